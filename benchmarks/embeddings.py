@@ -0,0 +1,101 @@
+# coding: utf-8
+"""Per-chunk benchmark of the HTDemucs embedding caches (demucs4/transformer.py).
+
+    python benchmarks/embeddings.py
+    python benchmarks/embeddings.py --iters 5 --threads 4
+
+Builds a default HTDemucs with the demucs package, as inference.py loads it,
+and times one segment forward with and without `adopt_model`, which turns on
+the caches of the positional and frequency embeddings (and the STFT plans, see
+benchmarks/stft.py for those alone). The time to build the 2d positional
+embedding, uncached and cached, is printed as well. Best times are reported,
+the maximum absolute difference of the outputs is printed.
+"""
+
+import argparse
+import copy
+import os
+import sys
+from time import perf_counter
+
+import torch
+from einops import rearrange
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from demucs4.htdemucs import adopt_model  # noqa: E402
+from demucs4.transformer import (  # noqa: E402
+    cached_embedding,
+    create_2d_sin_embedding,
+)
+
+
+def timeit(func, iters):
+    """Best time of `iters` calls of `func` after a warm up call."""
+    out = func()
+    best = float("inf")
+    for _ in range(iters):
+        start = perf_counter()
+        out = func()
+        best = min(best, perf_counter() - start)
+    return best, out
+
+
+def bench_2d_embedding(channels, freqs, frames, iters):
+    def build():
+        return rearrange(
+            create_2d_sin_embedding(channels, freqs, frames),
+            "b c fr t1 -> b (t1 fr) c",
+        )
+
+    module = torch.nn.Module().eval()
+    key = ("2d", channels, freqs, frames)
+    with torch.no_grad():
+        uncached, _ = timeit(build, iters)
+        cached, _ = timeit(lambda: cached_embedding(module, key, build), iters)
+    print(
+        "2d embedding ({}, {}, {}): uncached {:.3f} ms, cached {:.4f} ms".format(
+            channels, freqs, frames, uncached * 1e3, cached * 1e3
+        )
+    )
+
+
+def bench_htdemucs(iters):
+    from demucs.htdemucs import HTDemucs
+
+    original = HTDemucs(["drums", "bass", "other", "vocals"]).eval()
+    adopted = adopt_model(copy.deepcopy(original))
+    mix = torch.randn(1, 2, int(original.segment * original.samplerate))
+    times = {original: [], adopted: []}
+    outs = {}
+    with torch.no_grad():
+        # Interleaved so that load on the machine hits both the same
+        for model in [original, adopted] * (iters + 1):
+            start = perf_counter()
+            outs[model] = model(mix)
+            times[model].append(perf_counter() - start)
+    # The first call of each fills the caches
+    t0, t1 = min(times[original][1:]), min(times[adopted][1:])
+    print(
+        "HTDemucs forward, one {:.1f} s segment: before {:.0f} ms, after {:.0f} ms"
+        " ({:+.1%}), max diff {:.3g}".format(
+            float(original.segment),
+            t0 * 1e3,
+            t1 * 1e3,
+            t1 / t0 - 1,
+            (outs[original] - outs[adopted]).abs().max().item(),
+        )
+    )
+
+
+if __name__ == "__main__":
+    m = argparse.ArgumentParser(description="Benchmark the HTDemucs embedding caches")
+    m.add_argument("--iters", type=int, default=3, help="Timed calls per case")
+    m.add_argument("--threads", type=int, default=0, help="Torch threads")
+    args = m.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    # The transformer input of a default HTDemucs segment
+    bench_2d_embedding(384, 8, 431, 20)
+    bench_htdemucs(args.iters)
@@ -0,0 +1,125 @@
+# coding: utf-8
+"""Micro-benchmark of the shared STFT engine (demucs4/spec.py).
+
+    python benchmarks/stft.py
+    python benchmarks/stft.py --frames 8 --iters 20 --threads 4
+
+Times, before and after the engine and on random inputs:
+  - the MDX wrapper STFT + iSTFT of `--frames` frames, against the original
+    implementation with a window built at load and a frequency pad repeated
+    at every call,
+  - HTDemucs._spec + _ispec of one segment, against the demucs package class
+    that inference.py loads before `adopt_model`.
+Outputs are compared, the maximum absolute difference is printed.
+"""
+
+import argparse
+import os
+import sys
+from time import perf_counter
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inference  # noqa: E402
+from demucs4.htdemucs import adopt_model  # noqa: E402
+
+
+class OriginalMDXSTFT:
+    """STFT and iSTFT of `Conv_TDF_net_trim_model` before the shared engine."""
+
+    def __init__(self, model):
+        self.model = model
+        self.window = torch.hann_window(window_length=model.n_fft, periodic=True)
+        self.freq_pad = torch.zeros(
+            [1, model.dim_c, model.n_bins - model.dim_f, model.dim_t]
+        )
+
+    def stft(self, x):
+        m = self.model
+        x = x.reshape([-1, m.chunk_size])
+        x = torch.stft(
+            x,
+            n_fft=m.n_fft,
+            hop_length=m.hop,
+            window=self.window,
+            center=True,
+            return_complex=True,
+        )
+        x = torch.view_as_real(x)
+        x = x.permute([0, 3, 1, 2])
+        x = x.reshape([-1, 2, 2, m.n_bins, m.dim_t]).reshape(
+            [-1, m.dim_c, m.n_bins, m.dim_t]
+        )
+        return x[:, :, : m.dim_f]
+
+    def istft(self, x):
+        m = self.model
+        x = torch.cat([x, self.freq_pad.repeat([x.shape[0], 1, 1, 1])], -2)
+        x = x.reshape([-1, 2, 2, m.n_bins, m.dim_t]).reshape([-1, 2, m.n_bins, m.dim_t])
+        x = x.permute([0, 2, 3, 1]).contiguous()
+        x = torch.view_as_complex(x)
+        x = torch.istft(x, n_fft=m.n_fft, hop_length=m.hop, window=self.window)
+        return x.reshape([-1, 2, m.chunk_size])
+
+
+def timeit(func, iters):
+    func()
+    start = perf_counter()
+    for _ in range(iters):
+        out = func()
+    return (perf_counter() - start) / iters, out
+
+
+def report(name, before, after):
+    (t0, out0), (t1, out1) = before, after
+    print(
+        "{}: before {:.2f} ms, after {:.2f} ms ({:+.0%}), max diff {:.3g}".format(
+            name,
+            t0 * 1e3,
+            t1 * 1e3,
+            t1 / t0 - 1,
+            (out0 - out1).abs().max().item(),
+        )
+    )
+
+
+def bench_mdx(frames, iters):
+    model = inference.get_models("vocals", "cpu", vocals_model_type=3)[0]
+    original = OriginalMDXSTFT(model)
+    x = torch.randn(frames, 2, model.chunk_size)
+    with torch.no_grad():
+        before = timeit(lambda: original.istft(original.stft(x)), iters)
+        after = timeit(lambda: model.istft(model.stft(x)), iters)
+    report("MDX stft + istft, {} frames".format(frames), before, after)
+
+
+def bench_htdemucs(iters):
+    from demucs.htdemucs import HTDemucs
+
+    model = HTDemucs(["drums", "bass", "other", "vocals"]).eval()
+    mix = torch.randn(1, 2, int(model.segment * model.samplerate))
+
+    def spec_ispec():
+        z = model._spec(mix)
+        return model._ispec(z, mix.shape[-1])
+
+    with torch.no_grad():
+        before = timeit(spec_ispec, iters)
+        adopt_model(model)
+        after = timeit(spec_ispec, iters)
+    report("HTDemucs _spec + _ispec, one segment", before, after)
+
+
+if __name__ == "__main__":
+    m = argparse.ArgumentParser(description="Benchmark the shared STFT engine")
+    m.add_argument("--frames", type=int, default=4, help="MDX frames per call")
+    m.add_argument("--iters", type=int, default=10, help="Timed calls per case")
+    m.add_argument("--threads", type=int, default=0, help="Torch threads")
+    args = m.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    bench_mdx(args.frames, args.iters)
+    bench_htdemucs(args.iters)
@@ -0,0 +1,29 @@
+# coding: utf-8
+"""Convert the Demucs checkpoints of the ensemble to memory mapped files.
+
+    python convert_models.py              # every Demucs model of the ensemble
+    python convert_models.py htdemucs_ft
+
+The converted checkpoints are saved in the models folder, inference.py loads
+them from there with `demucs4.states.load_flat_model`: the weights are mapped
+from the file and paged in when used, rather than unpickled and copied at
+every load. Delete the `.flat` files to go back to the original checkpoints.
+"""
+
+import argparse
+
+import inference
+
+if __name__ == "__main__":
+    m = argparse.ArgumentParser(description="Convert Demucs checkpoints")
+    m.add_argument(
+        "names",
+        nargs="*",
+        default=[inference.DEMUCS_VOCALS_MODEL] + inference.DEMUCS_INSTRUM_MODELS,
+        help="Pretrained Demucs models to convert. Default: those of the ensemble",
+    )
+    args = m.parse_args()
+    converted = inference.convert_demucs_models(args.names)
+    print(
+        "Converted {} checkpoints in {}".format(len(converted), inference.MODEL_FOLDER)
+    )
@@ -0,0 +1,261 @@
+# coding: utf-8
+"""Separation daemon keeping the ensemble loaded between requests.
+
+Start the server once with the options of inference.py, then separate files
+with the light client, which neither imports torch nor loads models:
+
+    python daemon.py serve --port 8765
+    python daemon.py separate -i mixture.wav -r ./results/
+    python daemon.py status
+
+Requests are JSON posted to `/separate` on localhost. The answer streams one
+JSON event per line: `queued`, `start`, `progress`, `file` (an output was
+written), `done` (an input is finished) and finally `finished` or `error`.
+Requests run one at a time on the loaded ensemble, a request whose client
+disconnects is stopped.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class SeparationServer(ThreadingHTTPServer):
+    """HTTP server owning one ensemble built from `options`."""
+
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        import inference
+
+        super().__init__(address, SeparationHandler)
+        self.inference = inference
+        self.options = inference.plain_options(options)
+        self.lock = threading.Lock()
+        self.built_for = inference.ensemble_options(self.options)
+        start_time = time()
+        self.model = inference.EnsembleDemucsMDXMusicSeparationModel(self.options)
+        print("Ensemble ready in {:.1f} sec".format(time() - start_time))
+
+    def separate(self, request, emit):
+        """Run `predict_with_model` for `request` options on top of the server
+        options, reporting through `emit(event)`. The ensemble is rebuilt if
+        the request changes its options."""
+        inference = self.inference
+        options = dict(self.options)
+        options.update(request)
+        options["stop_requested"] = False
+
+        def send(event):
+            try:
+                emit(event)
+            except OSError:
+                # The client went away, nobody waits for the result
+                options["stop_requested"] = True
+
+        def file_write(path, data, sr, subtype):
+            import soundfile as sf
+
+            sf.write(path, data, sr, subtype=subtype)
+            send({"event": "file", "path": os.path.abspath(path)})
+
+        options["update_percent_func"] = lambda val: send(
+            {"event": "progress", "percent": val}
+        )
+        options["file_start_callback"] = lambda f: send({"event": "start", "file": f})
+        options["file_done_callback"] = lambda f: send({"event": "done", "file": f})
+        options["file_write"] = file_write
+
+        send({"event": "queued"})
+        with self.lock:
+            if options["stop_requested"]:
+                return
+            start_time = time()
+            if inference.ensemble_options(options) != self.built_for:
+                print("Request options change the ensemble, rebuild it")
+                self.model = None
+                self.built_for = inference.ensemble_options(options)
+            try:
+                self.model = inference.predict_with_model(options, self.model)
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+                send({"event": "error", "message": error})
+                return
+            send({"event": "finished", "time": time() - start_time})
+
+
+class SeparationHandler(BaseHTTPRequestHandler):
+    def send_json(self, code, value):
+        body = json.dumps(value).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        self.send_json(
+            200,
+            {
+                "version": self.server.inference.__VERSION__,
+                "device": self.server.model.device if self.server.model else None,
+                "busy": self.server.lock.locked(),
+            },
+        )
+
+    def do_POST(self):
+        if self.path != "/separate":
+            self.send_json(404, {"error": "Unknown path {}".format(self.path)})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))["options"]
+            missing = [f for f in request["input_audio"] if not os.path.isfile(f)]
+            if not request.get("output_folder"):
+                raise ValueError("output_folder is not set")
+        except (KeyError, TypeError, ValueError) as e:
+            self.send_json(400, {"error": "Bad request: {!r}".format(e)})
+            return
+        if missing:
+            self.send_json(
+                400, {"error": "No such file: {}".format(", ".join(missing))}
+            )
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+        def emit(event):
+            self.wfile.write(json.dumps(event).encode() + b"\n")
+            self.wfile.flush()
+
+        self.server.separate(request, emit)
+
+
+def serve(options, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    server = SeparationServer((host, port), options)
+    print("Listening on http://{}:{}".format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def separate(options, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """Send a separation request to the daemon and yield its events.
+    `options` are `predict_with_model` options used on top of the daemon
+    options, with at least `input_audio` and `output_folder`."""
+    options = dict(options)
+    options["input_audio"] = [os.path.abspath(f) for f in options["input_audio"]]
+    options["output_folder"] = os.path.abspath(options["output_folder"])
+    conn = http.client.HTTPConnection(host, port)
+    try:
+        conn.request(
+            "POST",
+            "/separate",
+            json.dumps({"options": options}),
+            {"Content-Type": "application/json"},
+        )
+        response = conn.getresponse()
+        if response.status != 200:
+            raise RuntimeError(json.loads(response.read())["error"])
+        for line in response:
+            yield json.loads(line)
+    finally:
+        conn.close()
+
+
+def status(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    conn = http.client.HTTPConnection(host, port)
+    try:
+        conn.request("GET", "/status")
+        return json.loads(conn.getresponse().read())
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == "serve":
+        import inference
+
+        m = argparse.ArgumentParser(
+            prog="daemon.py serve",
+            parents=[inference.build_parser(add_help=False, inputs=False)],
+            description="Load the ensemble and serve separation requests",
+        )
+    else:
+        m = argparse.ArgumentParser(
+            prog="daemon.py",
+            description="Separation daemon and its client",
+            epilog="Start the daemon with: daemon.py serve [inference.py options]",
+        )
+        m.add_argument("command", choices=["separate", "status"])
+    m.add_argument("--host", type=str, default=DEFAULT_HOST, help="Daemon address")
+    m.add_argument("--port", type=int, default=DEFAULT_PORT, help="Daemon port")
+    if command == "separate":
+        m.add_argument(
+            "--input_audio",
+            "-i",
+            nargs="+",
+            type=str,
+            help="Input audio location. You can provide multiple files at once",
+            required=True,
+        )
+        m.add_argument(
+            "--output_folder",
+            "-r",
+            type=str,
+            help="Output audio folder",
+            required=True,
+        )
+        m.add_argument(
+            "--stems",
+            nargs="+",
+            help="Outputs to create. Default: those of the daemon",
+        )
+        m.add_argument(
+            "--skip_existing",
+            action="store_true",
+            help="Skip inputs already separated into the output folder",
+        )
+
+    args = m.parse_args(sys.argv[2:] if command == "serve" else sys.argv[1:])
+    options = args.__dict__
+    host = options.pop("host")
+    port = options.pop("port")
+    if command == "serve":
+        serve(options, host, port)
+    elif options.pop("command") == "status":
+        print(json.dumps(status(host, port), indent=1))
+    else:
+        options = {key: value for key, value in options.items() if value}
+        start_time = time()
+        for event in separate(options, host, port):
+            if event["event"] == "progress":
+                print("Progress: {}%".format(event["percent"]))
+            elif event["event"] == "start":
+                print("Go for: {}".format(event["file"]))
+            elif event["event"] == "file":
+                print("File created: {}".format(event["path"]))
+            elif event["event"] == "done":
+                print("Done: {}".format(event["file"]))
+            elif event["event"] == "error":
+                print(event["message"])
+                sys.exit(1)
+        print("Time: {:.0f} sec".format(time() - start_time))
@@ -20,7 +20,7 @@ from .transformer import CrossTransformerEncoder
 
 from .demucs import rescale_module
 from .states import capture_init
-from .spec import spectro, ispectro
+from .spec import spectro, get_plan
 from .hdemucs import pad1d, ScaledEmbedding, HEncLayer, MultiWrap, HDecLayer
 
 
@@ -434,6 +434,15 @@ class HTDemucs(nn.Module):
         pad = hl // 2 * 3
         x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
 
+        if hl % 2 == 0:
+            # The `le` frames kept below only cover samples of the re-padded
+            # signal, so we can skip the centering pad of torch.stft and the
+            # 4 extra frames it produces.
+            plan = get_plan(nfft, hl, normalized=True, center=False)
+            z = plan.stft(x)[..., :-1, :]
+            assert z.shape[-1] == le, (z.shape, x.shape, le)
+            return z
+
         z = spectro(x, nfft, hl)[..., :-1, :]
         assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
         z = z[..., 2: 2 + le]
@@ -441,11 +450,11 @@ class HTDemucs(nn.Module):
 
     def _ispec(self, z, length=None, scale=0):
         hl = self.hop_length // (4**scale)
-        z = F.pad(z, (0, 0, 0, 1))
-        z = F.pad(z, (2, 2))
+        plan = get_plan(2 * z.shape[-2], hl, normalized=True)
+        z = plan.pad(z, freq=(0, 1), time=(2, 2))
         pad = hl // 2 * 3
         le = hl * int(math.ceil(length / hl)) + 2 * pad
-        x = ispectro(z, hl, length=le)
+        x = plan.istft(z, length=le)
         x = x[..., pad: pad + length]
         return x
 
@@ -10,7 +10,11 @@ from copy import deepcopy
 import math
 import typing as tp
 
-from openunmix.filtering import wiener
+try:
+    from openunmix.filtering import wiener
+except ImportError:
+    # demucs 4.1 ships the OpenUnmix filtering it uses
+    from demucs.wiener import wiener
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -9,19 +9,28 @@ This code contains the spectrogram and Hybrid version of Demucs.
 """
 import math
 
-from openunmix.filtering import wiener
+try:
+    from openunmix.filtering import wiener
+except ImportError:
+    # demucs 4.1 ships the OpenUnmix filtering it uses
+    from demucs.wiener import wiener
 import torch
 from torch import nn
 from torch.nn import functional as F
 from fractions import Fraction
 from einops import rearrange
 
-from .transformer import CrossTransformerEncoder
+from .transformer import (
+    CrossTransformerEncoder,
+    cached_embedding,
+    weights_version,
+)
 
 from .demucs import rescale_module
 from .states import capture_init
-from .spec import spectro, ispectro
-from .hdemucs import pad1d, ScaledEmbedding, HEncLayer, MultiWrap, HDecLayer
+from .spec import spectro, get_plan
+from .hdemucs import pad1d, ScaledEmbedding, HEncLayer, MultiWrap, HDecLayer, HDemucs
+from .utils import adopt_classes
 
 
 class HTDemucs(nn.Module):
@@ -434,6 +443,15 @@ class HTDemucs(nn.Module):
         pad = hl // 2 * 3
         x = pad1d(x, (pad, pad + le * hl - x.shape[-1]), mode="reflect")
 
+        if hl % 2 == 0:
+            # The `le` frames kept below only cover samples of the re-padded
+            # signal, so we can skip the centering pad of torch.stft and the
+            # 4 extra frames it produces.
+            plan = get_plan(nfft, hl, normalized=True, center=False)
+            z = plan.stft(x)[..., :-1, :]
+            assert z.shape[-1] == le, (z.shape, x.shape, le)
+            return z
+
         z = spectro(x, nfft, hl)[..., :-1, :]
         assert z.shape[-1] == le + 4, (z.shape, x.shape, le)
         z = z[..., 2: 2 + le]
@@ -441,11 +459,11 @@ class HTDemucs(nn.Module):
 
     def _ispec(self, z, length=None, scale=0):
         hl = self.hop_length // (4**scale)
-        z = F.pad(z, (0, 0, 0, 1))
-        z = F.pad(z, (2, 2))
+        plan = get_plan(2 * z.shape[-2], hl, normalized=True)
+        z = plan.pad(z, freq=(0, 1), time=(2, 2))
         pad = hl // 2 * 3
         le = hl * int(math.ceil(length / hl)) + 2 * pad
-        x = ispectro(z, hl, length=le)
+        x = plan.istft(z, length=le)
         x = x[..., pad: pad + length]
         return x
 
@@ -508,6 +526,10 @@ class HTDemucs(nn.Module):
         assert list(out.shape) == [B, S, C, Fq, T]
         return out.to(init)
 
+    def train(self, mode: bool = True):
+        self.__dict__.pop("_embedding_cache", None)
+        return super().train(mode)
+
     def valid_length(self, length: int):
         """
         Return a length that is appropriate for evaluation.
@@ -577,9 +599,19 @@ class HTDemucs(nn.Module):
             if idx == 0 and self.freq_emb is not None:
                 # add frequency embedding to allow for non equivariant convolutions
                 # over the frequency axis.
-                frs = torch.arange(x.shape[-2], device=x.device)
-                emb = self.freq_emb(frs).t()[None, :, :, None].expand_as(x)
-                x = x + self.freq_emb_scale * emb
+                Fr = x.shape[-2]
+
+                def make_freq_emb():
+                    frs = torch.arange(Fr, device=x.device)
+                    emb = self.freq_emb(frs).t()[None, :, :, None]
+                    return self.freq_emb_scale * emb
+
+                emb = cached_embedding(
+                    self,
+                    ("freq", Fr, x.dtype, x.device, weights_version(self.freq_emb)),
+                    make_freq_emb,
+                )
+                x = x + emb.expand_as(x)
 
             saved.append(x)
         if self.crosstransformer:
@@ -646,3 +678,10 @@ class HTDemucs(nn.Module):
         if length_pre_pad:
             x = x[..., :length_pre_pad]
         return x
+
+
+def adopt_model(model):
+    """Run `model`, loaded with the demucs package, with the HTDemucs, HDemucs
+    and CrossTransformerEncoder of this copy, and so with its STFT plans and
+    embedding caches, see `adopt_classes`."""
+    return adopt_classes(model, [HTDemucs, HDemucs, CrossTransformerEncoder])
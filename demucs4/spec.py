@@ -5,37 +5,124 @@
 # LICENSE file in the root directory of this source tree.
 """Conveniance wrapper to perform STFT and iSTFT"""
 
+import threading
+
 import torch as th
+from torch.nn import functional as F
+
+
+_windows = {}
+_plans = {}
+_lock = threading.Lock()
+
+
+def hann_window(win_length, dtype=th.float32, device="cpu"):
+    """Return a periodic Hann window, cached per (win_length, dtype, device).
+    The cached tensor is shared, it must not be modified in place."""
+    device = th.device(device)
+    key = (win_length, dtype, device)
+    window = _windows.get(key)
+    if window is None:
+        window = th.hann_window(win_length, dtype=dtype, device=device)
+        with _lock:
+            window = _windows.setdefault(key, window)
+    return window
+
+
+class STFTPlan:
+    """Fixed STFT/iSTFT settings along with cached windows and scratch buffers.
+
+    Plans are shared (see `get_plan`), so scratch buffers are kept per thread
+    and are only meant to hold inputs consumed within a single call.
+    """
+
+    def __init__(self, n_fft, hop_length=None, win_length=None,
+                 normalized=False, center=True, pad_mode='reflect'):
+        self.n_fft = n_fft
+        self.hop_length = hop_length or n_fft // 4
+        self.win_length = win_length or n_fft
+        self.normalized = normalized
+        self.center = center
+        self.pad_mode = pad_mode
+        self._local = threading.local()
+
+    def window(self, dtype=th.float32, device="cpu"):
+        return hann_window(self.win_length, dtype, device)
+
+    def stft(self, x):
+        *other, length = x.shape
+        x = x.reshape(-1, length)
+        z = th.stft(x,
+                    self.n_fft,
+                    self.hop_length,
+                    window=self.window(x.dtype, x.device),
+                    win_length=self.win_length,
+                    normalized=self.normalized,
+                    center=self.center,
+                    return_complex=True,
+                    pad_mode=self.pad_mode)
+        _, freqs, frame = z.shape
+        return z.view(*other, freqs, frame)
+
+    def istft(self, z, length=None):
+        *other, freqs, frames = z.shape
+        z = z.reshape(-1, freqs, frames)
+        x = th.istft(z,
+                     self.n_fft,
+                     self.hop_length,
+                     window=self.window(z.real.dtype, z.device),
+                     win_length=self.win_length,
+                     normalized=self.normalized,
+                     length=length,
+                     center=self.center)
+        _, length = x.shape
+        return x.view(*other, length)
+
+    def buffer(self, name, shape, dtype, device):
+        """Zero initialised scratch tensor reused across calls of this thread.
+        Callers must only write the regions they overwrite on every call."""
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = {}
+        key = (name, tuple(shape), dtype, th.device(device))
+        buf = buffers.get(key)
+        if buf is None:
+            buf = buffers[key] = th.zeros(shape, dtype=dtype, device=device)
+        return buf
+
+    def pad(self, z, freq=(0, 0), time=(0, 0)):
+        """Zero pad the last two dims of `z` (frequency, time).
+        Outside of autograd the result lives in a reused scratch buffer."""
+        if th.is_grad_enabled() and z.requires_grad:
+            return F.pad(z, (time[0], time[1], freq[0], freq[1]))
+        *other, freqs, frames = z.shape
+        shape = (*other, freq[0] + freqs + freq[1], time[0] + frames + time[1])
+        buf = self.buffer('pad', shape, z.dtype, z.device)
+        buf[..., freq[0]:freq[0] + freqs, time[0]:time[0] + frames] = z
+        return buf
+
+
+def get_plan(n_fft, hop_length=None, win_length=None,
+             normalized=False, center=True, pad_mode='reflect'):
+    """Return the shared `STFTPlan` for the given settings."""
+    key = (n_fft, hop_length or n_fft // 4, win_length or n_fft, normalized, center, pad_mode)
+    plan = _plans.get(key)
+    if plan is None:
+        plan = STFTPlan(n_fft, hop_length, win_length, normalized, center, pad_mode)
+        with _lock:
+            plan = _plans.setdefault(key, plan)
+    return plan
 
 
 def spectro(x, n_fft=512, hop_length=None, pad=0):
-    *other, length = x.shape
-    x = x.reshape(-1, length)
-    z = th.stft(x,
-                n_fft * (1 + pad),
-                hop_length or n_fft // 4,
-                window=th.hann_window(n_fft).to(x),
-                win_length=n_fft,
-                normalized=True,
-                center=True,
-                return_complex=True,
-                pad_mode='reflect')
-    _, freqs, frame = z.shape
-    return z.view(*other, freqs, frame)
+    plan = get_plan(n_fft * (1 + pad), hop_length or n_fft // 4,
+                    win_length=n_fft, normalized=True)
+    return plan.stft(x)
 
 
 def ispectro(z, hop_length=None, length=None, pad=0):
-    *other, freqs, frames = z.shape
-    n_fft = 2 * freqs - 2
-    z = z.view(-1, freqs, frames)
+    n_fft = 2 * z.shape[-2] - 2
     win_length = n_fft // (1 + pad)
-    x = th.istft(z,
-                 n_fft,
-                 hop_length,
-                 window=th.hann_window(win_length).to(z.real),
-                 win_length=win_length,
-                 normalized=True,
-                 length=length,
-                 center=True)
-    _, length = x.shape
-    return x.view(*other, length)
+    plan = get_plan(n_fft, hop_length or win_length // 4,
+                    win_length=win_length, normalized=True)
+    return plan.istft(z, length)
@@ -8,11 +8,16 @@ Utilities to save and load models.
 """
 
 from contextlib import contextmanager
+from fractions import Fraction
 
 import functools
 import hashlib
+import importlib
 import inspect
 import io
+import itertools
+import json
+import os
 from pathlib import Path
 import warnings
 
@@ -52,19 +57,93 @@ def load_model(path_or_package, strict=False):
     args = package["args"]
     kwargs = package["kwargs"]
 
-    if strict:
-        model = klass(*args, **kwargs)
-    else:
+    model = _build_model(klass, args, kwargs, strict)
+
+    state = package["state"]
+
+    set_state(model, state)
+    return model
+
+
+def _build_model(klass, args, kwargs, strict=False):
+    if not strict:
         sig = inspect.signature(klass)
         for key in list(kwargs):
             if key not in sig.parameters:
                 warnings.warn("Dropping inexistant parameter " + key)
                 del kwargs[key]
-        model = klass(*args, **kwargs)
+    return klass(*args, **kwargs)
 
-    state = package["state"]
 
-    set_state(model, state)
+def _encode_meta(value):
+    if isinstance(value, Fraction):
+        return {"__fraction__": [value.numerator, value.denominator]}
+    raise TypeError(f"Cannot store {value!r} in the model metadata.")
+
+
+def _decode_meta(value):
+    if "__fraction__" in value:
+        return Fraction(*value["__fraction__"])
+    return value
+
+
+def save_flat_model(path_or_package, path):
+    """Convert a serialized model (see `load_model`) to a flat tensor file `path`
+    that `load_flat_model` memory maps. The klass/args/kwargs are stored beside it
+    in `path + ".json"`. Quantized or half precision states are stored in the dtype
+    of the model, so that loading maps them as they are, without conversion."""
+    if isinstance(path_or_package, (str, Path)):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            package = torch.load(path_or_package, "cpu", weights_only=False)
+    else:
+        package = path_or_package
+    model = load_model(package)
+    klass = package["klass"]
+    meta = {
+        "klass": f"{klass.__module__}:{klass.__qualname__}",
+        "args": list(package["args"]),
+        "kwargs": package["kwargs"],
+    }
+    state = {k: v.detach().contiguous() for k, v in model.state_dict().items()}
+    path = str(path)
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path)
+    with open(tmp_path + ".json", "w") as f:
+        json.dump(meta, f, default=_encode_meta, indent=1)
+    os.replace(tmp_path + ".json", path + ".json")
+    os.replace(tmp_path, path)
+
+
+def load_flat_model(path, mmap=True):
+    """Load a model saved by `save_flat_model`. With `mmap` the parameters are backed
+    by the file and paged in on first use, rather than read and copied at load."""
+    path = str(path)
+    with open(path + ".json") as f:
+        meta = json.load(f, object_hook=_decode_meta)
+    module, name = meta["klass"].split(":")
+    klass = importlib.import_module(module)
+    for attr in name.split("."):
+        klass = getattr(klass, attr)
+    state = torch.load(path, "cpu", weights_only=True, mmap=mmap)
+
+    # Built on the meta device, without allocating or initializing weights, the
+    # state tensors are assigned in their place. The device only applies to
+    # this thread.
+    with torch.device("meta"):
+        model = _build_model(klass, meta["args"], meta["kwargs"])
+    # Demucs overrides load_state_dict for old key names, without `assign`. The
+    # keys saved by `save_flat_model` are those of the model already.
+    torch.nn.Module.load_state_dict(model, state, assign=True)
+    missing = [
+        name
+        for name, tensor in itertools.chain(
+            model.named_parameters(), model.named_buffers()
+        )
+        if tensor.is_meta
+    ]
+    if missing:
+        raise ValueError(f"No state for {', '.join(missing)} in {path}.")
     return model
 
 
@@ -70,6 +70,27 @@ def create_2d_sin_embedding(d_model, height, width, device="cpu", max_period=100
     return pe[None, :].to(device)
 
 
+def cached_embedding(module: nn.Module, key: tp.Tuple, make: tp.Callable):
+    """Return `make()`, computed once per `key` while `module` runs in eval mode
+    without grad. Positional and frequency embeddings only depend on the
+    shape, dtype and device of the input then. The cache is dropped by
+    `module.train()`, keys of learned embeddings hold `weights_version`.
+    """
+    if module.training or torch.is_grad_enabled():
+        return make()
+    cache = module.__dict__.setdefault("_embedding_cache", {})
+    emb = cache.get(key)
+    if emb is None:
+        emb = cache[key] = make()
+    return emb
+
+
+def weights_version(embedding: nn.Module):
+    """Changes when the weights of `embedding` are replaced or updated in place."""
+    weight = embedding.embedding.weight
+    return id(weight), weight._version
+
+
 def create_sin_embedding_cape(
     length: int,
     dim: int,
@@ -175,7 +196,7 @@ def get_elementary_mask(
     return mask
 
 
-def get_mask(
+def get_dense_mask(
     T1,
     T2,
     mask_type,
@@ -186,10 +207,10 @@ def get_mask(
     device,
 ):
     """
-    Return a SparseCSRTensor mask that is a combination of elementary masks
+    Return a boolean (T2, T1) mask, True where attention is allowed, that is a
+    combination of elementary masks
     mask_type can be a combination of multiple masks: for instance "diag_jmask_random"
     """
-    from xformers.sparse import SparseCSRTensor
     # create a list
     mask_types = mask_type.split("_")
 
@@ -207,11 +228,121 @@ def get_mask(
         for mask in mask_types
     ]
 
-    final_mask = torch.stack(all_masks).sum(axis=0) > 0
+    return torch.stack(all_masks).sum(axis=0) > 0
 
+
+def get_mask(
+    T1,
+    T2,
+    mask_type,
+    sparse_attn_window,
+    global_window,
+    mask_random_seed,
+    sparsity,
+    device,
+):
+    """
+    Return the mask of `get_dense_mask` as a SparseCSRTensor for xformers
+    """
+    from xformers.sparse import SparseCSRTensor
+
+    final_mask = get_dense_mask(
+        T1,
+        T2,
+        mask_type,
+        sparse_attn_window,
+        global_window,
+        mask_random_seed,
+        sparsity,
+        device,
+    )
     return SparseCSRTensor.from_dense(final_mask[None])
 
 
+# Attention backends of the transformer layers, see `set_attention`
+ATTENTION_BACKENDS = ["native", "sdpa"]
+
+
+def set_attention(model: nn.Module, backend: str):
+    """Use `backend` for every attention of the transformer layers in `model`.
+
+    "native" is the original implementation: `nn.MultiheadAttention` for dense
+    layers, xformers for sparse ones. "sdpa" computes self and cross attentions
+    with `F.scaled_dot_product_attention`, which picks the flash or memory
+    efficient kernels where available, sparse masks become dense boolean
+    attention masks so xformers is not needed. Layers with `auto_sparsity`
+    keep the xformers kernels, their sparsity pattern is found at runtime.
+
+    Layers of models from the demucs package, whose transformer this module
+    copies unchanged, become instances of the classes of this module.
+    """
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(
+            "Unknown attention backend {}, use one of {}".format(
+                backend, ATTENTION_BACKENDS
+            )
+        )
+    layers = (MyTransformerEncoderLayer, CrossTransformerEncoderLayer)
+    copies = {}
+    try:
+        from demucs import transformer as demucs_transformer
+    except ImportError:
+        pass
+    else:
+        for layer in layers:
+            copies[getattr(demucs_transformer, layer.__name__)] = layer
+    for module in model.modules():
+        if type(module) in copies:
+            module.__class__ = copies[type(module)]
+        if isinstance(module, layers) and module.attention != backend:
+            module.attention = backend
+            # Masks are rebuilt in the format of the backend
+            if hasattr(module, "src_mask"):
+                module.src_mask = torch.zeros(1, 1)
+            if hasattr(module, "mask"):
+                module.mask = torch.zeros(1, 1)
+
+
+def sdpa_attention(attn: nn.Module, query, key, value, attn_mask=None):
+    """`attn(query, key, value, attn_mask=attn_mask)[0]` for a `nn.MultiheadAttention`
+    or a `MultiheadAttention`, computed with `F.scaled_dot_product_attention`.
+    A boolean `attn_mask` of shape (N_q, N_k) is True where attention is allowed.
+    """
+    packed = query is key and key is value
+    if not attn.batch_first:  # N, B, C
+        query, key, value = [x.transpose(0, 1) for x in [query, key, value]]
+    B, N_q, C = query.shape
+    if isinstance(attn, nn.MultiheadAttention):
+        assert attn._qkv_same_embed_dim and attn.bias_k is None
+        assert not attn.add_zero_attn
+        weight, bias = attn.in_proj_weight, attn.in_proj_bias
+        if packed:
+            q, k, v = F.linear(query, weight, bias).chunk(3, dim=-1)
+        else:
+            weights = weight.chunk(3)
+            biases = [None] * 3 if bias is None else bias.chunk(3)
+            q = F.linear(query, weights[0], biases[0])
+            k = F.linear(key, weights[1], biases[1])
+            v = F.linear(value, weights[2], biases[2])
+        dropout = attn.dropout
+        proj, proj_drop = attn.out_proj, nn.Identity()
+    else:
+        q, k, v = attn.q(query), attn.k(key), attn.v(value)
+        dropout = attn.attn_drop.p
+        proj, proj_drop = attn.proj, attn.proj_drop
+    q, k, v = [
+        x.reshape(B, -1, attn.num_heads, C // attn.num_heads).transpose(1, 2)
+        for x in [q, k, v]
+    ]
+    x = F.scaled_dot_product_attention(
+        q, k, v, attn_mask, dropout_p=dropout if attn.training else 0.0
+    )
+    x = proj_drop(proj(x.transpose(1, 2).reshape(B, N_q, C)))
+    if not attn.batch_first:
+        x = x.transpose(0, 1)
+    return x
+
+
 class ScaledEmbedding(nn.Module):
     def __init__(
         self,
@@ -269,6 +400,8 @@ class MyGroupNorm(nn.GroupNorm):
 
 
 class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
+    attention = "native"
+
     def __init__(
         self,
         d_model,
@@ -348,7 +481,8 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
             assert src_mask is None
             src_mask = self.src_mask
             if src_mask.shape[-1] != T:
-                src_mask = get_mask(
+                make_mask = get_dense_mask if self.attention == "sdpa" else get_mask
+                src_mask = make_mask(
                     T,
                     T,
                     self.mask_type,
@@ -376,8 +510,17 @@ class MyTransformerEncoderLayer(nn.TransformerEncoderLayer):
 
         return x
 
+    # self-attention block
+    def _sa_block(self, x, attn_mask, key_padding_mask, is_causal=False):
+        if self.attention == "sdpa" and not self.auto_sparsity:
+            assert key_padding_mask is None and not is_causal
+            return self.dropout1(sdpa_attention(self.self_attn, x, x, x, attn_mask))
+        return super()._sa_block(x, attn_mask, key_padding_mask, is_causal)
+
 
 class CrossTransformerEncoderLayer(nn.Module):
+    attention = "native"
+
     def __init__(
         self,
         d_model: int,
@@ -478,7 +621,8 @@ class CrossTransformerEncoderLayer(nn.Module):
             assert mask is None
             mask = self.mask
             if mask.shape[-1] != S or mask.shape[-2] != T:
-                mask = get_mask(
+                make_mask = get_dense_mask if self.attention == "sdpa" else get_mask
+                mask = make_mask(
                     S,
                     T,
                     self.mask_type,
@@ -503,7 +647,10 @@ class CrossTransformerEncoderLayer(nn.Module):
 
     # self-attention block
     def _ca_block(self, q, k, attn_mask=None):
-        x = self.cross_attn(q, k, k, attn_mask=attn_mask, need_weights=False)[0]
+        if self.attention == "sdpa" and not self.auto_sparsity:
+            x = sdpa_attention(self.cross_attn, q, k, k, attn_mask)
+        else:
+            x = self.cross_attn(q, k, k, attn_mask=attn_mask, need_weights=False)[0]
         return self.dropout1(x)
 
     # feed forward block
@@ -645,22 +792,51 @@ class CrossTransformerEncoder(nn.Module):
                     CrossTransformerEncoderLayer(**kwargs_cross_encoder)
                 )
 
+    def train(self, mode: bool = True):
+        self.__dict__.pop("_embedding_cache", None)
+        return super().train(mode)
+
     def forward(self, x, xt):
         B, C, Fr, T1 = x.shape
-        pos_emb_2d = create_2d_sin_embedding(
-            C, Fr, T1, x.device, self.max_period
-        )  # (1, C, Fr, T1)
-        pos_emb_2d = rearrange(pos_emb_2d, "b c fr t1 -> b (t1 fr) c")
+
+        def make_pos_emb_2d():
+            pos_emb_2d = create_2d_sin_embedding(
+                C, Fr, T1, x.device, self.max_period
+            )  # (1, C, Fr, T1)
+            pos_emb_2d = rearrange(pos_emb_2d, "b c fr t1 -> b (t1 fr) c")
+            return self.weight_pos_embed * pos_emb_2d
+
+        pos_emb_2d = cached_embedding(
+            self,
+            ("2d", C, Fr, T1, x.dtype, x.device, self.weight_pos_embed),
+            make_pos_emb_2d,
+        )
         x = rearrange(x, "b c fr t1 -> b (t1 fr) c")
         x = self.norm_in(x)
-        x = x + self.weight_pos_embed * pos_emb_2d
+        x = x + pos_emb_2d
 
         B, C, T2 = xt.shape
         xt = rearrange(xt, "b c t2 -> b t2 c")  # now T2, B, C
-        pos_emb = self._get_pos_embedding(T2, B, C, x.device)
-        pos_emb = rearrange(pos_emb, "t2 b c -> b t2 c")
+        shift = None
+        if self.emb == "sin":
+            shift = random.randrange(self.sin_random_shift + 1)
+        version = None
+        if self.emb == "scaled":
+            version = weights_version(self.position_embeddings)
+
+        def make_pos_emb():
+            pos_emb = self._get_pos_embedding(T2, B, C, x.device, shift)
+            pos_emb = rearrange(pos_emb, "t2 b c -> b t2 c")
+            return self.weight_pos_embed * pos_emb
+
+        pos_emb = cached_embedding(
+            self,
+            ("1d", T2, B, C, xt.dtype, x.device, self.weight_pos_embed)
+            + (shift, version),
+            make_pos_emb,
+        )
         xt = self.norm_in_t(xt)
-        xt = xt + self.weight_pos_embed * pos_emb
+        xt = xt + pos_emb
 
         for idx in range(self.num_layers):
             if idx % 2 == self.classic_parity:
@@ -675,9 +851,10 @@ class CrossTransformerEncoder(nn.Module):
         xt = rearrange(xt, "b t2 c -> b c t2")
         return x, xt
 
-    def _get_pos_embedding(self, T, B, C, device):
+    def _get_pos_embedding(self, T, B, C, device, shift=None):
         if self.emb == "sin":
-            shift = random.randrange(self.sin_random_shift + 1)
+            if shift is None:
+                shift = random.randrange(self.sin_random_shift + 1)
             pos_emb = create_sin_embedding(
                 T, C, shift=shift, device=device, max_period=self.max_period
             )
@@ -13,16 +13,12 @@ from datetime import datetime
 from collections import deque
 import time
 import queue
-import soundfile as sf
 
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
-import torch
 import threading
 
-from inference import predict_with_model
-
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
@@ -94,7 +90,8 @@ class ConfigManager:
         "large_gpu": False,
         "use_kim_model_1": False,
         "only_vocals": False,
-        "chunk_size": 1000000,
+        # 0 leaves the chunk size to the memory planner of inference.py
+        "chunk_size": 0,
         "overlap_large": 0.6,
         "overlap_small": 0.5,
         "log_console_visible": False,
@@ -160,6 +157,9 @@ class Worker(QObject):
         import traceback
 
         try:
+            # torch and the models load on first use, not at GUI startup
+            from inference import predict_with_model
+
             predict_with_model(self.options)
         except Exception:
             # emit the full traceback so the GUI log shows complete error details
@@ -181,6 +181,31 @@ class Worker(QObject):
         self.file_started.emit(filepath)
 
 
+class DeviceProbe(QObject):
+    """Loads the separation backends and probes the GPU off the GUI thread."""
+
+    detected = pyqtSignal(object)
+
+    def run(self):
+        info = {"cuda": False, "memory_gb": None}
+        try:
+            import torch
+
+            if torch.cuda.is_available():
+                info["cuda"] = True
+                info["memory_gb"] = torch.cuda.get_device_properties(0).total_memory / (
+                    1024 * 1024 * 1024
+                )
+        except Exception:
+            pass
+        try:
+            # warm up the imports so the first separation starts right away
+            import inference
+        except Exception:
+            pass
+        self.detected.emit(info)
+
+
 class CollapsibleGroupBox(QWidget):
     """Collapsible group box with toggle button."""
 
@@ -336,6 +361,8 @@ class FileWriter:
                     pass
                 break
             try:
+                import soundfile as sf
+
                 sf.write(path, data, sr, subtype=subtype)
             except Exception:
                 # best-effort: write failed; ignore but avoid crashing thread
@@ -383,29 +410,50 @@ class ModernMainWindow(QMainWindow):
         self._log_timer.setInterval(100)
         self._log_timer.timeout.connect(self._flush_log_queue)
 
-        self.init_gpu_detection()
+        # Filled by the device probe started once the window is shown
+        self.gpu_info = None
+        self._device_probe = DeviceProbe()
+        self._device_probe.detected.connect(self.init_gpu_detection)
+
         self.init_ui()
         self.apply_theme()
         self.load_settings()
+        # The device defaults are applied when the probe answers, separating
+        # before would run with the settings of another device
+        self.start_btn.setEnabled(False)
 
-    def init_gpu_detection(self):
-        try:
-            if torch.cuda.is_available():
-                t = torch.cuda.get_device_properties(0).total_memory / (
-                    1024 * 1024 * 1024
-                )
-                if t > 11.5:
-                    print(f"GPU memory: {t:.2f} GB - Using conservative chunk size")
-                    self.config["large_gpu"] = False
-                    self.config["chunk_size"] = 200000
-                elif t < 8:
-                    self.config["large_gpu"] = False
-                    self.config["single_onnx"] = True
-                    self.config["chunk_size"] = 500000
-            else:
-                self.config["cpu"] = True
-        except:
-            self.config["cpu"] = True
+        # Importing torch and probing CUDA takes seconds, do it after the
+        # first paint in a background thread
+        QTimer.singleShot(0, self.start_device_probe)
+
+    def start_device_probe(self):
+        threading.Thread(target=self._device_probe.run, daemon=True).start()
+
+    def device_settings(self):
+        return {
+            "cpu": self.checkbox_cpu.isChecked(),
+            "single_onnx": self.checkbox_single_onnx.isChecked(),
+        }
+
+    def init_gpu_detection(self, info):
+        """Apply the defaults of the detected device to the settings the user
+        did not change since they were loaded."""
+        self.gpu_info = info
+        t = info["memory_gb"]
+        detected = {}
+        if not info["cuda"]:
+            detected["cpu"] = True
+        elif t < 8:
+            detected["single_onnx"] = True
+        # The chunk size and the resident models are chosen by the memory
+        # planner of inference.py, which measures the device itself
+        current = self.device_settings()
+        for key, value in detected.items():
+            if current[key] == self._loaded_device_settings[key]:
+                getattr(self, "checkbox_" + key).setChecked(value)
+        if not self.is_processing:
+            self.start_btn.setEnabled(True)
+        self.update_device_info()
 
     def init_ui(self):
         self.setWindowTitle("Stem Splitter")
@@ -637,10 +685,12 @@ class ModernMainWindow(QMainWindow):
         advanced_grid.addWidget(label_chunk, 0, 0)
         self.chunk_size_spin = QSpinBox()
         self.chunk_size_spin.setFixedHeight(36)
-        self.chunk_size_spin.setRange(100000, 10000000)
+        self.chunk_size_spin.setRange(0, 10000000)
         self.chunk_size_spin.setSingleStep(100000)
+        self.chunk_size_spin.setSpecialValueText("Auto")
         self.chunk_size_spin.setToolTip(
-            "Size of chunks processed at once. Lower values use less memory."
+            "Size of chunks processed at once. Lower values use less memory. "
+            "Auto fits it to the memory of the device."
         )
         advanced_grid.addWidget(self.chunk_size_spin, 0, 1)
 
@@ -789,6 +839,7 @@ class ModernMainWindow(QMainWindow):
 
         self.log_console.setVisible(False)
 
+        self._loaded_device_settings = self.device_settings()
         self.update_device_info()
 
     def save_settings(self):
@@ -853,7 +904,9 @@ class ModernMainWindow(QMainWindow):
     def update_device_info(self):
         if self.checkbox_cpu.isChecked():
             device = "CPU"
-        elif torch.cuda.is_available():
+        elif self.gpu_info is None:
+            device = "detecting..."
+        elif self.gpu_info["cuda"]:
             device = "GPU (CUDA available)"
         else:
             device = "CPU (CUDA not available)"
@@ -976,7 +1029,7 @@ class ModernMainWindow(QMainWindow):
                 ConfigManager.save(self.config)
 
     def reset_advanced_settings(self):
-        self.chunk_size_spin.setValue(1000000)
+        self.chunk_size_spin.setValue(0)
         self.overlap_large_spin.setValue(0.6)
         self.overlap_small_spin.setValue(0.5)
 
@@ -1069,8 +1122,6 @@ class ModernMainWindow(QMainWindow):
             "output_folder": self.output_folder_edit.text(),
             "cpu": self.checkbox_cpu.isChecked(),
             "single_onnx": self.checkbox_single_onnx.isChecked(),
-            "large_gpu": self.checkbox_large_gpu.isChecked(),
-            "chunk_size": self.chunk_size_spin.value(),
             "overlap_large": self.overlap_large_spin.value(),
             "overlap_small": self.overlap_small_spin.value(),
             "use_kim_model_1": self.kim_combo.currentData(),
@@ -1079,6 +1130,12 @@ class ModernMainWindow(QMainWindow):
             "stop_event": threading.Event(),
         }
 
+        # Unset, the memory planner picks the chunk size and resident models
+        if self.chunk_size_spin.value():
+            options["chunk_size"] = self.chunk_size_spin.value()
+        if self.checkbox_large_gpu.isChecked():
+            options["large_gpu"] = True
+
         # Start the background FileWriter and provide a simple callback
         try:
             self._file_writer.start()
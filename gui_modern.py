@@ -14,7 +14,7 @@ if __name__ == "__main__":
     print("GPU use: {}".format(gpu_use))
     os.environ["CUDA_VISIBLE_DEVICES"] = "{}".format(gpu_use)
 
-from inference import __VERSION__
+from version import __VERSION__
 
 # Import the new GUI package entrypoint
 try:
@@ -18,11 +18,34 @@ import soundfile as sf
 
 from demucs.states import load_model
 from demucs import pretrained
-from demucs.apply import apply_model
+from demucs.apply import BagOfModels, TensorChunk, apply_model
+from demucs.utils import center_trim
+from demucs4.htdemucs import adopt_model
+from demucs4.spec import get_plan
+from demucs4.states import load_flat_model, save_flat_model
+from demucs4.transformer import ATTENTION_BACKENDS, set_attention
+from version import __VERSION__
 import onnxruntime as ort
-from time import time
+from time import sleep, time
 import hashlib
+import itertools
+import json
+import multiprocessing
+import shutil
+import queue
+import random
 import threading
+import weakref
+import yaml
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
 # Global holder for the currently-running options dict so long-running
 # functions can check for a stop request set by the GUI worker.
@@ -56,9 +79,6 @@ class StopProcessing(Exception):
     pass
 
 
-__VERSION__ = "1.0.1"
-
-
 class Conv_TDF_net_trim_model(nn.Module):
     def __init__(self, device, target_name, L, n_fft, hop=1024):
         super(Conv_TDF_net_trim_model, self).__init__()
@@ -69,28 +89,15 @@ class Conv_TDF_net_trim_model(nn.Module):
         self.hop = hop
         self.n_bins = self.n_fft // 2 + 1
         self.chunk_size = hop * (self.dim_t - 1)
-        self.window = torch.hann_window(window_length=self.n_fft, periodic=True).to(
-            device
-        )
+        self.plan = get_plan(self.n_fft, self.hop)
+        self.window = self.plan.window(torch.float32, device)
         self.target_name = target_name
 
-        out_c = self.dim_c * 4 if target_name == "*" else self.dim_c
-        self.freq_pad = torch.zeros(
-            [1, out_c, self.n_bins - self.dim_f, self.dim_t]
-        ).to(device)
-
         self.n = L // 2
 
     def stft(self, x):
         x = x.reshape([-1, self.chunk_size])
-        x = torch.stft(
-            x,
-            n_fft=self.n_fft,
-            hop_length=self.hop,
-            window=self.window,
-            center=True,
-            return_complex=True,
-        )
+        x = self.plan.stft(x)
         x = torch.view_as_real(x)
         x = x.permute([0, 3, 1, 2])
         x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape(
@@ -99,21 +106,28 @@ class Conv_TDF_net_trim_model(nn.Module):
         return x[:, :, : self.dim_f]
 
     def istft(self, x, freq_pad=None):
-        freq_pad = (
-            self.freq_pad.repeat([x.shape[0], 1, 1, 1])
-            if freq_pad is None
-            else freq_pad
-        )
-        x = torch.cat([x, freq_pad], -2)
-        x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape(
-            [-1, 2, self.n_bins, self.dim_t]
-        )
-        x = x.permute([0, 2, 3, 1])
-        x = x.contiguous()
+        if freq_pad is not None:
+            x = torch.cat([x, freq_pad], -2)
+            x = x.reshape([-1, 2, 2, self.n_bins, self.dim_t]).reshape(
+                [-1, 2, self.n_bins, self.dim_t]
+            )
+            x = x.permute([0, 2, 3, 1])
+            x = x.contiguous()
+        else:
+            # Write real/imag straight into a reused buffer whose upper
+            # frequency bins stay zero, instead of cat + permute + contiguous.
+            spec = self.plan.buffer(
+                "mdx_istft",
+                (x.shape[0] * x.shape[1] // 2, self.n_bins, self.dim_t, 2),
+                x.dtype,
+                x.device,
+            )
+            spec[:, : self.dim_f] = x.reshape([-1, 2, self.dim_f, self.dim_t]).permute(
+                [0, 2, 3, 1]
+            )
+            x = spec
         x = torch.view_as_complex(x)
-        x = torch.istft(
-            x, n_fft=self.n_fft, hop_length=self.hop, window=self.window, center=True
-        )
+        x = self.plan.istft(x)
         return x.reshape([-1, 2, self.chunk_size])
 
     def forward(self, x):
@@ -150,428 +164,1998 @@ def get_models(name, device, load=True, vocals_model_type=0):
     return [model_vocals]
 
 
-def demix_base(mix, device, models, infer_session):
+# Upper bound for the default number of MDX frames per ONNX call
+MDX_DEFAULT_MAX_BATCH = 16
+
+
+def mdx_frame_bytes(model):
+    """Rough working set of one MDX frame going through STFT -> ONNX -> iSTFT.
+
+    Counts the waveform in and out, the network input and output and the
+    padded spectrogram fed to the iSTFT. ONNX Runtime's own activations are
+    not included.
+    """
+    wave = 2 * model.chunk_size * 4
+    spec = model.dim_c * model.n_bins * model.dim_t * 4
+    return 2 * wave + 4 * spec
+
+
+def mdx_batch_size(model, chunk_size, batch_size=None, batch_bytes=None):
+    """Number of MDX frames sent to the ONNX session per call.
+
+    An explicit `batch_size` wins, then a `batch_bytes` budget. Otherwise use
+    the frame count of one `chunk_size` window, capped at
+    `MDX_DEFAULT_MAX_BATCH` so memory does not grow with the track length.
+    """
+    if batch_size:
+        return max(1, int(batch_size))
+    if batch_bytes:
+        return max(1, int(batch_bytes // mdx_frame_bytes(model)))
+    gen_size = model.chunk_size - model.n_fft
+    return max(1, min(-(-chunk_size // gen_size), MDX_DEFAULT_MAX_BATCH))
+
+
+def plan_overlap_add(length, chunk_size, overlap):
+    """Plan the overlapping windows used by `demix_full`.
+
+    Returns `(starts, sizes, step)`: the start offset of every window, the
+    number of valid (non padding) samples in it and the hop between windows.
+    """
+    step = max(1, int(chunk_size * (1 - overlap)))
+    starts = np.arange(0, length, step, dtype=np.int64)
+    sizes = np.minimum(starts + chunk_size, length) - starts
+    return starts, sizes, step
+
+
+def overlap_add_weights(start, size, step, chunk_size, n_windows):
+    """Normalization profile for the samples `[start, start + size)`.
+
+    Every sample is averaged over the windows covering it. That count only
+    depends on the window grid, so it is derived from the plan here instead of
+    being accumulated in a divider array the size of the whole track.
+    """
+    t = np.arange(start, start + size, dtype=np.int64)
+    last = np.minimum(t // step, n_windows - 1)
+    first = np.maximum((t - chunk_size) // step + 1, 0)
+    return (1.0 / (last - first + 1)).astype(np.float32)
+
+
+def plan_mdx_frames(sizes, model):
+    """Flatten the windows of an overlap-add plan into the MDX frames they need.
+
+    Returns an int64 array of shape (n_frames, 2) holding the window index and
+    the frame index inside that window. Frames covering only padding are not
+    planned.
+    """
+    gen_size = model.chunk_size - model.n_fft
+    counts = -(-sizes // gen_size)
+    window = np.repeat(np.arange(len(sizes), dtype=np.int64), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.stack([window, np.arange(len(window), dtype=np.int64) - first], 1)
+
+
+def gather_mdx_frames(mix, starts, sizes, frames, model, out):
+    """Copy the input of `frames` (see `plan_mdx_frames`) into `out`.
+
+    Each window is zero padded by `n_fft // 2` on both sides and at its end,
+    exactly like a standalone `demix_base` call on that window.
+    """
+    for b, (k, j) in enumerate(frames):
+        gather_mdx_frame(mix, starts[k], sizes[k], j, model, out[b])
+    return out[: len(frames)]
+
+
+def gather_mdx_frame(mix, start, size, j, model, out):
+    """Copy the input of frame `j` of the window `[start, start + size)` of
+    `mix` into `out` (channels, chunk_size)."""
+    trim = model.n_fft // 2
+    gen_size = model.chunk_size - 2 * trim
+    lo = j * gen_size - trim
+    a, e = max(lo, 0), min(lo + model.chunk_size, size)
+    out[:, : a - lo] = 0
+    out[:, a - lo : e - lo] = mix[:, start + a : start + e]
+    out[:, e - lo :] = 0
+
+
+def add_mdx_frame(result, wave, starts, sizes, step, chunk_size, k, j, sign):
+    """Overlap-add the trimmed output `wave` of frame `j` of window `k` into
+    `result`, scaled by `overlap_add_weights` and by `sign`."""
+    gen_size = wave.shape[-1]
+    start = int(starts[k]) + j * gen_size
+    n = min(gen_size, int(sizes[k]) - j * gen_size)
+    weights = overlap_add_weights(start, n, step, chunk_size, len(starts))
+    if sign < 0:
+        weights = -weights
+    result[:, start : start + n] += wave[:, :n] * weights
+
+
+def mdx_stft_stage(frames, device, model):
+    """STFT of a (n_frames, 2, chunk_size) array, returned as the ONNX input."""
+    with torch.no_grad():
+        stft_res = model.stft(torch.from_numpy(frames).to(device))
+    return stft_res.cpu().numpy()
+
+
+def mdx_onnx_stage(spec, infer_session):
+    return infer_session.run(None, {"input": spec})[0]
+
+
+def mdx_istft_stage(res, device, model):
+    """iSTFT of the ONNX output, trimmed to (n_frames, 2, gen_size)."""
+    trim = model.n_fft // 2
+    with torch.no_grad():
+        ten = torch.tensor(res).to(device)  # Move result tensor to device
+        tar_waves = model.istft(ten)  # This operation is performed on the GPU
+        tar_waves = tar_waves.cpu()  # Move the result back to CPU once at the end
+    return tar_waves[:, :, trim:-trim].numpy()
+
+
+def run_mdx_frames(frames, device, model, infer_session):
+    """Run STFT -> ONNX -> iSTFT on a (n_frames, 2, chunk_size) float32 array.
+
+    Returns the trimmed outputs as an array of shape (n_frames, 2, gen_size).
+    """
+    spec = mdx_stft_stage(frames, device, model)
+    res = mdx_onnx_stage(spec, infer_session)
+    return mdx_istft_stage(res, device, model)
+
+
+def run_pipeline(items, stages, sink, depth=1, name="Pipeline", names=None):
+    """Run `items` through `stages` with one thread per stage.
+
+    Stages are linked by queues holding at most `depth` results, so stage i
+    works on item n + 1 while stage i + 1 handles item n. Each stage takes the
+    previous stage's output (the item itself for the first one), and
+    `sink(item, value)` receives the last output in the calling thread.
+    Errors and stop requests are propagated to the caller, and the busy share
+    of every stage is printed at the end.
+    """
+    names = names or ["stage {}".format(i) for i in range(len(stages))]
+    queues = [queue.Queue(maxsize=depth) for _ in stages]
+    busy = [0.0] * (len(stages) + 1)
+    errors = []
+    abort = threading.Event()
+    done = object()
+
+    def put(q, value):
+        while not abort.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(q):
+        while not abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return done, None
+
+    def run_stage(i):
+        source = iter(items)
+        try:
+            while True:
+                if i == 0:
+                    if stop_requested():
+                        raise StopProcessing("Stop requested")
+                    item = next(source, done)
+                    value = item
+                else:
+                    item, value = get(queues[i - 1])
+                if item is done:
+                    put(queues[i], (done, None))
+                    return
+                t = time()
+                value = stages[i](value)
+                busy[i] += time() - t
+                if not put(queues[i], (item, value)):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            abort.set()
+
+    start_time = time()
+    threads = [
+        threading.Thread(target=run_stage, args=(i,), daemon=True)
+        for i in range(len(stages))
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item, value = get(queues[-1])
+            if item is done:
+                break
+            t = time()
+            sink(item, value)
+            busy[-1] += time() - t
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        abort.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+    wall = max(time() - start_time, 1e-6)
+    print(
+        "{} {:.2f} sec, busy: {}".format(
+            name,
+            wall,
+            ", ".join(
+                "{} {:.0%}".format(n, b / wall) for n, b in zip(names + ["sink"], busy)
+            ),
+        )
+    )
+
+
+def demix_base(mix, device, models, infer_session, batch_size=None, batch_bytes=None):
     """Demix a short segment using given models and an ONNX session.
 
     This function checks the global `CURRENT_OPTIONS` for a `stop_requested`
     flag and raises `StopProcessing` if set so the GUI can gracefully cancel.
     """
-    global CURRENT_OPTIONS
-    start_time = time()
-    sources = []
-    n_sample = mix.shape[1]
-    for model in models:
-        # Check for stop request between models
-        if stop_requested():
-            raise StopProcessing("Stop requested")
-
-        trim = model.n_fft // 2
-        gen_size = model.chunk_size - 2 * trim
-        pad = gen_size - n_sample % gen_size
-        mix_p = np.concatenate(
-            (np.zeros((2, trim)), mix, np.zeros((2, pad)), np.zeros((2, trim))), 1
+    return demix_full(
+        mix,
+        device,
+        mix.shape[-1],
+        models,
+        infer_session,
+        overlap=0.0,
+        batch_size=batch_size,
+        batch_bytes=batch_bytes,
+    )
+
+
+def mdx_geometry(model):
+    """Settings that must match for two MDX models to share their input STFT."""
+    return (
+        model.n_fft,
+        model.hop,
+        model.dim_c,
+        model.dim_f,
+        model.dim_t,
+        model.chunk_size,
+    )
+
+
+def demix_full(
+    mix,
+    device,
+    chunk_size,
+    models,
+    infer_session,
+    overlap=0.75,
+    batch_size=None,
+    batch_bytes=None,
+    pipeline=False,
+):
+    """Demix a full track with overlapping windows of `chunk_size` samples.
+
+    Returns an array of shape (len(models), 2, length). See
+    `demix_full_multi` for the details and the remaining arguments.
+    """
+    return np.array(
+        demix_full_multi(
+            mix,
+            device,
+            chunk_size,
+            [(model, infer_session, 1) for model in models],
+            overlap=overlap,
+            batch_size=batch_size,
+            batch_bytes=batch_bytes,
+            pipeline=pipeline,
         )
+    )
+
+
+def demix_full_multi(
+    mix,
+    device,
+    chunk_size,
+    heads,
+    overlap=0.75,
+    batch_size=None,
+    batch_bytes=None,
+    pipeline=False,
+):
+    """Demix a full track with several MDX sessions at once.
+
+    `heads` is a list of `(model, infer_session, sign)`. A head runs on
+    `sign * mix` and its output is multiplied by `sign` again, so `sign=-1`
+    gives the polarity flipped estimate `-demix(-mix)`. Heads whose models
+    share the same `mdx_geometry` are fed from a single STFT pass, negated
+    where needed since STFT(-x) = -STFT(x).
+
+    All windows are planned up front and flattened into the MDX frames they
+    need. Frames are streamed through the ONNX sessions in micro-batches (see
+    `mdx_batch_size`) and every output is overlap-added straight into the
+    result, already scaled by `overlap_add_weights`, so peak memory depends on
+    the batch size rather than on the track length.
+
+    With `pipeline`, STFT, ONNX and iSTFT run as overlapping stages (see
+    `run_pipeline`), which keeps up to a few micro-batches in flight.
+
+    Returns one (2, length) array per head.
+    """
+    start_time = time()
+
+    length = mix.shape[-1]
+    starts, sizes, step = plan_overlap_add(length, chunk_size, overlap)
+    # print('Initial shape: {} Chunk size: {} Step: {} Device: {}'.format(mix.shape, chunk_size, step, device))
+
+    results = [np.zeros((mix.shape[0], length), dtype=np.float32) for _ in heads]
+    groups = {}
+    for h, head in enumerate(heads):
+        groups.setdefault(mdx_geometry(head[0]), []).append(h)
+
+    for group in groups.values():
+        model = heads[group[0]][0]
+        plan = plan_mdx_frames(sizes, model)
+        batch = mdx_batch_size(model, chunk_size, batch_size, batch_bytes)
+        buf = np.empty((batch, mix.shape[0], model.chunk_size), dtype=np.float32)
+        batches = [plan[b : b + batch] for b in range(0, len(plan), batch)]
+
+        def stft(frames):
+            # `buf` is consumed by the STFT, so it can be refilled right after
+            return mdx_stft_stage(
+                gather_mdx_frames(mix, starts, sizes, frames, model, buf),
+                device,
+                model,
+            )
+
+        def onnx(spec):
+            outs = []
+            for h in group:
+                _, infer_session, sign = heads[h]
+                outs.append(mdx_onnx_stage(spec if sign > 0 else -spec, infer_session))
+            return outs
+
+        def istft(outs):
+            return [
+                mdx_istft_stage(res, device, heads[h][0]) for h, res in zip(group, outs)
+            ]
+
+        def accumulate(frames, outs):
+            for h, out in zip(group, outs):
+                for wave, (k, j) in zip(out, frames):
+                    add_mdx_frame(
+                        results[h],
+                        wave,
+                        starts,
+                        sizes,
+                        step,
+                        chunk_size,
+                        k,
+                        j,
+                        heads[h][2],
+                    )
+
+        if pipeline:
+            run_pipeline(
+                batches,
+                [stft, onnx, istft],
+                accumulate,
+                name="MDX pipeline",
+                names=["stft", "onnx", "istft"],
+            )
+            continue
 
-        mix_waves = []
-        i = 0
-        while i < n_sample + pad:
-            # Check for stop request while building chunks
+        for frames in batches:
             if stop_requested():
                 raise StopProcessing("Stop requested")
-            waves = np.array(mix_p[:, i : i + model.chunk_size])
-            mix_waves.append(waves)
-            i += gen_size
-        mix_waves = np.array(mix_waves)  # Convert the list to a single numpy.ndarray
-        mix_waves = torch.tensor(mix_waves, dtype=torch.float32).to(device)
+            accumulate(frames, istft(onnx(stft(frames))))
+    # print('Final shape: {} Overall time: {:.2f}'.format(len(results), time() - start_time))
+    return results
 
-        with torch.no_grad():
+
+ONNX_GRAPH_OPTIMIZATION = {
+    "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+ONNX_EXECUTION_MODE = {
+    "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+    "parallel": ort.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def onnx_session_settings(options):
+    """Extract the ONNX Runtime session settings from the user options.
+
+    - `onnx_intra_threads` / `onnx_inter_threads`: thread pool sizes (0 lets
+      ONNX Runtime decide)
+    - `onnx_graph_optimization`: one of `ONNX_GRAPH_OPTIMIZATION`
+    - `onnx_execution_mode`: one of `ONNX_EXECUTION_MODE`
+    - `onnx_cache`: save the optimized graph next to the model on first use
+      and build later sessions from it (see `create_onnx_session`)
+    """
+    settings = {
+        "intra_threads": int(options.get("onnx_intra_threads") or 0),
+        "inter_threads": int(options.get("onnx_inter_threads") or 0),
+        "graph_optimization": options.get("onnx_graph_optimization") or "all",
+        "execution_mode": options.get("onnx_execution_mode") or "sequential",
+        "cache": options.get("onnx_cache", True) is not False,
+    }
+    if settings["graph_optimization"] not in ONNX_GRAPH_OPTIMIZATION:
+        raise ValueError(
+            "Unknown ONNX graph optimization: {}".format(settings["graph_optimization"])
+        )
+    if settings["execution_mode"] not in ONNX_EXECUTION_MODE:
+        raise ValueError(
+            "Unknown ONNX execution mode: {}".format(settings["execution_mode"])
+        )
+    return settings
+
+
+def optimized_model_path(model_path, providers, level):
+    """Where the graph of `model_path` optimized at `level` is cached.
+
+    Optimized graphs may contain provider specific nodes and are not portable
+    across ONNX Runtime versions, so both are part of the file name.
+    """
+    provider = providers[0].replace("ExecutionProvider", "").lower()
+    return "{}.{}.{}.ort{}.onnx".format(
+        os.path.splitext(model_path)[0], provider, level, ort.__version__
+    )
+
+
+def create_onnx_session(model_path, providers, settings):
+    """Create an `ort.InferenceSession` configured by `onnx_session_settings`.
+
+    With caching enabled, the graph optimized up to the "extended" level is
+    written to disk on first use and later sessions are built from it, which
+    skips most of the session construction time. Layout optimizations of the
+    "all" level are hardware specific, so they are never saved and still run
+    when the session is created.
+    """
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = settings["intra_threads"]
+    so.inter_op_num_threads = settings["inter_threads"]
+    so.execution_mode = ONNX_EXECUTION_MODE[settings["execution_mode"]]
+    so.graph_optimization_level = ONNX_GRAPH_OPTIMIZATION[
+        settings["graph_optimization"]
+    ]
+
+    path = model_path
+    level = settings["graph_optimization"]
+    if level == "all":
+        level = "extended"
+    if settings["cache"] and level != "disable":
+        cache_path = optimized_model_path(model_path, providers, level)
+        if not os.path.isfile(cache_path) or os.path.getmtime(
+            cache_path
+        ) < os.path.getmtime(model_path):
+            tmp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+            save_so = ort.SessionOptions()
+            save_so.graph_optimization_level = ONNX_GRAPH_OPTIMIZATION[level]
+            save_so.optimized_model_filepath = tmp_path
+            try:
+                ort.InferenceSession(
+                    model_path,
+                    sess_options=save_so,
+                    providers=providers,
+                    provider_options=[{"device_id": 0}],
+                )
+                os.replace(tmp_path, cache_path)
+                print("Optimized ONNX model saved: {}".format(cache_path))
+            except Exception as e:
+                print("Could not cache optimized ONNX model: {}".format(e))
+                if os.path.isfile(tmp_path):
+                    os.remove(tmp_path)
+        if os.path.isfile(cache_path):
+            path = cache_path
+
+    return ort.InferenceSession(
+        path,
+        sess_options=so,
+        providers=providers,
+        provider_options=[{"device_id": 0}],
+    )
+
+
+class ModelRegistry:
+    """Process-wide cache of loaded models bounded by a host memory budget.
+
+    Entries are kept in least recently used order and evicted oldest first
+    once their total size exceeds the budget. A budget of 0 keeps nothing, so
+    every `get` loads the model again. Evicting an entry only drops the
+    registry reference, callers still holding the model can keep using it.
+    """
+
+    def __init__(self, budget_bytes=0):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # Per key [lock, waiters], loads of different keys run concurrently
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set_budget(self, budget_bytes):
+        with self._lock:
+            self.budget_bytes = budget_bytes
+            self._evict()
+
+    def used_bytes(self):
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def get(self, key, loader, size_func=None):
+        """Return the model cached under `key`, calling `loader()` on a miss.
+        `size_func(model)` gives the bytes charged against the budget.
+
+        The registry is only locked to look up, insert and evict entries.
+        `loader()` runs under a lock of `key` alone, so a slow load does not
+        hold up other keys, and concurrent misses of `key` load it once when
+        it fits the budget.
+        """
+        with self._lock:
+            model = self._lookup(key)
+            if model is not None:
+                return model
+            loading = self._loading.setdefault(key, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            with loading[0]:
+                with self._lock:
+                    # Loaded by another thread while this one waited
+                    model = self._lookup(key)
+                    if model is not None:
+                        return model
+                    self.misses += 1
+                start_time = time()
+                model = loader()
+                size = size_func(model) if size_func is not None else 0
+                print(
+                    "Model loaded: {} {:.1f} MB {:.2f} sec".format(
+                        key, size / 1024 / 1024, time() - start_time
+                    )
+                )
+                with self._lock:
+                    if size <= self.budget_bytes:
+                        self._entries[key] = (model, size)
+                        self._evict()
+                return model
+        finally:
+            with self._lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self._loading[key]
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        used = sum(size for _, size in self._entries.values())
+        while self._entries and used > self.budget_bytes:
+            key, (_, size) = self._entries.popitem(last=False)
+            used -= size
+            print("Model evicted: {} {:.1f} MB".format(key, size / 1024 / 1024))
+
+
+def module_bytes(model):
+    """Host memory held by the parameters and buffers of a torch module."""
+    return sum(t.numel() * t.element_size() for t in model.parameters()) + sum(
+        t.numel() * t.element_size() for t in model.buffers()
+    )
+
+
+MODEL_CACHE_DEFAULT_MB = 2048
+MODEL_REGISTRY = ModelRegistry(MODEL_CACHE_DEFAULT_MB * 1024 * 1024)
+
+
+def apply_model_antipolar(model, audio, shifts=1, overlap=0.25, batched=True):
+    """Average the Demucs estimates of `audio` and of `-audio` (flipped back).
+
+    With `batched`, both polarities are stacked on the batch dimension and
+    separated by a single `apply_model` call. `audio` has shape
+    (1, channels, length); returns a numpy array (sources, channels, length).
+    """
+    if stop_requested():
+        raise StopProcessing("Stop requested")
+    if batched:
+        out = apply_model(
+            model, torch.cat([audio, -audio]), shifts=shifts, overlap=overlap
+        )
+        return (0.5 * (out[0] - out[1])).cpu().numpy()
+    out = (
+        0.5 * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
+    )
+    if stop_requested():
+        raise StopProcessing("Stop requested")
+    out += (
+        0.5
+        * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
+    )
+    return out
+
+
+def architecture_key(model):
+    """Equal for Demucs models built with the same class, arguments and
+    segment, whose parameters have the same shapes. None if unknown."""
+    init = getattr(model, "_init_args_kwargs", None)
+    if init is None:
+        return None
+    return (type(model), repr(init), repr(getattr(model, "segment", None)))
+
+
+def apply_stacked(models, mix, shifts=1, overlap=0.25, vmap=False):
+    """`apply_model` of each of the `models` (same `architecture_key`) on
+    `mix`, with one chunking pass: each segment, with the same random shift
+    and padding for every model, goes through all of them. With `vmap` they
+    run as a single `torch.func.vmap` call over their stacked parameters,
+    else one after the other. Returns a (models, *mix.shape[:-2], sources,
+    channels, length) tensor."""
+    model = models[0]
+    if vmap:
+        params, buffers = torch.func.stack_module_state(models)
+        call = lambda p, b, x: torch.func.functional_call(model, (p, b), (x,))
+        forward = lambda x: torch.func.vmap(call, in_dims=(0, 0, None))(
+            params, buffers, x
+        )
+    else:
+        forward = lambda x: torch.stack([m(x) for m in models])
+    length = mix.shape[-1]
+    max_shift = int(0.5 * model.samplerate)
+    segment_length = int(model.samplerate * model.segment)
+    stride = int((1 - overlap) * segment_length)
+    weight = torch.cat(
+        [
+            torch.arange(1, segment_length // 2 + 1, device=mix.device),
+            torch.arange(
+                segment_length - segment_length // 2, 0, -1, device=mix.device
+            ),
+        ]
+    )
+    weight = weight / weight.max()
+    if shifts:
+        padded_mix = TensorChunk(mix).padded(length + 2 * max_shift)
+    estimates = 0.0
+    for _ in range(max(1, shifts)):
+        if shifts:
+            offset = random.randint(0, max_shift)
+            source = TensorChunk(padded_mix, offset, length + max_shift - offset)
+        else:
+            offset = max_shift
+            source = TensorChunk(mix)
+        shape = (len(models), mix.shape[0], len(model.sources), mix.shape[1])
+        out = torch.zeros(shape + (source.length,), device=mix.device)
+        sum_weight = torch.zeros(source.length, device=mix.device)
+        for start in range(0, source.length, stride):
             if stop_requested():
                 raise StopProcessing("Stop requested")
-            _ort = infer_session
-            stft_res = model.stft(mix_waves)
-            res = _ort.run(None, {"input": stft_res.cpu().numpy()})[0]
-            ten = torch.tensor(res).to(device)  # Move result tensor to device
-            tar_waves = model.istft(ten)  # This operation is performed on the GPU
-            tar_waves = (
-                tar_waves.cpu()
-            )  # Move the result back to CPU only after all computations
-            tar_signal = (
-                tar_waves[:, :, trim:-trim]
-                .transpose(0, 1)
-                .reshape(2, -1)
-                .numpy()[:, :-pad]
-            )
+            chunk = TensorChunk(source, start, segment_length)
+            if hasattr(model, "valid_length"):
+                valid_length = model.valid_length(chunk.length)
+            else:
+                valid_length = chunk.length
+            with torch.no_grad():
+                chunk_out = forward(chunk.padded(valid_length))
+            chunk_out = center_trim(chunk_out, chunk.length)
+            n = chunk_out.shape[-1]
+            out[..., start : start + n] += weight[:n] * chunk_out
+            sum_weight[start : start + n] += weight[:n]
+        estimates += (out / sum_weight)[..., max_shift - offset :]
+    return estimates / max(1, shifts)
+
+
+def apply_stacked_antipolar(
+    models, audio, shifts=1, overlap=0.25, batched=True, vmap=False
+):
+    """`apply_model_antipolar` of each of the `models` through `apply_stacked`,
+    returns one numpy array (sources, channels, length) per model."""
+    if stop_requested():
+        raise StopProcessing("Stop requested")
+    if batched:
+        out = apply_stacked(models, torch.cat([audio, -audio]), shifts, overlap, vmap)
+        return [(0.5 * (o[0] - o[1])).cpu().numpy() for o in out]
+    outs = [
+        0.5 * o[0].cpu().numpy()
+        for o in apply_stacked(models, audio, shifts, overlap, vmap)
+    ]
+    if stop_requested():
+        raise StopProcessing("Stop requested")
+    for out, o in zip(outs, apply_stacked(models, -audio, shifts, overlap, vmap)):
+        out += 0.5 * -o[0].cpu().numpy()
+    return outs
+
+
+class Stage:
+    """A node of the ensemble graph run by `run_graph`.
+
+    `func` is called with the results of `deps`, in order. `threads` and
+    `memory` (bytes) are held from the scheduler budgets while the stage runs
+    and `progress` is the fraction of the file it accounts for.
+    """
+
+    def __init__(self, name, func, deps=(), threads=0, memory=0, progress=0.0):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.threads = threads
+        self.memory = memory
+        self.progress = progress
 
-            sources.append(tar_signal)
-    # print('Time demix base: {:.2f} sec'.format(time() - start_time))
-    return np.array(sources)
 
+def run_graph(stages, threads, memory, callback=None, name="Graph"):
+    """Run `stages` concurrently as soon as their dependencies are done.
 
-def demix_full(mix, device, chunk_size, models, infer_session, overlap=0.75):
+    Ready stages are started in list order while they fit in the `threads`
+    and `memory` left, a stage larger than a budget still runs once nothing
+    else does. `callback(stage)` is called from the caller thread when a stage
+    finishes. The first error is raised after the running stages end, a stop
+    request stops new stages from starting. Returns the results by name.
+    """
+    names = set(stage.name for stage in stages)
+    for stage in stages:
+        for dep in stage.deps:
+            if dep not in names:
+                raise ValueError(
+                    "Stage {} depends on unknown stage {}".format(stage.name, dep)
+                )
+
+    def call(stage, args):
+        start_time = time()
+        result = stage.func(*args)
+        return result, time() - start_time
+
+    results = {}
+    times = {}
+    pending = list(stages)
+    running = {}
+    free_threads = threads
+    free_memory = memory
     start_time = time()
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        try:
+            while pending or running:
+                for stage in list(pending):
+                    if any(dep not in results for dep in stage.deps):
+                        continue
+                    fits = stage.threads <= free_threads and stage.memory <= free_memory
+                    if running and not fits:
+                        continue
+                    if stop_requested():
+                        raise StopProcessing("Stop requested")
+                    pending.remove(stage)
+                    free_threads -= stage.threads
+                    free_memory -= stage.memory
+                    args = [results[dep] for dep in stage.deps]
+                    running[executor.submit(call, stage, args)] = stage
+                if not running:
+                    raise ValueError(
+                        "Stage graph has a cycle: {}".format(
+                            ", ".join(stage.name for stage in pending)
+                        )
+                    )
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    free_threads += stage.threads
+                    free_memory += stage.memory
+                    results[stage.name], times[stage.name] = future.result()
+                    if callback is not None:
+                        callback(stage)
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+    print(
+        "{} {:.2f} sec, stages: {}".format(
+            name,
+            time() - start_time,
+            ", ".join(
+                "{} {:.2f}".format(stage.name, times[stage.name]) for stage in stages
+            ),
+        )
+    )
+    return results
 
-    step = int(chunk_size * (1 - overlap))
-    # print('Initial shape: {} Chunk size: {} Step: {} Device: {}'.format(mix.shape, chunk_size, step, device))
-    result = np.zeros((1, 2, mix.shape[-1]), dtype=np.float32)
-    divider = np.zeros((1, 2, mix.shape[-1]), dtype=np.float32)
-
-    total = 0
-    for i in range(0, mix.shape[-1], step):
-        total += 1
-
-        start = i
-        end = min(i + chunk_size, mix.shape[-1])
-        # print('Chunk: {} Start: {} End: {}'.format(total, start, end))
-        mix_part = mix[:, start:end]
-        sources = demix_base(mix_part, device, models, infer_session)
-        # print(sources.shape)
-        result[..., start:end] += sources
-        divider[..., start:end] += 1
-    sources = result / divider
-    # print('Final shape: {} Overall time: {:.2f}'.format(sources.shape, time() - start_time))
-    return sources
 
+def prune_graph(stages, targets):
+    """The stages needed to compute the `targets` stage names, in order."""
+    by_name = {stage.name: stage for stage in stages}
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(by_name[name].deps)
+    return [stage for stage in stages if stage.name in needed]
 
-class EnsembleDemucsMDXMusicSeparationModel:
-    def __init__(self, options):
-        """
-        options - user options
-        """
-        # print(options)
 
-        if torch.cuda.is_available():
-            device = "cuda:0"
-        else:
-            device = "cpu"
-        if "cpu" in options:
-            if options["cpu"]:
-                device = "cpu"
-        print("Use device: {}".format(device))
-        self.single_onnx = False
-        if "single_onnx" in options:
-            if options["single_onnx"]:
-                self.single_onnx = True
-                print("Use single vocal ONNX")
+MEMINFO = "/proc/meminfo"
 
-        self.kim_model_1 = False
-        if "use_kim_model_1" in options:
-            if options["use_kim_model_1"]:
-                self.kim_model_1 = True
-        if self.kim_model_1:
-            print("Use Kim model 1")
-        else:
-            print("Use Kim model 2")
 
-        self.overlap_large = float(options["overlap_large"])
-        self.overlap_small = float(options["overlap_small"])
-        if self.overlap_large > 0.99:
-            self.overlap_large = 0.99
-        if self.overlap_large < 0.0:
-            self.overlap_large = 0.0
-        if self.overlap_small > 0.99:
-            self.overlap_small = 0.99
-        if self.overlap_small < 0.0:
-            self.overlap_small = 0.0
+def available_memory(device):
+    """Bytes that can still be allocated on `device`.
 
-        model_folder = os.path.dirname(os.path.realpath(__file__)) + "/models/"
-        remote_url = "https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th"
-        model_path = model_folder + "04573f0d-f3cf25b2.th"
-        if not os.path.isfile(model_path):
-            torch.hub.download_url_to_file(
-                remote_url, model_folder + "04573f0d-f3cf25b2.th"
+    On the host this is MemAvailable of /proc/meminfo, which counts the page
+    cache the kernel can reclaim, sysconf free pages where it is missing.
+    """
+    if str(device).startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info(device)
+        return (
+            free
+            + torch.cuda.memory_reserved(device)
+            - torch.cuda.memory_allocated(device)
+        )
+    try:
+        with open(MEMINFO) as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return 8 * 1024 * 1024 * 1024
+
+
+MODEL_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/models/"
+MODEL_URLS = {
+    "04573f0d-f3cf25b2.th": "https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th",
+    "Kim_Vocal_1.onnx": "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_1.onnx",
+    "Kim_Vocal_2.onnx": "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_2.onnx",
+    "Kim_Inst.onnx": "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Inst.onnx",
+}
+
+
+def model_file(file_name):
+    """Path of `file_name` in the models folder, downloaded on first use."""
+    path = MODEL_FOLDER + file_name
+    if not os.path.isfile(path):
+        torch.hub.download_url_to_file(MODEL_URLS[file_name], path)
+    return path
+
+
+DEMUCS_VOCALS_MODEL = "04573f0d"
+DEMUCS_INSTRUM_MODELS = ["htdemucs_ft", "htdemucs", "htdemucs_6s", "hdemucs_mmi"]
+# Outputs that can be requested, instrum is the mix without the vocals
+STEMS = ["vocals", "instrum", "drums", "bass", "other"]
+INSTRUMENT_STEMS = ["drums", "bass", "other"]
+
+
+def flat_model_file(sig):
+    """Memory mapped copy of the Demucs checkpoint `sig` in the models folder,
+    made by `convert_demucs_models`. None if it was not converted."""
+    path = MODEL_FOLDER + sig + ".flat"
+    return path if os.path.isfile(path) else None
+
+
+def pretrained_bag(name):
+    """Checkpoint signatures, weights and segment of the pretrained Demucs `name`."""
+    with open(os.path.join(pretrained.REMOTE_ROOT, name + ".yaml")) as f:
+        return yaml.safe_load(f)
+
+
+def load_pretrained(name):
+    """`pretrained.get_model(name)`, from the memory mapped copies of its
+    checkpoints when they were all converted."""
+    bag = pretrained_bag(name)
+    paths = [flat_model_file(sig) for sig in bag["models"]]
+    if not all(paths):
+        return pretrained.get_model(name)
+    models = [load_flat_model(path) for path in paths]
+    model = BagOfModels(models, bag.get("weights"), bag.get("segment"))
+    model.eval()
+    return model
+
+
+def convert_demucs_models(names):
+    """Save the checkpoints of the pretrained Demucs models `names` as memory
+    mapped files in the models folder, used from then on by `load_pretrained`
+    and the ensemble. Returns the signatures converted."""
+    urls = pretrained._parse_remote_files(pretrained.REMOTE_ROOT / "files.txt")
+    converted = []
+    for name in names:
+        if name == DEMUCS_VOCALS_MODEL:
+            signatures = [name]
+        else:
+            signatures = pretrained_bag(name)["models"]
+        for sig in signatures:
+            if sig in converted or flat_model_file(sig):
+                continue
+            if sig == DEMUCS_VOCALS_MODEL:
+                package = model_file("04573f0d-f3cf25b2.th")
+            else:
+                package = torch.hub.load_state_dict_from_url(
+                    urls[sig], map_location="cpu", check_hash=True, weights_only=False
+                )
+            print("Convert Demucs checkpoint {}".format(sig))
+            save_flat_model(package, MODEL_FOLDER + sig + ".flat")
+            converted.append(sig)
+    return converted
+
+
+def demucs_signatures(name):
+    """Checkpoint signatures of the Demucs model `name`, one per bag member."""
+    if name == DEMUCS_VOCALS_MODEL:
+        return [name]
+    return pretrained_bag(name)["models"]
+
+
+def demucs_members(name, sources=None):
+    """Bag members of the Demucs model `name` with a non zero weight on one of
+    `sources` (source indices), the others can be skipped. All the members if
+    `sources` is None."""
+    bag = {"models": [name]} if name == DEMUCS_VOCALS_MODEL else pretrained_bag(name)
+    members = list(range(len(bag["models"])))
+    if sources is None:
+        return members
+    weights = bag.get("weights")
+    if weights is None:
+        return members if sources else []
+    return [k for k in members if any(weights[k][j] != 0 for j in sources)]
+
+
+def same_weights(a, b):
+    """True if the modules `a` and `b` hold equal parameters and buffers."""
+    state_a = a.state_dict()
+    state_b = b.state_dict()
+    if state_a.keys() != state_b.keys():
+        return False
+    for key, value in state_a.items():
+        other = state_b[key]
+        if value.shape != other.shape or value.dtype != other.dtype:
+            return False
+        if not torch.equal(value, other.to(value.device)):
+            return False
+    return True
+
+
+# Demucs checkpoints loaded through MODEL_REGISTRY, by signature, so that a
+# checkpoint in several models is held once (see `share_checkpoints`)
+SHARED_CHECKPOINTS = weakref.WeakValueDictionary()
+SHARED_CHECKPOINTS_LOCK = threading.Lock()
+
+
+def share_checkpoints(name, model, shared):
+    """Replace the members of the Demucs model `name` already loaded for
+    another model by that copy, keyed by checkpoint signature in the mapping
+    `shared`. The htdemucs_ft vocals member is the Demucs vocals model.
+    Models sharing a checkpoint must be moved between devices together, so
+    resident and cached models use different mappings. Returns `model`."""
+    signatures = demucs_signatures(name)
+    bag = isinstance(model, BagOfModels)
+    members = list(model.models) if bag else [model]
+    if len(members) != len(signatures):
+        return model
+    with SHARED_CHECKPOINTS_LOCK:
+        for k, (sig, member) in enumerate(zip(signatures, members)):
+            other = shared.get(sig)
+            if other is None:
+                shared[sig] = member
+                continue
+            if (
+                other is member
+                or type(other) is not type(member)
+                or getattr(other, "segment", None) != getattr(member, "segment", None)
+                or not same_weights(member, other)
+            ):
+                continue
+            print("Share Demucs checkpoint {} of {}".format(sig, name))
+            if bag:
+                model.models[k] = other
+            else:
+                model = other
+    return model
+
+
+def parse_stems(options):
+    """Requested outputs from `stems` (a list or a comma separated string),
+    `only_vocals` stands for vocals and instrum. Defaults to all of them."""
+    stems = options.get("stems")
+    if not stems:
+        if options.get("only_vocals") is True:
+            return ["vocals", "instrum"]
+        return list(STEMS)
+    if isinstance(stems, str):
+        stems = stems.split(",")
+    stems = [stem.strip() for stem in stems]
+    for stem in stems:
+        if stem not in STEMS:
+            raise ValueError(
+                "Unknown stem: {}. Expected some of: {}".format(stem, ", ".join(STEMS))
             )
-        model_vocals = load_model(model_path)
-        model_vocals.to(device)
-        self.model_vocals_only = model_vocals
-
-        self.models = []
-        self.weights_vocals = np.array([10, 1, 8, 9])
-        self.weights_bass = np.array([19, 4, 5, 8])
-        self.weights_drums = np.array([18, 2, 4, 9])
-        self.weights_other = np.array([14, 2, 5, 10])
-
-        model1 = pretrained.get_model("htdemucs_ft")
-        model1.to(device)
-        self.models.append(model1)
-
-        model2 = pretrained.get_model("htdemucs")
-        model2.to(device)
-        self.models.append(model2)
-
-        model3 = pretrained.get_model("htdemucs_6s")
-        model3.to(device)
-        self.models.append(model3)
-
-        model4 = pretrained.get_model("hdemucs_mmi")
-        model4.to(device)
-        self.models.append(model4)
-
-        if 0:
-            for model in self.models:
-                print(model.sources)
-        """
-        ['drums', 'bass', 'other', 'vocals']
-        ['drums', 'bass', 'other', 'vocals']
-        ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
-        ['drums', 'bass', 'other', 'vocals']
-        """
+    return [stem for stem in STEMS if stem in stems]
 
-        if device == "cpu":
-            chunk_size = 200000000
-            providers = ["CPUExecutionProvider"]
-        else:
-            chunk_size = 1000000
-            providers = ["CUDAExecutionProvider"]
-        if "chunk_size" in options:
-            chunk_size = int(options["chunk_size"])
 
-        # MDX-B model 1 initialization
-        self.chunk_size = chunk_size
-        self.mdx_models1 = get_models(
-            "tdf_extra", load=False, device=device, vocals_model_type=2
+def needs_instruments(stems):
+    """Whether `stems` need the instrument stage of the ensemble."""
+    return any(stem in INSTRUMENT_STEMS for stem in stems)
+
+
+# float32 weights of the Demucs models, used by the planner before loading
+DEMUCS_MODEL_BYTES = {
+    "04573f0d": 168 * 1024 * 1024,
+    "htdemucs_ft": 672 * 1024 * 1024,
+    "htdemucs": 168 * 1024 * 1024,
+    "htdemucs_6s": 110 * 1024 * 1024,
+    "hdemucs_mmi": 335 * 1024 * 1024,
+}
+# Rough peak of one apply_model call per batch item, besides its outputs
+DEMUCS_ACTIVATION_BYTES = 512 * 1024 * 1024
+# Most segments per Demucs call when batching across files
+DEMUCS_MAX_BATCH = 8
+# Size of an ONNX model that was not downloaded yet
+ONNX_MODEL_BYTES = 70 * 1024 * 1024
+
+
+class MemoryPlan:
+    """How an ensemble uses memory, see `plan_memory`.
+
+    `model_bytes` has the weights of every model by name, `resident` the
+    models kept loaded between files and `stage_bytes` what each stage of
+    `ensemble_graph` holds while it runs, besides its outputs.
+    """
+
+    def __init__(self, budget, device):
+        self.budget = budget
+        self.device = device
+        self.model_bytes = {}
+        self.resident = []
+        self.chunk_size = None
+        self.mdx_batch_size = None
+        self.antipolar_batch = True
+        self.demucs_batch_size = 1
+        self.stage_bytes = {}
+        self.graph_memory = None
+
+    def stage_memory(self, stage):
+        """Planned bytes of `stage`. Stages of models left out of the plan
+        count their weights and the largest polarity batch."""
+        if stage in self.stage_bytes:
+            return self.stage_bytes[stage]
+        return DEMUCS_MODEL_BYTES[stage] + 2 * DEMUCS_ACTIVATION_BYTES
+
+    def report(self):
+        mb = 1024 * 1024
+        print(
+            "Memory plan: budget {:.0f} MB on {}".format(self.budget / mb, self.device)
         )
-        if self.kim_model_1:
-            model_path_onnx1 = model_folder + "Kim_Vocal_1.onnx"
-            remote_url_onnx1 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_1.onnx"
-        else:
-            model_path_onnx1 = model_folder + "Kim_Vocal_2.onnx"
-            remote_url_onnx1 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_2.onnx"
-        if not os.path.isfile(model_path_onnx1):
-            torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
-        print("Model path: {}".format(model_path_onnx1))
-        print("Device: {} Chunk size: {}".format(device, chunk_size))
-        self.infer_session1 = ort.InferenceSession(
-            model_path_onnx1,
-            providers=providers,
-            provider_options=[{"device_id": 0}],
+        print(
+            "  Resident models: {}".format(
+                ", ".join(
+                    "{} {:.0f} MB".format(name, self.model_bytes[name] / mb)
+                    for name in self.resident
+                )
+                or "none"
+            )
         )
-
-        if self.single_onnx is False:
-            # MDX-B model 2  initialization
-            self.chunk_size = chunk_size
-            self.mdx_models2 = get_models(
-                "tdf_extra", load=False, device=device, vocals_model_type=2
+        print(
+            "  Loaded per file: {}".format(
+                ", ".join(
+                    "{} {:.0f} MB".format(name, size / mb)
+                    for name, size in self.model_bytes.items()
+                    if name not in self.resident
+                )
+                or "none"
             )
-            root_path = os.path.dirname(os.path.realpath(__file__)) + "/"
-            model_path_onnx2 = model_folder + "Kim_Inst.onnx"
-            remote_url_onnx2 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Inst.onnx"
-            if not os.path.isfile(model_path_onnx2):
-                torch.hub.download_url_to_file(remote_url_onnx2, model_path_onnx2)
-            print("Model path: {}".format(model_path_onnx2))
-            print("Device: {} Chunk size: {}".format(device, chunk_size))
-            self.infer_session2 = ort.InferenceSession(
-                model_path_onnx2,
-                providers=providers,
-                provider_options=[{"device_id": 0}],
+        )
+        print(
+            "  MDX chunk size: {} batch: {} Demucs polarity batch: {}".format(
+                self.chunk_size, self.mdx_batch_size, 2 if self.antipolar_batch else 1
+            )
+        )
+        print(
+            "  Demucs segments per call across files: {}".format(self.demucs_batch_size)
+        )
+        print(
+            "  Largest stage: {:.0f} MB Concurrent stages: {:.0f} MB".format(
+                max(self.stage_bytes.values()) / mb, self.graph_memory / mb
             )
+        )
 
-        self.device = device
-        pass
 
-    @property
-    def instruments(self):
-        """DO NOT CHANGE"""
-        return ["bass", "drums", "other", "vocals"]
+def plan_memory(ensemble, options, resident=None):
+    """Fit `ensemble` into a memory budget.
 
-    def raise_aicrowd_error(self, msg):
-        """Will be used by the evaluator to provide logs, DO NOT CHANGE"""
-        raise NameError(msg)
+    The budget is `memory_budget_mb` or the free memory of the device. The
+    MDX batch and the Demucs polarity batch are reduced first, so that one
+    stage needs at most half the budget, the Demucs batch of
+    `separate_continuous` is sized the same way. Then models are kept resident in
+    ensemble order while they fit next to the largest stage. An explicit
+    `resident` list of model names skips that choice. Options set by the user
+    (`chunk_size`, `mdx_batch_size`, `mdx_batch_mb`, `demucs_batch_size`,
+    `ensemble_memory_mb`)
+    are kept as they are.
+    """
+    device = ensemble.device
+    on_gpu = str(device).startswith("cuda")
+    if options.get("memory_budget_mb"):
+        budget = int(float(options["memory_budget_mb"]) * 1024 * 1024)
+    else:
+        budget = available_memory(device)
+    plan = MemoryPlan(budget, device)
+    gb = 1024 * 1024 * 1024
+
+    if options.get("chunk_size"):
+        plan.chunk_size = int(options["chunk_size"])
+    elif not on_gpu:
+        plan.chunk_size = 200000000
+    elif budget >= 8 * gb:
+        plan.chunk_size = 1000000
+    elif budget >= 4 * gb:
+        plan.chunk_size = 500000
+    else:
+        plan.chunk_size = 200000
+
+    # Frames, spectrogram in and out and the iSTFT output of one batch
+    mdx_model = ensemble.mdx_models1[0]
+    frame_bytes = 4 * mdx_frame_bytes(mdx_model)
+    plan.mdx_batch_size = mdx_batch_size(
+        mdx_model, plan.chunk_size, ensemble.mdx_batch_size, ensemble.mdx_batch_bytes
+    )
+    if not ensemble.mdx_batch_size and not ensemble.mdx_batch_bytes:
+        plan.mdx_batch_size = max(
+            1, min(plan.mdx_batch_size, budget // 8 // frame_bytes)
+        )
 
-    def separate_music_file(
-        self,
-        mixed_sound_array,
-        sample_rate,
-        update_percent_func=None,
-        current_file_number=0,
-        total_files=0,
-        only_vocals=False,
+    for name in ensemble.model_names():
+        if name in DEMUCS_MODEL_BYTES:
+            plan.model_bytes[name] = DEMUCS_MODEL_BYTES[name]
+        elif os.path.isfile(MODEL_FOLDER + name):
+            plan.model_bytes[name] = os.path.getsize(MODEL_FOLDER + name)
+        else:
+            plan.model_bytes[name] = ONNX_MODEL_BYTES
+    onnx_names = [name for name in ensemble.model_names() if name.endswith(".onnx")]
+    demucs_names = [
+        name for name in ensemble.model_names() if name in DEMUCS_MODEL_BYTES
+    ]
+    largest_demucs = max(plan.model_bytes[name] for name in demucs_names)
+    plan.antipolar_batch = ensemble.antipolar_batch
+    if (
+        plan.antipolar_batch
+        and 2 * DEMUCS_ACTIVATION_BYTES + largest_demucs > budget // 2
     ):
-        """
-        Implements the sound separation for a single sound file
-        Inputs: Outputs from soundfile.read('mixture.wav')
-            mixed_sound_array
-            sample_rate
+        plan.antipolar_batch = False
+    activation = DEMUCS_ACTIVATION_BYTES * (2 if plan.antipolar_batch else 1)
+    # Segments of both polarities per call of `separate_continuous`
+    if options.get("demucs_batch_size"):
+        plan.demucs_batch_size = int(options["demucs_batch_size"])
+    else:
+        plan.demucs_batch_size = max(
+            1,
+            min(
+                DEMUCS_MAX_BATCH,
+                (budget // 2 - largest_demucs) // (2 * DEMUCS_ACTIVATION_BYTES),
+            ),
+        )
 
-        Outputs:
-            separated_music_arrays: Dictionary numpy array of each separated instrument
-            output_sample_rates: Dictionary of sample rates separated sequence
-        """
+    def stage_bytes(resident):
+        sizes = {}
+        for name in demucs_names:
+            stage = "demucs_vocals" if name == DEMUCS_VOCALS_MODEL else name
+            sizes[stage] = activation
+            if name not in resident:
+                sizes[stage] += plan.model_bytes[name]
+        sizes["mdx"] = len(onnx_names) * frame_bytes * plan.mdx_batch_size
+        for name in onnx_names:
+            if name not in resident:
+                sizes["mdx"] += plan.model_bytes[name]
+        return sizes
+
+    if resident is not None:
+        plan.resident = list(resident)
+    else:
+        room = budget - max(stage_bytes([]).values())
+        for name in ensemble.model_names():
+            if plan.model_bytes[name] <= room:
+                plan.resident.append(name)
+                room -= plan.model_bytes[name]
+    plan.stage_bytes = stage_bytes(plan.resident)
+
+    if options.get("ensemble_memory_mb"):
+        plan.graph_memory = int(float(options["ensemble_memory_mb"]) * 1024 * 1024)
+    else:
+        plan.graph_memory = budget - sum(
+            plan.model_bytes[name] for name in plan.resident
+        )
+    return plan
 
-        # print('Update percent func: {}'.format(update_percent_func))
 
-        separated_music_arrays = {}
-        output_sample_rates = {}
+# Part of every cache key, bump when model outputs change for the same input
+CACHE_VERSION = 1
+CACHE_DEFAULT_MB = 8192
 
-        audio = np.expand_dims(mixed_sound_array.T, axis=0)
-        audio = torch.from_numpy(audio).type("torch.FloatTensor").to(self.device)
 
-        overlap_large = self.overlap_large
-        overlap_small = self.overlap_small
+def audio_hash(array):
+    """Digest of the decoded samples of `array` along with shape and dtype."""
+    array = np.ascontiguousarray(array)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(repr((array.shape, array.dtype.str)).encode())
+    h.update(memoryview(array).cast("B"))
+    return h.hexdigest()
 
-        # Get Demics vocal only
-        model = self.model_vocals_only
-        shifts = 1
-        overlap = overlap_large
-        if stop_requested():
-            raise StopProcessing("Stop requested")
-        vocals_demucs = (
-            0.5
-            * apply_model(model, audio, shifts=shifts, overlap=overlap)[0][3]
-            .cpu()
-            .numpy()
-        )
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.10) / total_files
-            update_percent_func(int(val))
+class StemCache:
+    """Content addressed on-disk cache of intermediate model outputs.
 
-        if stop_requested():
-            raise StopProcessing("Stop requested")
-        vocals_demucs += (
-            0.5
-            * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0][3]
-            .cpu()
-            .numpy()
-        )
+    Entries are float32 `.npy` files named by the digest of their key. Reads
+    refresh the modification time, and once the folder grows past `max_bytes`
+    the least recently used entries are removed.
+    """
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.20) / total_files
-            update_percent_func(int(val))
+    def __init__(self, folder, max_bytes):
+        os.makedirs(folder, exist_ok=True)
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.evict()
 
-        overlap = overlap_large
-        sources1 = demix_full(
-            mixed_sound_array.T,
-            self.device,
-            self.chunk_size,
-            self.mdx_models1,
-            self.infer_session1,
-            overlap=overlap,
-        )[0]
+    def key(self, *parts):
+        parts = parts + (CACHE_VERSION, __VERSION__)
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
 
-        vocals_mdxb1 = sources1
+    def path(self, key):
+        return os.path.join(self.folder, key + ".npy")
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.30) / total_files
+    def get(self, key):
+        path = self.path(key)
+        try:
+            array = np.load(path, allow_pickle=False)
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            return None
+        return array
+
+    def put(self, key, array):
+        path = self.path(key)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_path, "wb") as f:
+                np.save(f, np.ascontiguousarray(array, dtype=np.float32))
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print("Could not write cache entry {}: {}".format(path, e))
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def cached(self, key, compute):
+        """Cached array for `key`, `compute()` and store it on a miss."""
+        array = self.get(key)
+        if array is None:
+            array = compute()
+            self.put(key, array)
+        return array
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.folder):
+                if entry.name.endswith(".npy"):
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+
+class CacheGroup:
+    """Several `StemCache` used as one. Reads come from the first cache with
+    the entry, writes go to all of them."""
+
+    def __init__(self, caches):
+        self.caches = caches
+
+    def key(self, *parts):
+        return self.caches[0].key(*parts)
+
+    def get(self, key):
+        for cache in self.caches:
+            array = cache.get(key)
+            if array is not None:
+                return array
+        return None
+
+    def put(self, key, array):
+        for cache in self.caches:
+            cache.put(key, array)
+
+    cached = StemCache.cached
+
+
+def ensemble_weights(options, name, default):
+    """Weights `name` from the options (a list or a comma separated string),
+    with as many values as `default`."""
+    weights = options.get(name)
+    if weights is None:
+        return np.array(default)
+    if isinstance(weights, str):
+        weights = weights.split(",")
+    weights = np.array([float(w) for w in weights])
+    if len(weights) != len(default) or weights.sum() <= 0:
+        raise ValueError(
+            "{} needs {} weights with a positive sum, got: {}".format(
+                name, len(default), list(weights)
+            )
+        )
+    return weights
+
+
+def stem_cache(options):
+    """`StemCache` in `cache_dir` bounded by `cache_mb`, None if not set."""
+    if not options.get("cache_dir"):
+        return None
+    cache_mb = options.get("cache_mb")
+    if cache_mb is None:
+        cache_mb = CACHE_DEFAULT_MB
+    return StemCache(options["cache_dir"], int(float(cache_mb) * 1024 * 1024))
+
+
+def join_vocals(ensemble, mixed_sound_array, vocals_demucs, sources):
+    """Weighted vocals of the Demucs vocals model and the MDX `sources`."""
+    vocals_mdxb1 = sources[0]
+    # Ensemble vocals for MDX and Demucs
+    if ensemble.single_onnx is False:
+        # it's instrumental so need to invert
+        instrum_mdxb2 = sources[1]
+        vocals_mdxb2 = mixed_sound_array.T - instrum_mdxb2
+        weights = ensemble.vocals_ensemble_weights
+        return (
+            weights[0] * vocals_mdxb1.T
+            + weights[1] * vocals_mdxb2.T
+            + weights[2] * vocals_demucs.T
+        ) / weights.sum()
+    weights = ensemble.vocals_ensemble_weights
+    return (weights[0] * vocals_mdxb1.T + weights[1] * vocals_demucs.T) / weights.sum()
+
+
+def weight_instrum_output(ensemble, i, out):
+    """Output of instrument model `i` as drums, bass, other and vocals, each
+    scaled by its ensemble weight."""
+    if i == 2:
+        # ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
+        out[2] = out[2] + out[4] + out[5]
+        out = out[:4]
+    out[0] = ensemble.weights_drums[i] * out[0]
+    out[1] = ensemble.weights_bass[i] * out[1]
+    out[2] = ensemble.weights_other[i] * out[2]
+    out[3] = ensemble.weights_vocals[i] * out[3]
+    return out
+
+
+def join_instruments(ensemble, mixed_sound_array, vocals, all_outs):
+    """Drums, bass and other from the weighted outputs of the instrument
+    models (see `weight_instrum_output`)."""
+    out = np.array(all_outs).sum(axis=0)
+    out[0] = out[0] / ensemble.weights_drums.sum()
+    out[1] = out[1] / ensemble.weights_bass.sum()
+    out[2] = out[2] / ensemble.weights_other.sum()
+    out[3] = out[3] / ensemble.weights_vocals.sum()
+
+    # other
+    res = mixed_sound_array - vocals - out[0].T - out[1].T
+    res = np.clip(res, -1, 1)
+    other = (2 * res + out[2].T) / 3.0
+
+    # drums
+    res = mixed_sound_array - vocals - out[1].T - out[2].T
+    res = np.clip(res, -1, 1)
+    drums = (res + 2 * out[0].T.copy()) / 3.0
+
+    # bass
+    res = mixed_sound_array - vocals - out[0].T - out[2].T
+    res = np.clip(res, -1, 1)
+    bass = (res + 2 * out[1].T) / 3.0
+
+    return {
+        "other": mixed_sound_array - vocals - bass - drums,
+        "drums": mixed_sound_array - vocals - bass - other,
+        "bass": mixed_sound_array - vocals - drums - other,
+    }
+
+
+def split_threads(threads, torch_threads=0, onnx_threads=0):
+    """Torch and ONNX Runtime intra-op threads sharing `threads`, so that the
+    Demucs and MDX stages run at the same time. A count that is not set gets
+    the rest of the budget, half of it if neither is set."""
+    if not torch_threads and not onnx_threads:
+        torch_threads = max(1, (threads + 1) // 2)
+    if not torch_threads:
+        torch_threads = max(1, threads - onnx_threads)
+    if not onnx_threads:
+        onnx_threads = max(1, threads - torch_threads)
+    return torch_threads, onnx_threads
+
+
+def ensemble_graph(ensemble, mixed_sound_array, stems=STEMS, cache=None):
+    """Stages separating `mixed_sound_array` (length, channels) with `ensemble`.
+
+    The Demucs vocals model and the MDX models are independent and join into
+    the vocals, the four Demucs models then run on the instrumental and join
+    into drums, bass and other. Every stem depends on the vocals, the graph is
+    pruned to the vocals alone unless `stems` has drums, bass or other.
+
+    With a `cache` (see `StemCache`), each model output is stored under the
+    hash of its input, so only changed branches and the joins run again.
+    """
+    device = ensemble.device
+    length = mixed_sound_array.shape[0]
+    # On GPU a stage only needs the thread feeding the device
+    if str(device).startswith("cuda"):
+        demucs_threads = 1
+        mdx_threads = 1
+    else:
+        # Applied by the ensemble, see `split_threads`
+        demucs_threads = torch.get_num_threads()
+        mdx_threads = ensemble.onnx_settings["intra_threads"]
+    # Planned stage memory plus the outputs, both polarities of up to 6
+    # sources and the overlap-add sums for Demucs
+    plan = ensemble.plan
+    demucs_outputs = 2 * 6 * 2 * length * 4 * 2
+    mdx_outputs = len(ensemble.onnx_names()) * 2 * 2 * length * 4
+    mix_hash = audio_hash(mixed_sound_array) if cache is not None else None
+
+    def demucs_key(name, input_hash, members=None):
+        parts = [input_hash, name, ensemble.demucs_overlap(name), 1]
+        if members is not None:
+            # Sources of the skipped bag members are zeros
+            parts.append(tuple(members))
+        return cache.key(*parts)
+
+    def demucs_vocals():
+        def compute():
+            audio = np.expand_dims(mixed_sound_array.T, axis=0)
+            audio = torch.from_numpy(audio).type("torch.FloatTensor").to(device)
+            return ensemble.demucs_vocals(audio)
+
+        if cache is None:
+            return compute()
+        return cache.cached(demucs_key(DEMUCS_VOCALS_MODEL, mix_hash), compute)
+
+    def mdx():
+        names = ensemble.onnx_names()
+        sources = [None] * len(names)
+        if cache is not None:
+            keys = [
+                cache.key(mix_hash, name, ensemble.overlap_large, ensemble.chunk_size)
+                for name in names
+            ]
+            sources = [cache.get(key) for key in keys]
+        missing = [name for name, out in zip(names, sources) if out is None]
+        if missing:
+            # Both MDX models share one STFT pass, Kim_Inst runs on the inverted mix
+            outs = demix_full_multi(
+                mixed_sound_array.T,
+                device,
+                ensemble.chunk_size,
+                ensemble.mdx_heads(missing),
+                overlap=ensemble.overlap_large,
+                batch_size=ensemble.mdx_batch_size,
+                batch_bytes=ensemble.mdx_batch_bytes,
+                pipeline=ensemble.mdx_pipeline,
+            )
+            for name, out in zip(missing, outs):
+                i = names.index(name)
+                sources[i] = out
+                if cache is not None:
+                    cache.put(keys[i], out)
+        return sources
+
+    def vocals(vocals_demucs, sources):
+        return join_vocals(ensemble, mixed_sound_array, vocals_demucs, sources)
+
+    stages = [
+        Stage(
+            "demucs_vocals",
+            demucs_vocals,
+            threads=demucs_threads,
+            memory=plan.stage_memory("demucs_vocals") + demucs_outputs,
+            progress=0.20,
+        ),
+        Stage(
+            "mdx",
+            mdx,
+            threads=mdx_threads,
+            memory=plan.stage_memory("mdx") + mdx_outputs,
+            progress=0.20,
+        ),
+        Stage("vocals", vocals, deps=("demucs_vocals", "mdx")),
+    ]
+
+    def instrum_audio(vocals):
+        # Generate instrumental
+        instrum = mixed_sound_array - vocals
+        audio = np.expand_dims(instrum.T, axis=0)
+        instrum_hash = audio_hash(audio) if cache is not None else None
+        audio = torch.from_numpy(audio).type("torch.FloatTensor").to(device)
+        return audio, instrum_hash
+
+    def demucs_instrum(i, instrum):
+        audio, instrum_hash = instrum
+        if cache is None:
+            out = ensemble.demucs_instrum(i, audio)
+        else:
+            out = cache.cached(
+                demucs_key(
+                    DEMUCS_INSTRUM_MODELS[i], instrum_hash, ensemble.instrum_members(i)
+                ),
+                lambda: ensemble.demucs_instrum(i, audio),
+            )
+        return weight_instrum_output(ensemble, i, out)
+
+    def instruments(vocals, *all_outs):
+        return join_instruments(ensemble, mixed_sound_array, vocals, all_outs)
+
+    stages.append(Stage("instrum_audio", instrum_audio, deps=("vocals",)))
+    for i, name in enumerate(DEMUCS_INSTRUM_MODELS):
+        stages.append(
+            Stage(
+                name,
+                lambda audio, i=i: demucs_instrum(i, audio),
+                deps=("instrum_audio",),
+                threads=demucs_threads,
+                memory=plan.stage_memory(name) + demucs_outputs,
+                progress=0.10,
+            )
+        )
+    stages.append(
+        Stage("instruments", instruments, deps=("vocals", *DEMUCS_INSTRUM_MODELS))
+    )
+    if needs_instruments(stems):
+        return prune_graph(stages, ["vocals", "instruments"])
+    return prune_graph(stages, ["vocals"])
+
+
+def separate_ensemble(
+    ensemble,
+    mixed_sound_array,
+    sample_rate,
+    update_percent_func=None,
+    current_file_number=0,
+    total_files=0,
+    only_vocals=False,
+    stems=None,
+    checkpoint=None,
+):
+    """`separate_music_file` of the ensemble, runs `ensemble_graph`. Returns
+    the vocals, plus drums, bass and other if `stems` needs them. Model
+    outputs are read from and written to `ensemble.cache` and the
+    `checkpoint` cache of this file."""
+    if stems is None:
+        stems = ["vocals", "instrum"] if only_vocals else STEMS
+    caches = [c for c in (checkpoint, ensemble.cache) if c is not None]
+    cache = None
+    if len(caches) == 1:
+        cache = caches[0]
+    elif caches:
+        cache = CacheGroup(caches)
+    stages = ensemble_graph(ensemble, mixed_sound_array, stems, cache)
+    done = [0.0]
+
+    def progress(stage):
+        done[0] += stage.progress
+        if update_percent_func is not None and stage.progress:
+            val = 100 * (current_file_number + done[0]) / total_files
             update_percent_func(int(val))
 
-        if self.single_onnx is False:
-            sources2 = -demix_full(
-                -mixed_sound_array.T,
-                self.device,
-                self.chunk_size,
-                self.mdx_models2,
-                self.infer_session2,
-                overlap=overlap,
-            )[0]
-
-            # it's instrumental so need to invert
-            instrum_mdxb2 = sources2
-            vocals_mdxb2 = mixed_sound_array.T - instrum_mdxb2
+    results = run_graph(
+        stages, ensemble.graph_threads, ensemble.graph_memory, progress, "Ensemble"
+    )
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.40) / total_files
-            update_percent_func(int(val))
+    separated_music_arrays = {"vocals": results["vocals"]}
+    if needs_instruments(stems):
+        separated_music_arrays.update(results["instruments"])
+    output_sample_rates = {}
+    for instrum in separated_music_arrays:
+        output_sample_rates[instrum] = sample_rate
 
-        # Ensemble vocals for MDX and Demucs
-        if self.single_onnx is False:
-            weights = np.array([12, 8, 3])
-            vocals = (
-                weights[0] * vocals_mdxb1.T
-                + weights[1] * vocals_mdxb2.T
-                + weights[2] * vocals_demucs.T
-            ) / weights.sum()
+    if update_percent_func is not None:
+        val = 100 * (current_file_number + 0.95) / total_files
+        update_percent_func(int(val))
+
+    return separated_music_arrays, output_sample_rates
+
+
+class DemucsBatcher:
+    """Continuous batching of `apply_model_antipolar` over several tracks.
+
+    `submit` splits a track into the segments `apply_model` would run, with
+    the same random shifts, padding and weights of every model of a bag, both
+    polarities stacked. `step` runs up to `batch_size` queued segments of one
+    model in a single forward call, whichever tracks they come from, and adds
+    the outputs to the overlap-add sums of their track. Once the last segment
+    of a track is in, its (sources, channels, length) numpy result is passed
+    to the `done` callback given to `submit`.
+
+    The model must already be on `device`, like the submitted audio. Only the
+    bag `members` given run (see `demucs_members`), sources without weight
+    left are zeros.
+    """
+
+    def __init__(self, model, overlap, device, batch_size=1, shifts=1, members=None):
+        if isinstance(model, BagOfModels):
+            self.models = list(model.models)
+            self.weights = model.weights
         else:
-            weights = np.array([6, 1])
-            vocals = (
-                weights[0] * vocals_mdxb1.T + weights[1] * vocals_demucs.T
-            ) / weights.sum()
+            self.models = [model]
+            self.weights = None
+        if members is not None:
+            self.models = [self.models[k] for k in members]
+            if self.weights is None:
+                self.weights = [[1.0] * len(model.sources) for _ in members]
+            else:
+                self.weights = [self.weights[k] for k in members]
+        for sub_model in self.models:
+            sub_model.eval()
+        self.sources = model.sources
+        self.max_shift = int(0.5 * model.samplerate)
+        self.overlap = overlap
+        self.device = device
+        self.batch_size = max(1, int(batch_size))
+        self.shifts = shifts
+        self.pending = deque()
 
-        # vocals
-        separated_music_arrays["vocals"] = vocals
-        output_sample_rates["vocals"] = sample_rate
+    def __len__(self):
+        return len(self.pending)
 
-        if not only_vocals:
-            # Generate instrumental
-            instrum = mixed_sound_array - vocals
+    def submit(self, audio, done):
+        """Queue the segments of `audio` (1, channels, length)."""
+        if not self.models:
+            done(np.zeros((len(self.sources),) + audio.shape[1:], dtype=np.float32))
+            return
+        mix = torch.cat([audio, -audio])
+        length = mix.shape[-1]
+        if self.shifts:
+            padded_mix = TensorChunk(mix).padded(length + 2 * self.max_shift)
+        job = {"passes": [], "remaining": 0, "done": done}
+        for m, model in enumerate(self.models):
+            segment_length = int(model.samplerate * model.segment)
+            stride = int((1 - self.overlap) * segment_length)
+            weight = torch.cat(
+                [
+                    torch.arange(1, segment_length // 2 + 1, device=self.device),
+                    torch.arange(
+                        segment_length - segment_length // 2, 0, -1, device=self.device
+                    ),
+                ]
+            )
+            weight = weight / weight.max()
+            for _ in range(max(1, self.shifts)):
+                if self.shifts:
+                    offset = random.randint(0, self.max_shift)
+                    source = TensorChunk(
+                        padded_mix, offset, length + self.max_shift - offset
+                    )
+                else:
+                    offset = self.max_shift
+                    source = TensorChunk(mix)
+                shape = (2, len(self.sources), mix.shape[1], source.length)
+                p = {
+                    "model": m,
+                    "offset": offset,
+                    "weight": weight,
+                    "out": torch.zeros(shape, device=mix.device),
+                    "sum_weight": torch.zeros(source.length, device=mix.device),
+                }
+                job["passes"].append(p)
+                for start in range(0, source.length, stride):
+                    chunk = TensorChunk(source, start, segment_length)
+                    if hasattr(model, "valid_length"):
+                        valid_length = model.valid_length(chunk.length)
+                    else:
+                        valid_length = chunk.length
+                    self.pending.append((job, p, start, chunk, valid_length))
+                    job["remaining"] += 1
+
+    def step(self):
+        """Run one batch of segments sharing the model and input length of
+        the oldest queued one."""
+        _, p, _, _, valid_length = self.pending[0]
+        m = p["model"]
+        items = []
+        rest = deque()
+        while self.pending and len(items) < self.batch_size:
+            item = self.pending.popleft()
+            if item[1]["model"] == m and item[4] == valid_length:
+                items.append(item)
+            else:
+                rest.append(item)
+        self.pending.extendleft(reversed(rest))
 
-            audio = np.expand_dims(instrum.T, axis=0)
-            audio = torch.from_numpy(audio).type("torch.FloatTensor").to(self.device)
+        batch = torch.cat([chunk.padded(valid_length) for _, _, _, chunk, _ in items])
+        with torch.no_grad():
+            out = self.models[m](batch.to(self.device))
+        for b, (job, p, start, chunk, _) in enumerate(items):
+            chunk_out = center_trim(out[2 * b : 2 * b + 2], chunk.length)
+            n = chunk_out.shape[-1]
+            p["out"][..., start : start + n] += p["weight"][:n] * chunk_out
+            p["sum_weight"][start : start + n] += p["weight"][:n]
+            job["remaining"] -= 1
+            if job["remaining"] == 0:
+                self.finish(job)
+
+    def finish(self, job):
+        estimates = 0.0
+        totals = [0.0] * len(self.sources)
+        for m in range(len(self.models)):
+            out = 0.0
+            for p in job["passes"]:
+                if p["model"] != m:
+                    continue
+                res = p["out"] / p["sum_weight"]
+                out += res[..., self.max_shift - p["offset"] :]
+            out /= max(1, self.shifts)
+            if self.weights is not None:
+                for k, inst_weight in enumerate(self.weights[m]):
+                    out[:, k, :, :] *= inst_weight
+                    totals[k] += inst_weight
+            estimates += out
+        if self.weights is not None:
+            for k in range(estimates.shape[1]):
+                if totals[k]:
+                    estimates[:, k, :, :] /= totals[k]
+        job["passes"] = None
+        job["done"]((0.5 * (estimates[0] - estimates[1])).cpu().numpy())
+
+
+class MdxBatcher:
+    """Continuous batching of `demix_full_multi` over several tracks.
+
+    `heads` must share one `mdx_geometry`. `submit` plans the MDX frames of a
+    track and `step` sends up to one MDX batch of queued frames, from any
+    track, through the STFT and the ONNX sessions. Once the last frame of a
+    track is added, the `done` callback gets one (2, length) array per head.
+    """
 
-            all_outs = []
-            for i, model in enumerate(self.models):
-                if i == 0:
-                    overlap = overlap_small
-                elif i > 0:
-                    overlap = overlap_large
-                out = (
-                    0.5
-                    * apply_model(model, audio, shifts=shifts, overlap=overlap)[0]
-                    .cpu()
-                    .numpy()
-                    + 0.5
-                    * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-                    .cpu()
-                    .numpy()
+    def __init__(
+        self, heads, chunk_size, overlap, device, batch_size=None, batch_bytes=None
+    ):
+        self.heads = heads
+        self.model = heads[0][0]
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+        self.device = device
+        self.batch_size = mdx_batch_size(
+            self.model, chunk_size, batch_size, batch_bytes
+        )
+        self.buf = np.empty(
+            (self.batch_size, 2, self.model.chunk_size), dtype=np.float32
+        )
+        self.pending = deque()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, mix, done):
+        """Queue the frames of `mix` (2, length)."""
+        length = mix.shape[-1]
+        starts, sizes, step = plan_overlap_add(length, self.chunk_size, self.overlap)
+        frames = plan_mdx_frames(sizes, self.model)
+        job = {
+            "mix": mix,
+            "plan": (starts, sizes, step),
+            "results": [
+                np.zeros((mix.shape[0], length), dtype=np.float32) for _ in self.heads
+            ],
+            "remaining": len(frames),
+            "done": done,
+        }
+        for k, j in frames:
+            self.pending.append((job, k, j))
+
+    def step(self):
+        items = [
+            self.pending.popleft()
+            for _ in range(min(self.batch_size, len(self.pending)))
+        ]
+        for b, (job, k, j) in enumerate(items):
+            starts, sizes, _ = job["plan"]
+            gather_mdx_frame(
+                job["mix"], starts[k], sizes[k], j, self.model, self.buf[b]
+            )
+        spec = mdx_stft_stage(self.buf[: len(items)], self.device, self.model)
+        for h, (model, infer_session, sign) in enumerate(self.heads):
+            res = mdx_onnx_stage(spec if sign > 0 else -spec, infer_session)
+            out = mdx_istft_stage(res, self.device, model)
+            for wave, (job, k, j) in zip(out, items):
+                starts, sizes, step = job["plan"]
+                add_mdx_frame(
+                    job["results"][h],
+                    wave,
+                    starts,
+                    sizes,
+                    step,
+                    self.chunk_size,
+                    k,
+                    j,
+                    sign,
                 )
+        for job, _, _ in items:
+            job["remaining"] -= 1
+            if job["remaining"] == 0:
+                job["mix"] = None
+                job["done"](job["results"])
+
+
+def separate_continuous(ensemble, tracks, done, stems=STEMS, max_files=8):
+    """Separate many tracks with batches mixing the chunks of several of them.
+
+    `tracks` yields `(key, mixed_sound_array, sample_rate)` and is read as
+    room frees up, at most `max_files` tracks are in flight. Every model of
+    the ensemble gets a `DemucsBatcher` or a `MdxBatcher` and the fullest
+    queue runs next, so short tracks share batches instead of padding their
+    own. A track moves on to the instrument models as soon as its vocals are
+    joined and `done(key, mixed_sound_array, separated_music_arrays,
+    sample_rate)` is called when its last stem is ready, in the order tracks
+    finish.
+
+    Every model of the ensemble stays on the device while tracks are
+    separated. The stem cache and checkpoints are not used.
+    """
+    device = ensemble.device
+    instruments = needs_instruments(stems)
+    names = [DEMUCS_VOCALS_MODEL]
+    if instruments:
+        names += DEMUCS_INSTRUM_MODELS
+    loaded = []
+    try:
+        demucs = {}
+        for name in names:
+            model = ensemble.resident_models.get(name)
+            if model is None:
+                model = ensemble.load_demucs_model(name)
+                model.to(device)
+                loaded.append(model)
+            members = None
+            if name in DEMUCS_INSTRUM_MODELS:
+                members = ensemble.instrum_members(
+                    DEMUCS_INSTRUM_MODELS.index(name), model
+                )
+            demucs[name] = DemucsBatcher(
+                model,
+                ensemble.demucs_overlap(name),
+                device,
+                batch_size=ensemble.demucs_batch_size,
+                members=members,
+            )
+        heads = ensemble.mdx_heads()
+        groups = {}
+        for h, head in enumerate(heads):
+            groups.setdefault(mdx_geometry(head[0]), []).append(h)
+        mdx = [
+            (
+                group,
+                MdxBatcher(
+                    [heads[h] for h in group],
+                    ensemble.chunk_size,
+                    ensemble.overlap_large,
+                    device,
+                    ensemble.mdx_batch_size,
+                    ensemble.mdx_batch_bytes,
+                ),
+            )
+            for group in groups.values()
+        ]
+        batchers = list(demucs.values()) + [batcher for _, batcher in mdx]
+        active = {}
+
+        def to_device(array):
+            audio = np.expand_dims(array.T, axis=0)
+            return torch.from_numpy(audio).type("torch.FloatTensor").to(device)
+
+        def admit(key, mixed_sound_array, sample_rate):
+            track = {
+                "mix": mixed_sound_array,
+                "sample_rate": sample_rate,
+                "vocals_demucs": None,
+                "sources": [None] * len(heads),
+                "waiting": 1 + len(mdx),
+                "outs": [None] * len(DEMUCS_INSTRUM_MODELS),
+            }
+            active[key] = track
+
+            def vocals_demucs_done(out):
+                track["vocals_demucs"] = out[3]
+                part_done()
+
+            def mdx_done(group, outs):
+                for h, out in zip(group, outs):
+                    track["sources"][h] = out
+                part_done()
+
+            def part_done():
+                track["waiting"] -= 1
+                if track["waiting"] == 0:
+                    vocals_done()
+
+            def vocals_done():
+                track["vocals"] = join_vocals(
+                    ensemble, track["mix"], track["vocals_demucs"], track["sources"]
+                )
+                track["vocals_demucs"] = track["sources"] = None
+                if not instruments:
+                    finish({"vocals": track["vocals"]})
+                    return
+                audio = to_device(track["mix"] - track["vocals"])
+                for i, name in enumerate(DEMUCS_INSTRUM_MODELS):
+                    demucs[name].submit(audio, lambda out, i=i: instrum_done(i, out))
+
+            def instrum_done(i, out):
+                track["outs"][i] = weight_instrum_output(ensemble, i, out)
+                if all(out is not None for out in track["outs"]):
+                    result = {"vocals": track["vocals"]}
+                    result.update(
+                        join_instruments(
+                            ensemble, track["mix"], track["vocals"], track["outs"]
+                        )
+                    )
+                    finish(result)
 
-                if update_percent_func is not None:
-                    val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-                    update_percent_func(int(val))
-
-                if i == 2:
-                    # ['drums', 'bass', 'other', 'vocals', 'guitar', 'piano']
-                    out[2] = out[2] + out[4] + out[5]
-                    out = out[:4]
-
-                out[0] = self.weights_drums[i] * out[0]
-                out[1] = self.weights_bass[i] * out[1]
-                out[2] = self.weights_other[i] * out[2]
-                out[3] = self.weights_vocals[i] * out[3]
-
-                all_outs.append(out)
-            out = np.array(all_outs).sum(axis=0)
-            out[0] = out[0] / self.weights_drums.sum()
-            out[1] = out[1] / self.weights_bass.sum()
-            out[2] = out[2] / self.weights_other.sum()
-            out[3] = out[3] / self.weights_vocals.sum()
-
-            # other
-            res = mixed_sound_array - vocals - out[0].T - out[1].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays["other"] = (2 * res + out[2].T) / 3.0
-            output_sample_rates["other"] = sample_rate
-
-            # drums
-            res = mixed_sound_array - vocals - out[1].T - out[2].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays["drums"] = (res + 2 * out[0].T.copy()) / 3.0
-            output_sample_rates["drums"] = sample_rate
-
-            # bass
-            res = mixed_sound_array - vocals - out[0].T - out[2].T
-            res = np.clip(res, -1, 1)
-            separated_music_arrays["bass"] = (res + 2 * out[1].T) / 3.0
-            output_sample_rates["bass"] = sample_rate
-
-            bass = separated_music_arrays["bass"]
-            drums = separated_music_arrays["drums"]
-            other = separated_music_arrays["other"]
-
-            separated_music_arrays["other"] = mixed_sound_array - vocals - bass - drums
-            separated_music_arrays["drums"] = mixed_sound_array - vocals - bass - other
-            separated_music_arrays["bass"] = mixed_sound_array - vocals - drums - other
+            def finish(result):
+                del active[key]
+                done(key, track["mix"], result, track["sample_rate"])
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.95) / total_files
-            update_percent_func(int(val))
+            demucs[DEMUCS_VOCALS_MODEL].submit(
+                to_device(mixed_sound_array), vocals_demucs_done
+            )
+            for group, batcher in mdx:
+                batcher.submit(
+                    mixed_sound_array.T, lambda outs, group=group: mdx_done(group, outs)
+                )
 
-        return separated_music_arrays, output_sample_rates
+        tracks = iter(tracks)
+        exhausted = False
+        while True:
+            while not exhausted and len(active) < max_files:
+                track = next(tracks, None)
+                if track is None:
+                    exhausted = True
+                else:
+                    admit(*track)
+            if stop_requested():
+                raise StopProcessing("Stop requested")
+            batcher = max(batchers, key=len)
+            if not len(batcher):
+                break
+            batcher.step()
+    finally:
+        for model in loaded:
+            model.cpu()
 
 
-class EnsembleDemucsMDXMusicSeparationModelLowGPU:
-    def __init__(self, options):
+class EnsembleDemucsMDXMusicSeparationModel:
+    def __init__(self, options, resident=None):
         """
         options - user options
+        resident - names of the models kept loaded between files, planned
+            from the memory budget if None (see `plan_memory`)
         """
         # print(options)
 
@@ -609,21 +2193,107 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         if self.overlap_small < 0.0:
             self.overlap_small = 0.0
 
-        self.weights_vocals = np.array([10, 1, 8, 9])
-        self.weights_bass = np.array([19, 4, 5, 8])
-        self.weights_drums = np.array([18, 2, 4, 9])
-        self.weights_other = np.array([14, 2, 5, 10])
+        # Outputs computed by default, only their models are planned
+        self.stems = parse_stems(options)
+
+        # Ensemble weights, vocals of MDX and Demucs and the four instrument
+        # models per stem. Changing them with a cache only redoes the joins.
+        if self.single_onnx is False:
+            self.vocals_ensemble_weights = ensemble_weights(
+                options, "vocals_ensemble_weights", [12, 8, 3]
+            )
+        else:
+            self.vocals_ensemble_weights = ensemble_weights(
+                options, "vocals_ensemble_weights", [6, 1]
+            )
+        self.weights_vocals = ensemble_weights(options, "weights_vocals", [10, 1, 8, 9])
+        self.weights_bass = ensemble_weights(options, "weights_bass", [19, 4, 5, 8])
+        self.weights_drums = ensemble_weights(options, "weights_drums", [18, 2, 4, 9])
+        self.weights_other = ensemble_weights(options, "weights_other", [14, 2, 5, 10])
+        self.cache = stem_cache(options)
 
         if device == "cpu":
-            chunk_size = 200000000
             self.providers = ["CPUExecutionProvider"]
         else:
-            chunk_size = 1000000
             self.providers = ["CUDAExecutionProvider"]
-        if "chunk_size" in options:
-            chunk_size = int(options["chunk_size"])
-        self.chunk_size = chunk_size
+
+        # MDX frames per ONNX call, either as a count or as a memory budget
+        self.mdx_batch_size = None
+        if options.get("mdx_batch_size"):
+            self.mdx_batch_size = int(options["mdx_batch_size"])
+        self.mdx_batch_bytes = None
+        if options.get("mdx_batch_mb"):
+            self.mdx_batch_bytes = int(float(options["mdx_batch_mb"]) * 1024 * 1024)
+        self.onnx_settings = onnx_session_settings(options)
+        # Overlap STFT, ONNX and iSTFT of consecutive MDX batches
+        self.mdx_pipeline = options.get("mdx_pipeline", True) is not False
+        # Run Demucs on the mix and on the inverted mix as one batch of 2
+        self.antipolar_batch = options.get("antipolar_batch", True) is not False
+        # Run the members of a bag sharing an architecture on each segment
+        # together, as one vmapped call with `demucs_vmap`
+        self.demucs_stack = options.get("demucs_stack", True) is not False
+        self.demucs_vmap = options.get("demucs_vmap") is True
+        # Attention implementation of the Demucs transformer layers
+        self.attention = options.get("attention") or "native"
+        if self.attention not in ATTENTION_BACKENDS:
+            raise ValueError(
+                "Unknown attention backend {}, use one of {}".format(
+                    self.attention, ATTENTION_BACKENDS
+                )
+            )
+        # Threads shared by the ensemble stages running at the same time
+        self.graph_threads = int(options.get("ensemble_threads") or os.cpu_count() or 1)
+        torch_threads = int(options.get("torch_threads") or 0)
+        if device == "cpu":
+            # The Demucs and MDX branches share the threads to run together
+            torch_threads, self.onnx_settings["intra_threads"] = split_threads(
+                self.graph_threads, torch_threads, self.onnx_settings["intra_threads"]
+            )
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        # Keep models that are not resident loaded between files within a
+        # host memory budget
+        model_cache_mb = options.get("model_cache_mb")
+        if model_cache_mb is None:
+            model_cache_mb = MODEL_CACHE_DEFAULT_MB
+        MODEL_REGISTRY.set_budget(int(float(model_cache_mb) * 1024 * 1024))
+
+        # MDX-B models only hold the STFT settings, the ONNX sessions are
+        # created by mdx_heads
+        self.mdx_models1 = get_models(
+            "tdf_extra", load=False, device=device, vocals_model_type=2
+        )
+        if self.single_onnx is False:
+            self.mdx_models2 = get_models(
+                "tdf_extra", load=False, device=device, vocals_model_type=2
+            )
         self.device = device
+
+        if resident is None and options.get("large_gpu") is True:
+            print("Use fast large GPU memory version of code")
+            resident = self.model_names()
+        self.plan = plan_memory(self, options, resident)
+        self.chunk_size = self.plan.chunk_size
+        self.mdx_batch_size = self.plan.mdx_batch_size
+        self.antipolar_batch = self.plan.antipolar_batch
+        self.demucs_batch_size = self.plan.demucs_batch_size
+        self.graph_memory = self.plan.graph_memory
+
+        self.resident_models = {}
+        resident_checkpoints = {}
+        for name in self.plan.resident:
+            if name.endswith(".onnx"):
+                model = create_onnx_session(
+                    model_file(name), self.providers, self.onnx_settings
+                )
+            else:
+                model = self.load_demucs_model(name, cache=False)
+                model = share_checkpoints(name, model, resident_checkpoints)
+                self.plan.model_bytes[name] = module_bytes(model)
+                model.to(device)
+            self.resident_models[name] = model
+
+        self.plan.report()
         pass
 
     @property
@@ -631,9 +2301,198 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         """DO NOT CHANGE"""
         return ["bass", "drums", "other", "vocals"]
 
-    def raise_aicrowd_error(self, msg):
-        """Will be used by the evaluator to provide logs, DO NOT CHANGE"""
-        raise NameError(msg)
+    def raise_aicrowd_error(self, msg):
+        """Will be used by the evaluator to provide logs, DO NOT CHANGE"""
+        raise NameError(msg)
+
+    def onnx_names(self):
+        if self.kim_model_1:
+            names = ["Kim_Vocal_1.onnx"]
+        else:
+            names = ["Kim_Vocal_2.onnx"]
+        if self.single_onnx is False:
+            names.append("Kim_Inst.onnx")
+        return names
+
+    def model_names(self):
+        """Models of the ensemble needed for `self.stems`, in the order they
+        run."""
+        names = [DEMUCS_VOCALS_MODEL] + self.onnx_names()
+        if needs_instruments(self.stems):
+            names += DEMUCS_INSTRUM_MODELS
+        return names
+
+    def load_demucs_model(self, name, cache=True):
+        """Demucs model `name` on the CPU, through `MODEL_REGISTRY` if `cache`,
+        run by the demucs4 classes with the attention backend of the ensemble."""
+        model = adopt_model(self._load_demucs_model(name, cache))
+        # Models in the registry may come from an ensemble with another backend
+        set_attention(model, self.attention)
+        return model
+
+    def _load_demucs_model(self, name, cache):
+        if name == DEMUCS_VOCALS_MODEL:
+            flat_path = flat_model_file(DEMUCS_VOCALS_MODEL)
+            if flat_path:
+                key = ("demucs", flat_path)
+                loader = lambda: load_flat_model(flat_path)
+            else:
+                model_path = model_file("04573f0d-f3cf25b2.th")
+                key = ("demucs", model_path)
+                loader = lambda: load_model(model_path)
+        else:
+            key = ("demucs", name)
+            loader = lambda: load_pretrained(name)
+        if not cache:
+            return loader()
+        return MODEL_REGISTRY.get(
+            key,
+            lambda: share_checkpoints(name, loader(), SHARED_CHECKPOINTS),
+            module_bytes,
+        )
+
+    def get_onnx_session(self, name):
+        """ONNX session for `name`. Sessions that are not resident are only
+        kept in `MODEL_REGISTRY` on CPU, a CUDA session would hold on to its
+        GPU arena while Demucs runs."""
+        session = self.resident_models.get(name)
+        if session is not None:
+            return session
+        model_path = model_file(name)
+        if self.providers != ["CPUExecutionProvider"]:
+            return create_onnx_session(model_path, self.providers, self.onnx_settings)
+        key = ("onnx", model_path, tuple(sorted(self.onnx_settings.items())))
+        return MODEL_REGISTRY.get(
+            key,
+            lambda: create_onnx_session(model_path, self.providers, self.onnx_settings),
+            lambda session: os.path.getsize(model_path),
+        )
+
+    def run_demucs(self, name, audio, overlap, members=None):
+        """Sign-flip averaged Demucs output of model `name`, of its bag
+        `members` only if given. A model that is not resident is only on the
+        device for the duration of the call."""
+        model = self.resident_models.get(name)
+        if model is not None:
+            return self.apply_demucs(name, model, audio, overlap, members)
+        model = self.load_demucs_model(name)
+        model.to(self.device)
+        try:
+            return self.apply_demucs(name, model, audio, overlap, members)
+        finally:
+            model.cpu()
+
+    def apply_demucs(self, name, model, audio, overlap, members=None):
+        """`apply_model_antipolar` of `model`, restricted to the bag `members`
+        if given, sources without weight left are zeros. A model with skipped
+        members or members of the same architecture runs member by member,
+        same architecture members through `apply_stacked_antipolar`."""
+        signatures = demucs_signatures(name)
+        bag = isinstance(model, BagOfModels)
+        models = list(model.models) if bag else [model]
+        if len(models) != len(signatures):
+            members = None
+        if members is None:
+            members = list(range(len(models)))
+        # Members with the same architecture run on each segment together
+        groups = OrderedDict()
+        for k in members:
+            key = architecture_key(models[k]) if self.demucs_stack else None
+            groups.setdefault(key if key is not None else k, []).append(k)
+        if len(members) == len(models) and len(groups) == len(members):
+            return apply_model_antipolar(
+                model, audio, shifts=1, overlap=overlap, batched=self.antipolar_batch
+            )
+        if bag:
+            weights = np.array(model.weights, dtype=np.float32)
+        else:
+            weights = np.ones((1, len(model.sources)), dtype=np.float32)
+        outs = {}
+        for group in groups.values():
+            if len(group) > 1:
+                results = apply_stacked_antipolar(
+                    [models[k] for k in group],
+                    audio,
+                    shifts=1,
+                    overlap=overlap,
+                    batched=self.antipolar_batch,
+                    vmap=self.demucs_vmap,
+                )
+            else:
+                results = [
+                    apply_model_antipolar(
+                        models[group[0]],
+                        audio,
+                        shifts=1,
+                        overlap=overlap,
+                        batched=self.antipolar_batch,
+                    )
+                ]
+            for k, out in zip(group, results):
+                outs[k] = out
+        estimates = np.zeros(
+            (len(model.sources),) + tuple(audio.shape[1:]), dtype=np.float32
+        )
+        for k in members:
+            estimates += weights[k][:, None, None] * outs[k]
+        totals = weights[members].sum(axis=0)[:, None, None]
+        return np.divide(estimates, totals, out=estimates, where=totals != 0)
+
+    def instrum_sources(self, i):
+        """Sources of instrument model `i` used by `join_instruments`: drums,
+        bass and other with a non zero weight, the guitar and piano of
+        htdemucs_6s go to other. Vocals of the instrument models are unused."""
+        weights = [self.weights_drums[i], self.weights_bass[i], self.weights_other[i]]
+        sources = [k for k, weight in enumerate(weights) if weight != 0]
+        if i == 2 and 2 in sources:
+            sources += [4, 5]
+        return sources
+
+    def instrum_members(self, i, model=None):
+        """Bag members of instrument model `i` whose outputs are used, None if
+        all of them are. `model` is checked to be the bag they index."""
+        name = DEMUCS_INSTRUM_MODELS[i]
+        count = len(demucs_signatures(name))
+        members = demucs_members(name, self.instrum_sources(i))
+        if len(members) == count:
+            return None
+        if model is not None:
+            models = model.models if isinstance(model, BagOfModels) else [model]
+            if len(models) != count:
+                return None
+        return members
+
+    def demucs_overlap(self, name):
+        if name == DEMUCS_INSTRUM_MODELS[0]:
+            return self.overlap_small
+        return self.overlap_large
+
+    def demucs_vocals(self, audio):
+        # Get Demucs vocal only
+        return self.run_demucs(
+            DEMUCS_VOCALS_MODEL, audio, self.demucs_overlap(DEMUCS_VOCALS_MODEL)
+        )[3]
+
+    def demucs_instrum(self, i, audio):
+        name = DEMUCS_INSTRUM_MODELS[i]
+        return self.run_demucs(
+            name, audio, self.demucs_overlap(name), self.instrum_members(i)
+        )
+
+    def mdx_heads(self, names=None):
+        """(model, session, sign) of the MDX models `names` (default: all)."""
+        heads = []
+        for i, name in enumerate(self.onnx_names()):
+            if names is not None and name not in names:
+                continue
+            print("Model path: {}".format(MODEL_FOLDER + name))
+            print("Device: {} Chunk size: {}".format(self.device, self.chunk_size))
+            if i == 0:
+                heads.append((self.mdx_models1[0], self.get_onnx_session(name), 1))
+            else:
+                # it's instrumental so it runs on the inverted mix
+                heads.append((self.mdx_models2[0], self.get_onnx_session(name), -1))
+        return heads
 
     def separate_music_file(
         self,
@@ -643,338 +2502,356 @@ class EnsembleDemucsMDXMusicSeparationModelLowGPU:
         current_file_number=0,
         total_files=0,
         only_vocals=False,
+        stems=None,
+        checkpoint=None,
     ):
         """
         Implements the sound separation for a single sound file
         Inputs: Outputs from soundfile.read('mixture.wav')
             mixed_sound_array
             sample_rate
+            stems: outputs to compute, see STEMS (default: all)
+            checkpoint: StemCache keeping finished stages of this file
 
         Outputs:
             separated_music_arrays: Dictionary numpy array of each separated instrument
             output_sample_rates: Dictionary of sample rates separated sequence
         """
 
-        # print('Update percent func: {}'.format(update_percent_func))
-
-        separated_music_arrays = {}
-        output_sample_rates = {}
-
-        audio = np.expand_dims(mixed_sound_array.T, axis=0)
-        audio = torch.from_numpy(audio).type("torch.FloatTensor").to(self.device)
-
-        overlap_large = self.overlap_large
-        overlap_small = self.overlap_small
-
-        # Get Demucs vocal only
-        model_folder = os.path.dirname(os.path.realpath(__file__)) + "/models/"
-        remote_url = "https://dl.fbaipublicfiles.com/demucs/hybrid_transformer/04573f0d-f3cf25b2.th"
-        model_path = model_folder + "04573f0d-f3cf25b2.th"
-        if not os.path.isfile(model_path):
-            torch.hub.download_url_to_file(
-                remote_url, model_folder + "04573f0d-f3cf25b2.th"
-            )
-        model_vocals = load_model(model_path)
-        model_vocals.to(self.device)
-        shifts = 1
-        overlap = overlap_large
-        vocals_demucs = (
-            0.5
-            * apply_model(model_vocals, audio, shifts=shifts, overlap=overlap)[0][3]
-            .cpu()
-            .numpy()
+        return separate_ensemble(
+            self,
+            mixed_sound_array,
+            sample_rate,
+            update_percent_func,
+            current_file_number,
+            total_files,
+            only_vocals,
+            stems,
+            checkpoint,
         )
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.10) / total_files
-            update_percent_func(int(val))
+    def separate_music_files(self, tracks, done, stems=None, max_files=8):
+        """
+        Sound separation of many files with batches shared between them
+        Inputs:
+            tracks: iterable of (key, mixed_sound_array, sample_rate)
+            done: called with (key, mixed_sound_array, separated_music_arrays,
+                sample_rate) as each file finishes
+            stems: outputs to compute, see STEMS (default: all)
+            max_files: files separated at the same time
+        """
 
-        vocals_demucs += (
-            0.5
-            * -apply_model(model_vocals, -audio, shifts=shifts, overlap=overlap)[0][3]
-            .cpu()
-            .numpy()
+        separate_continuous(
+            self, tracks, done, stems or self.stems, max_files=max_files
         )
-        model_vocals = model_vocals.cpu()
-        del model_vocals
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.20) / total_files
-            update_percent_func(int(val))
 
-        # MDX-B model 1 initialization
-        mdx_models1 = get_models(
-            "tdf_extra", load=False, device=self.device, vocals_model_type=2
-        )
-        if self.kim_model_1:
-            model_path_onnx1 = model_folder + "Kim_Vocal_1.onnx"
-            remote_url_onnx1 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_1.onnx"
-        else:
-            model_path_onnx1 = model_folder + "Kim_Vocal_2.onnx"
-            remote_url_onnx1 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Vocal_2.onnx"
-        if not os.path.isfile(model_path_onnx1):
-            torch.hub.download_url_to_file(remote_url_onnx1, model_path_onnx1)
-        print("Model path: {}".format(model_path_onnx1))
-        print("Device: {} Chunk size: {}".format(self.device, self.chunk_size))
-        infer_session1 = ort.InferenceSession(
-            model_path_onnx1,
-            providers=self.providers,
-            provider_options=[{"device_id": 0}],
-        )
-        overlap = overlap_large
-        sources1 = demix_full(
-            mixed_sound_array.T,
-            self.device,
-            self.chunk_size,
-            mdx_models1,
-            infer_session1,
-            overlap=overlap,
-        )[0]
-        vocals_mdxb1 = sources1
-        del infer_session1
-        del mdx_models1
+class EnsembleDemucsMDXMusicSeparationModelLowGPU(
+    EnsembleDemucsMDXMusicSeparationModel
+):
+    """Ensemble that keeps no model on the device between files."""
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.30) / total_files
-            update_percent_func(int(val))
+    def __init__(self, options):
+        super().__init__(options, resident=[])
+
+
+# Options that change the separated audio, a manifest entry only matches
+# when they are the same
+OUTPUT_OPTIONS = [
+    "overlap_large",
+    "overlap_small",
+    "single_onnx",
+    "use_kim_model_1",
+    "chunk_size",
+    "vocals_ensemble_weights",
+    "weights_vocals",
+    "weights_bass",
+    "weights_drums",
+    "weights_other",
+]
+
+
+# Options that only choose the files to separate, the outputs and where they
+# go, an ensemble built for other values of them can be reused. Models of
+# stems it did not plan for are loaded when needed.
+RUN_OPTIONS = [
+    "input_audio",
+    "output_folder",
+    "stems",
+    "only_vocals",
+    "skip_existing",
+    "resume",
+    "checkpoint_dir",
+    "batch_files",
+    "workers",
+    "stop_requested",
+]
+
+
+def plain_options(options):
+    """`options` without callbacks, events and other values that cannot be
+    sent to another process or saved as JSON."""
+    plain = (str, int, float, bool, list, tuple, type(None))
+    return {key: value for key, value in options.items() if isinstance(value, plain)}
+
+
+def ensemble_options(options):
+    """The options an ensemble is built from. Runs with equal ensemble
+    options can share one ensemble (see `predict_with_model`)."""
+    return {
+        key: value
+        for key, value in plain_options(options).items()
+        if key not in RUN_OPTIONS and value is not None
+    }
+
+
+def file_digest(path, block_size=1024 * 1024):
+    """Streaming blake2b digest of the file at `path`."""
+    h = hashlib.blake2b(digest_size=16)
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
 
-        if self.single_onnx is False:
-            # MDX-B model 2  initialization
-            mdx_models2 = get_models(
-                "tdf_extra", load=False, device=self.device, vocals_model_type=2
-            )
-            root_path = os.path.dirname(os.path.realpath(__file__)) + "/"
-            model_path_onnx2 = model_folder + "Kim_Inst.onnx"
-            remote_url_onnx2 = "https://github.com/TRvlvr/model_repo/releases/download/all_public_uvr_models/Kim_Inst.onnx"
-            if not os.path.isfile(model_path_onnx2):
-                torch.hub.download_url_to_file(remote_url_onnx2, model_path_onnx2)
-            print("Model path: {}".format(model_path_onnx2))
-            print("Device: {} Chunk size: {}".format(self.device, self.chunk_size))
-            infer_session2 = ort.InferenceSession(
-                model_path_onnx2,
-                providers=self.providers,
-                provider_options=[{"device_id": 0}],
-            )
 
-            overlap = overlap_large
-            sources2 = -demix_full(
-                -mixed_sound_array.T,
-                self.device,
-                self.chunk_size,
-                mdx_models2,
-                infer_session2,
-                overlap=overlap,
-            )[0]
-
-            # it's instrumental so need to invert
-            instrum_mdxb2 = sources2
-            vocals_mdxb2 = mixed_sound_array.T - instrum_mdxb2
-            del infer_session2
-            del mdx_models2
+def output_options_hash(options):
+    values = {key: options.get(key) for key in OUTPUT_OPTIONS}
+    values["version"] = __VERSION__
+    return hashlib.blake2b(
+        json.dumps(values, sort_keys=True, default=str).encode(), digest_size=16
+    ).hexdigest()
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.40) / total_files
-            update_percent_func(int(val))
 
-        # Ensemble vocals for MDX and Demucs
-        if self.single_onnx is False:
-            weights = np.array([12, 8, 3])
-            vocals = (
-                weights[0] * vocals_mdxb1.T
-                + weights[1] * vocals_mdxb2.T
-                + weights[2] * vocals_demucs.T
-            ) / weights.sum()
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on the file `path`, created if needed, against
+    other processes and other threads taking it."""
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
         else:
-            weights = np.array([6, 1])
-            vocals = (
-                weights[0] * vocals_mdxb1.T + weights[1] * vocals_demucs.T
-            ) / weights.sum()
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # Gave up after 10 seconds, keep waiting
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
-        # Generate instrumental
-        instrum = mixed_sound_array - vocals
 
-        audio = np.expand_dims(instrum.T, axis=0)
-        audio = torch.from_numpy(audio).type("torch.FloatTensor").to(self.device)
+class Manifest:
+    """Inputs already separated into an output folder.
 
-        all_outs = []
+    Entries are keyed by the content digest of the input and the hash of the
+    output options, and list the stems and files written for it. Digests are
+    remembered by path, size and modification time so unchanged inputs are not
+    read again.
 
-        i = 0
-        overlap = overlap_small
-        model = pretrained.get_model("htdemucs_ft")
-        model.to(self.device)
-        out = (
-            0.5
-            * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-            + 0.5
-            * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-            .cpu()
-            .numpy()
-        )
+    Workers of `predict_with_workers` share the manifest, changes are made to
+    the saved manifest under `file_lock`.
+    """
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
+    FILE_NAME = "manifest.json"
 
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 1
-        overlap = overlap_large
-        model = pretrained.get_model("htdemucs")
-        model.to(self.device)
-        out = (
-            0.5
-            * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-            + 0.5
-            * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-            .cpu()
-            .numpy()
-        )
+    def __init__(self, output_folder):
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, self.FILE_NAME)
+        self.data = self.read() or self.empty()
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
+    @staticmethod
+    def empty():
+        return {"version": 1, "digests": {}, "entries": {}}
 
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 2
-        overlap = overlap_large
-        model = pretrained.get_model("htdemucs_6s")
-        model.to(self.device)
-        out = (
-            0.5
-            * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-            + 0.5
-            * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-            .cpu()
-            .numpy()
+    def read(self):
+        """The saved manifest, None if missing or unreadable."""
+        if not os.path.isfile(self.path):
+            return None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Could not read manifest {}: {}".format(self.path, e))
+            return None
+        return data if data.get("version") == 1 else None
+
+    def digest(self, input_audio):
+        path = os.path.abspath(input_audio)
+        st = os.stat(path)
+        known = self.data["digests"].get(path)
+        if known is not None and known[:2] == [st.st_size, st.st_mtime_ns]:
+            return known[2]
+        digest = file_digest(path)
+        self.data["digests"][path] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def has_files(self, entry, folder):
+        """Whether all the files of `entry` are in `folder`."""
+        folder = os.path.join(self.output_folder, folder)
+        return all(
+            os.path.isfile(os.path.join(folder, name)) for name in entry["files"]
         )
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        # More stems need to add
-        out[2] = out[2] + out[4] + out[5]
-        out = out[:4]
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        i = 3
-        model = pretrained.get_model("hdemucs_mmi")
-        model.to(self.device)
-        out = (
-            0.5
-            * apply_model(model, audio, shifts=shifts, overlap=overlap)[0].cpu().numpy()
-            + 0.5
-            * -apply_model(model, -audio, shifts=shifts, overlap=overlap)[0]
-            .cpu()
-            .numpy()
+    def valid(self, entry, stems):
+        """Whether `entry` covers `stems` and its files all exist."""
+        return (
+            entry is not None
+            and set(stems) <= set(entry["stems"])
+            and self.has_files(entry, entry["folder"])
         )
 
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.50 + i * 0.10) / total_files
-            update_percent_func(int(val))
-
-        out[0] = self.weights_drums[i] * out[0]
-        out[1] = self.weights_bass[i] * out[1]
-        out[2] = self.weights_other[i] * out[2]
-        out[3] = self.weights_vocals[i] * out[3]
-        all_outs.append(out)
-        model = model.cpu()
-        del model
-
-        out = np.array(all_outs).sum(axis=0)
-        out[0] = out[0] / self.weights_drums.sum()
-        out[1] = out[1] / self.weights_bass.sum()
-        out[2] = out[2] / self.weights_other.sum()
-        out[3] = out[3] / self.weights_vocals.sum()
-
-        # vocals
-        separated_music_arrays["vocals"] = vocals
-        output_sample_rates["vocals"] = sample_rate
-
-        # other
-        res = mixed_sound_array - vocals - out[0].T - out[1].T
-        res = np.clip(res, -1, 1)
-        separated_music_arrays["other"] = (2 * res + out[2].T) / 3.0
-        output_sample_rates["other"] = sample_rate
-
-        # drums
-        res = mixed_sound_array - vocals - out[1].T - out[2].T
-        res = np.clip(res, -1, 1)
-        separated_music_arrays["drums"] = (res + 2 * out[0].T.copy()) / 3.0
-        output_sample_rates["drums"] = sample_rate
-
-        # bass
-        res = mixed_sound_array - vocals - out[0].T - out[2].T
-        res = np.clip(res, -1, 1)
-        separated_music_arrays["bass"] = (res + 2 * out[1].T) / 3.0
-        output_sample_rates["bass"] = sample_rate
-
-        bass = separated_music_arrays["bass"]
-        drums = separated_music_arrays["drums"]
-        other = separated_music_arrays["other"]
-
-        separated_music_arrays["other"] = mixed_sound_array - vocals - bass - drums
-        separated_music_arrays["drums"] = mixed_sound_array - vocals - bass - other
-        separated_music_arrays["bass"] = mixed_sound_array - vocals - drums - other
-
-        if update_percent_func is not None:
-            val = 100 * (current_file_number + 0.95) / total_files
-            update_percent_func(int(val))
-
-        return separated_music_arrays, output_sample_rates
+    def find(self, digest, options_hash, stems):
+        """The entry for `digest` made with the same options, covering `stems`,
+        whose files all exist. None otherwise."""
+        entry = self.data["entries"].get("{}:{}".format(digest, options_hash))
+        return entry if self.valid(entry, stems) else None
 
+    def record(self, digest, options_hash, input_audio, stems, folder, files):
+        """Record the outputs of `input_audio` written to `folder`.
 
-def predict_with_model(options):
+        A valid entry of the same audio in another folder is kept, and `folder`
+        is added to its copies. Entries of other audio lose `folder`, its files
+        were overwritten: one stored there moves to its first copy, or is
+        dropped without copies.
+        """
+        key = "{}:{}".format(digest, options_hash)
+
+        def change(data):
+            entries = data["entries"]
+            entry = entries.get(key)
+            if self.valid(entry, stems) and entry["folder"] != folder:
+                if folder not in entry.setdefault("copies", []):
+                    entry["copies"].append(folder)
+            else:
+                copies = [c for c in (entry or {}).get("copies", []) if c != folder]
+                entries[key] = {
+                    "input": os.path.abspath(input_audio),
+                    "stems": list(stems),
+                    "folder": folder,
+                    "files": list(files),
+                    "time": time(),
+                }
+                if copies:
+                    entries[key]["copies"] = copies
+            for other_key, other in list(entries.items()):
+                if other_key == key:
+                    continue
+                copies = other.get("copies", [])
+                if folder in copies:
+                    copies.remove(folder)
+                if other["folder"] == folder:
+                    if copies:
+                        other["folder"] = copies.pop(0)
+                    else:
+                        del entries[other_key]
+
+        self.update(change)
+
+    def update(self, change):
+        """Apply `change(data)` to the saved manifest, along with the digests
+        known here, and save it. Changes saved by other processes since this
+        one read the manifest are kept."""
+        with file_lock(self.path + ".lock"):
+            data = self.read() or self.empty()
+            data["digests"].update(self.data["digests"])
+            change(data)
+            self.data = data
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f, indent=1)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print("Could not write manifest {}: {}".format(self.path, e))
+
+
+def read_audio(input_audio):
+    """Read `input_audio` as float32 (channels, samples), mono is duplicated
+    to stereo. Returns the audio and the sample rate."""
+    audio, sr = sf.read(input_audio, dtype="float32")
+    # soundfile returns shape (n_samples, channels) for multichannel audio
+    if audio.ndim == 1:
+        audio = np.stack([audio, audio], axis=0)
+    elif audio.ndim == 2:
+        # transpose to (channels, samples)
+        audio = audio.T
+    print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
+    return audio, sr
+
+
+def predict_with_model(options, model=None):
     """Top-level loop over input files with cooperative cancellation and callbacks.
 
     The GUI Worker sets `options["stop_requested"] = True` to request a stop.
     We expose `file_start_callback` and `file_done_callback` so the GUI can show
     which file is being processed.
+
+    With `skip_existing`, a `Manifest` in the output folder records what was
+    produced. Inputs already separated with the same options are skipped and
+    copies of the same audio under another name get the outputs copied, also
+    when they are in the same batch of `batch_files`.
+
+    `resume` also skips, and checkpoints each finished stage of a file in
+    `checkpoint_dir`. A batch restarted after a stop or a crash continues the
+    interrupted file from its last finished stage.
+
+    With `batch_files` above 1, that many files are separated at once with
+    batches mixing their chunks (see `separate_continuous`). Files are done
+    in the order they finish, the stem cache and checkpoints are not used.
+
+    With `workers` above 1, files are shared out to that many processes (see
+    `predict_with_workers`).
+
+    `model` is the ensemble to separate with, built on the first file to
+    separate if None. Returns the ensemble, so the next call can reuse it.
     """
     global CURRENT_OPTIONS
 
     for input_audio in options["input_audio"]:
         if not os.path.isfile(input_audio):
             print("Error. No such file: {}. Please check path!".format(input_audio))
-            return
+            return model
     output_folder = options["output_folder"]
     if not os.path.isdir(output_folder):
-        os.mkdir(output_folder)
-
-    only_vocals = False
-    if "only_vocals" in options:
-        if options["only_vocals"] is True:
-            print("Generate only vocals and instrumental")
-            only_vocals = True
-
-    model = None
-    if "large_gpu" in options:
-        if options["large_gpu"] is True:
-            print("Use fast large GPU memory version of code")
-            model = EnsembleDemucsMDXMusicSeparationModel(options)
-    if model is None:
-        print("Use low GPU memory version of code")
-        model = EnsembleDemucsMDXMusicSeparationModelLowGPU(options)
+        os.makedirs(output_folder, exist_ok=True)
+    if int(options.get("workers") or 1) > 1:
+        predict_with_workers(options)
+        return model
+
+    stems = parse_stems(options)
+    if stems == ["vocals", "instrum"]:
+        print("Generate only vocals and instrumental")
+    else:
+        print("Generate: {}".format(", ".join(stems)))
+
+    manifest = None
+    if options.get("skip_existing") or options.get("resume"):
+        manifest = Manifest(output_folder)
+        options_hash = output_options_hash(options)
+    checkpoint_dir = None
+    batch_files = int(options.get("batch_files") or 1)
+    if options.get("resume") and batch_files > 1:
+        print("Checkpoints are not used when batching across files")
+    elif options.get("resume"):
+        checkpoint_dir = options.get("checkpoint_dir") or os.path.join(
+            output_folder, ".checkpoints"
+        )
 
+    # Built on the first file to separate, large_gpu keeps every model
+    # resident, otherwise the memory plan decides
     update_percent_func = options.get("update_percent_func")
     file_done_callback = options.get("file_done_callback")
     file_start_callback = options.get("file_start_callback")
@@ -982,112 +2859,200 @@ def predict_with_model(options):
         "file_write"
     )  # optional: (path, data, sr, subtype) -> None
 
+    def notify(callback, input_audio):
+        if callable(callback):
+            try:
+                callback(input_audio)
+            except Exception:
+                pass
+
+    def start_file(input_audio):
+        """Announce `input_audio`, returns its manifest digest and whether it
+        was already handled by the manifest."""
+        print("Go for: {}".format(input_audio))
+
+        # notify GUI that this file is starting
+        notify(file_start_callback, input_audio)
+
+        if manifest is None:
+            return None, False
+        digest = manifest.digest(input_audio)
+        return digest, reuse_outputs(input_audio, digest)
+
+    def reuse_outputs(input_audio, digest):
+        """Skip `input_audio` if the manifest has outputs for its `digest`,
+        copied from the folder of the same audio under another name if
+        needed. False if there are none."""
+        entry = manifest.find(digest, options_hash, stems)
+        if entry is None:
+            return False
+        stem = os.path.splitext(os.path.basename(input_audio))[0]
+        subfolder = os.path.join(output_folder, stem)
+        if entry["folder"] == stem or (
+            stem in entry.get("copies", []) and manifest.has_files(entry, stem)
+        ):
+            print("Already processed, skip: {}".format(input_audio))
+        else:
+            print("Same audio as {}, copy its outputs".format(entry["input"]))
+            os.makedirs(subfolder, exist_ok=True)
+            for name in entry["files"]:
+                shutil.copyfile(
+                    os.path.join(output_folder, entry["folder"], name),
+                    os.path.join(subfolder, name),
+                )
+            manifest.record(
+                digest, options_hash, input_audio, entry["stems"], stem, entry["files"]
+            )
+        notify(file_done_callback, input_audio)
+        return True
+
+    def write(out_path, data, sr):
+        if callable(file_write_func):
+            try:
+                file_write_func(out_path, data, sr, "FLOAT")
+            except Exception:
+                # fallback to direct write on error
+                sf.write(out_path, data, sr, subtype="FLOAT")
+        else:
+            sf.write(out_path, data, sr, subtype="FLOAT")
+        print("File created: {}".format(out_path))
+
+    def finish_file(input_audio, digest, audio, sr, result, sample_rates):
+        """Write the outputs of `input_audio` and record them."""
+        stem = os.path.splitext(os.path.basename(input_audio))[0]
+        subfolder = os.path.join(output_folder, stem)
+        all_instrum = [instrum for instrum in model.instruments if instrum in stems]
+        written = []
+        if not os.path.isdir(subfolder):
+            os.makedirs(subfolder, exist_ok=True)
+        for instrum in all_instrum:
+            output_name = "{}.wav".format(instrum)
+            write(
+                os.path.join(subfolder, output_name),
+                result[instrum],
+                sample_rates[instrum],
+            )
+            written.append(output_name)
+
+        if "instrum" in stems:
+            # instrumental part 1
+            inst = audio.T - result["vocals"]
+            write(os.path.join(subfolder, "instrum.wav"), inst, sr)
+            written.append("instrum.wav")
+
+        if all(instrum in stems for instrum in INSTRUMENT_STEMS):
+            # instrumental part 2
+            inst2 = result["bass"] + result["drums"] + result["other"]
+            write(os.path.join(subfolder, "instrum2.wav"), inst2, sr)
+            written.append("instrum2.wav")
+
+        if manifest is not None:
+            manifest.record(digest, options_hash, input_audio, stems, stem, written)
+
+        # notify caller (GUI worker) that this file is done
+        notify(file_done_callback, input_audio)
+
     # make current options visible to demix helpers for stop checks
     CURRENT_OPTIONS = options
 
     try:
-        for i, input_audio in enumerate(options["input_audio"]):
-            # cooperative stop check before each file
-            if stop_requested():
-                print("Stop requested, aborting before starting next file")
-                break
-
-            print("Go for: {}".format(input_audio))
-
-            # notify GUI that this file is starting
-            if callable(file_start_callback):
-                try:
-                    file_start_callback(input_audio)
-                except Exception:
-                    pass
+        if batch_files > 1:
+            digests = {}
+            # Copies of the audio of a file being separated, by digest. They
+            # get its outputs once it is done.
+            duplicates = {}
+            finished = [0]
+
+            def progress():
+                finished[0] += 1
+                if update_percent_func is not None:
+                    val = 100 * finished[0] / len(options["input_audio"])
+                    update_percent_func(int(val))
 
-            try:
-                audio, sr = sf.read(input_audio, dtype="float32")
-                # soundfile returns shape (n_samples, channels) for multichannel audio
-                if audio.ndim == 1:
-                    audio = np.stack([audio, audio], axis=0)
-                elif audio.ndim == 2:
-                    # transpose to (channels, samples)
-                    audio = audio.T
-                print("Input audio: {} Sample rate: {}".format(audio.shape, sr))
-
-                result, sample_rates = model.separate_music_file(
-                    audio.T,
+            def tracks():
+                for input_audio in options["input_audio"]:
+                    if stop_requested():
+                        print("Stop requested, aborting before starting next file")
+                        return
+                    digest, skipped = start_file(input_audio)
+                    if skipped:
+                        progress()
+                        continue
+                    if digest is not None and digest in duplicates:
+                        print("Same audio as a file in the batch, wait for it")
+                        duplicates[digest].append(input_audio)
+                        continue
+                    digests[input_audio] = digest
+                    if digest is not None:
+                        duplicates[digest] = []
+                    audio, sr = read_audio(input_audio)
+                    yield input_audio, audio.T, sr
+
+            def track_done(input_audio, mixed_sound_array, result, sr):
+                digest = digests.pop(input_audio)
+                finish_file(
+                    input_audio,
+                    digest,
+                    mixed_sound_array.T,
                     sr,
-                    update_percent_func,
-                    i,
-                    len(options["input_audio"]),
-                    only_vocals,
+                    result,
+                    {instrum: sr for instrum in result},
                 )
-            except StopProcessing:
-                print("Stop requested during file processing")
-                break
-
-            all_instrum = model.instruments
-            if only_vocals:
-                all_instrum = ["vocals"]
-            stem = os.path.splitext(os.path.basename(input_audio))[0]
-            subfolder = os.path.join(output_folder, stem)
-            if not os.path.isdir(subfolder):
-                os.makedirs(subfolder, exist_ok=True)
-            for instrum in all_instrum:
-                output_name = "{}.wav".format(instrum)
-                out_path = os.path.join(subfolder, output_name)
-                if callable(file_write_func):
-                    try:
-                        file_write_func(
-                            out_path, result[instrum], sample_rates[instrum], "FLOAT"
-                        )
-                    except Exception:
-                        # fallback to direct write on error
-                        sf.write(
-                            out_path,
-                            result[instrum],
-                            sample_rates[instrum],
-                            subtype="FLOAT",
-                        )
-                else:
-                    sf.write(
-                        out_path,
-                        result[instrum],
-                        sample_rates[instrum],
-                        subtype="FLOAT",
+                progress()
+                for duplicate in duplicates.pop(digest, []):
+                    reuse_outputs(duplicate, digest)
+                    progress()
+
+            pending = tracks()
+            first = next(pending, None)
+            if first is not None:
+                if model is None:
+                    model = EnsembleDemucsMDXMusicSeparationModel(options)
+                try:
+                    model.separate_music_files(
+                        itertools.chain([first], pending),
+                        track_done,
+                        stems,
+                        max_files=batch_files,
                     )
-                print("File created: {}".format(out_path))
+                except StopProcessing:
+                    print("Stop requested during file processing")
+        else:
+            for i, input_audio in enumerate(options["input_audio"]):
+                # cooperative stop check before each file
+                if stop_requested():
+                    print("Stop requested, aborting before starting next file")
+                    break
+
+                digest, skipped = start_file(input_audio)
+                if skipped:
+                    continue
+
+                if model is None:
+                    model = EnsembleDemucsMDXMusicSeparationModel(options)
+                checkpoint = None
+                if checkpoint_dir is not None:
+                    # Unbounded, removed once the outputs of the file are written
+                    checkpoint = StemCache(os.path.join(checkpoint_dir, digest), 2**62)
 
-            # instrumental part 1
-            inst = audio.T - result["vocals"]
-            output_name = "instrum.wav"
-            out_path = os.path.join(subfolder, output_name)
-            if callable(file_write_func):
                 try:
-                    file_write_func(out_path, inst, sr, "FLOAT")
-                except Exception:
-                    sf.write(out_path, inst, sr, subtype="FLOAT")
-            else:
-                sf.write(out_path, inst, sr, subtype="FLOAT")
-            print("File created: {}".format(out_path))
-
-            if not only_vocals:
-                # instrumental part 2
-                inst2 = result["bass"] + result["drums"] + result["other"]
-                output_name = "instrum2.wav"
-                out_path = os.path.join(subfolder, output_name)
-                if callable(file_write_func):
-                    try:
-                        file_write_func(out_path, inst2, sr, "FLOAT")
-                    except Exception:
-                        sf.write(out_path, inst2, sr, subtype="FLOAT")
-                else:
-                    sf.write(out_path, inst2, sr, subtype="FLOAT")
-                print("File created: {}".format(out_path))
+                    audio, sr = read_audio(input_audio)
+                    result, sample_rates = model.separate_music_file(
+                        audio.T,
+                        sr,
+                        update_percent_func,
+                        i,
+                        len(options["input_audio"]),
+                        stems=stems,
+                        checkpoint=checkpoint,
+                    )
+                except StopProcessing:
+                    print("Stop requested during file processing")
+                    break
 
-            # notify caller (GUI worker) that this file is done
-            if callable(file_done_callback):
-                try:
-                    file_done_callback(input_audio)
-                except Exception:
-                    pass
+                finish_file(input_audio, digest, audio, sr, result, sample_rates)
+                if checkpoint is not None:
+                    shutil.rmtree(checkpoint.folder, ignore_errors=True)
 
         # ensure progress reaches 100 at end unless stopped early
         if update_percent_func is not None:
@@ -1096,6 +3061,152 @@ def predict_with_model(options):
     finally:
         # clear global pointer so future calls don't see stale stop flags
         CURRENT_OPTIONS = None
+    return model
+
+
+def worker_options(options, threads):
+    """Options of a `predict_with_workers` process using `threads` cores.
+    Callbacks and events stay in the parent, threads and memory budgets the
+    user did not set are split between the workers."""
+    result = plain_options(options)
+    for key in ("input_audio", "workers", "batch_files", "stop_requested"):
+        result.pop(key, None)
+    if not result.get("ensemble_threads"):
+        result["ensemble_threads"] = threads
+    if not result.get("memory_budget_mb"):
+        device = "cpu"
+        if torch.cuda.is_available() and not options.get("cpu"):
+            device = "cuda:0"
+        result["memory_budget_mb"] = (
+            available_memory(device) / int(options["workers"]) / (1024 * 1024)
+        )
+    return result
+
+
+def separation_worker(index, options, cpus, files, events, stop):
+    """Process of `predict_with_workers`. Takes input files from the `files`
+    queue until it gets None and reports start, progress and done events of
+    each file on `events`, tagged with `index`."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    options["update_percent_func"] = lambda val: events.put(("percent", index, val))
+    options["file_start_callback"] = lambda f: events.put(("start", index, f))
+    options["file_done_callback"] = lambda f: events.put(("done", index, f))
+
+    def watch():
+        # Polled, a process exiting inside `stop.wait()` would block `set`
+        while not stop.is_set():
+            sleep(0.2)
+        options["stop_requested"] = True
+
+    threading.Thread(target=watch, daemon=True).start()
+    model = None
+    while not stop.is_set():
+        input_audio = files.get()
+        if input_audio is None:
+            break
+        options["input_audio"] = [input_audio]
+        model = predict_with_model(options, model)
+
+
+def predict_with_workers(options):
+    """`predict_with_model` with the input files shared out to `workers`
+    processes.
+
+    Each process is pinned to its share of the CPU cores, uses as many
+    threads and loads its own models. Files are handed out from a shared
+    queue, so a process takes the next one as soon as it is free. Progress
+    and file callbacks of all processes go through `update_percent_func`,
+    `file_start_callback` and `file_done_callback` of `options` and a stop
+    request stops every process.
+    """
+    global CURRENT_OPTIONS
+
+    inputs = options["input_audio"]
+    workers = max(1, min(int(options["workers"]), len(inputs)))
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    threads = max(1, len(cpus) // workers)
+    if options.get("batch_files"):
+        print("Files are not batched together with workers")
+    print("Use {} workers with {} threads each".format(workers, threads))
+
+    update_percent_func = options.get("update_percent_func")
+    file_done_callback = options.get("file_done_callback")
+    file_start_callback = options.get("file_start_callback")
+
+    ctx = multiprocessing.get_context("spawn")
+    files = ctx.Queue()
+    events = ctx.Queue()
+    stop = ctx.Event()
+    for input_audio in inputs:
+        files.put(input_audio)
+    for _ in range(workers):
+        files.put(None)
+    shared = worker_options(options, threads)
+    processes = []
+    for w in range(workers):
+        share = cpus[w * threads : (w + 1) * threads] or [cpus[w % len(cpus)]]
+        process = ctx.Process(
+            target=separation_worker,
+            args=(w, shared, share, files, events, stop),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+
+    # make current options visible for stop checks
+    CURRENT_OPTIONS = options
+    try:
+        done = 0
+        running = {}
+        while True:
+            if stop_requested() and not stop.is_set():
+                print("Stop requested, stopping workers")
+                stop.set()
+            try:
+                kind, w, value = events.get(timeout=0.2)
+            except queue.Empty:
+                if not any(process.is_alive() for process in processes):
+                    break
+                continue
+            if kind == "start":
+                running[w] = 0.0
+                callback = file_start_callback
+            elif kind == "done":
+                running.pop(w, None)
+                done += 1
+                callback = file_done_callback
+            else:
+                # The end of a file reports 100 after it is done
+                if w in running:
+                    running[w] = value / 100.0
+                callback = None
+            if callable(callback):
+                try:
+                    callback(value)
+                except Exception:
+                    pass
+            if update_percent_func is not None:
+                update_percent_func(
+                    int(100 * (done + sum(running.values())) / len(inputs))
+                )
+        failed = [w for w, process in enumerate(processes) if process.exitcode != 0]
+        if failed:
+            raise RuntimeError(
+                "Workers {} failed, see their output above".format(
+                    ", ".join(str(w) for w in failed)
+                )
+            )
+        if update_percent_func is not None and not stop.is_set():
+            update_percent_func(int(100))
+    finally:
+        stop.set()
+        for process in processes:
+            process.join(timeout=10)
+        CURRENT_OPTIONS = None
 
 
 def md5(fname):
@@ -1106,22 +3217,26 @@ def md5(fname):
     return hash_md5.hexdigest()
 
 
-if __name__ == "__main__":
-    start_time = time()
-
-    print("Version: {}".format(__VERSION__))
-    m = argparse.ArgumentParser()
-    m.add_argument(
-        "--input_audio",
-        "-i",
-        nargs="+",
-        type=str,
-        help="Input audio location. You can provide multiple files at once",
-        required=True,
-    )
-    m.add_argument(
-        "--output_folder", "-r", type=str, help="Output audio folder", required=True
-    )
+def build_parser(add_help=True, inputs=True):
+    """Command line options of `predict_with_model`, without the input files
+    and output folder unless `inputs`."""
+    m = argparse.ArgumentParser(add_help=add_help)
+    if inputs:
+        m.add_argument(
+            "--input_audio",
+            "-i",
+            nargs="+",
+            type=str,
+            help="Input audio location. You can provide multiple files at once",
+            required=True,
+        )
+        m.add_argument(
+            "--output_folder",
+            "-r",
+            type=str,
+            help="Output audio folder",
+            required=True,
+        )
     m.add_argument(
         "--cpu",
         action="store_true",
@@ -1152,15 +3267,121 @@ if __name__ == "__main__":
         "--chunk_size",
         "-cz",
         type=int,
-        help="Chunk size for ONNX models. Set lower to reduce GPU memory consumption. Default: 1000000",
+        help="Chunk size for ONNX models. Set lower to reduce GPU memory consumption. Default: planned from the memory budget",
+        required=False,
+        default=None,
+    )
+    m.add_argument(
+        "--mdx_batch_size",
+        type=int,
+        help="Number of MDX frames sent to ONNX at once. Lower values use less memory.",
+        required=False,
+        default=None,
+    )
+    m.add_argument(
+        "--mdx_batch_mb",
+        type=float,
+        help="Memory budget in MB for one MDX batch. Used when --mdx_batch_size is not set.",
+        required=False,
+        default=None,
+    )
+    m.add_argument(
+        "--no_mdx_pipeline",
+        dest="mdx_pipeline",
+        action="store_false",
+        help="Run MDX STFT, ONNX and iSTFT one after another instead of as overlapping stages.",
+    )
+    m.add_argument(
+        "--model_cache_mb",
+        type=float,
+        help="Host memory budget in MB for keeping models loaded between files in low GPU mode (default: {}). 0 reloads every model for each file.".format(
+            MODEL_CACHE_DEFAULT_MB
+        ),
+    )
+    m.add_argument(
+        "--ensemble_threads",
+        type=int,
+        help="CPU threads shared by ensemble models running at the same time (default: all cores)",
+    )
+    m.add_argument(
+        "--ensemble_memory_mb",
+        type=float,
+        help="Memory budget in MB for ensemble models running at the same time (default: free device memory)",
+    )
+    m.add_argument(
+        "--torch_threads",
+        type=int,
+        help="Threads used by each Demucs model on CPU (default: half of ensemble_threads, the rest goes to ONNX Runtime)",
+    )
+    m.add_argument(
+        "--no_antipolar_batch",
+        dest="antipolar_batch",
+        action="store_false",
+        help="Run Demucs on the mix and the inverted mix as two passes. Uses less memory.",
+    )
+    m.add_argument(
+        "--no_demucs_stack",
+        dest="demucs_stack",
+        action="store_false",
+        help="Run the models of a Demucs bag one after the other, each with its own chunking.",
+    )
+    m.add_argument(
+        "--demucs_vmap",
+        action="store_true",
+        help="Run the stacked models of a Demucs bag as one torch.func.vmap call. Often slower on CPU.",
+    )
+    m.add_argument(
+        "--attention",
+        type=str,
+        choices=ATTENTION_BACKENDS,
+        help="Attention of the Demucs transformers: native (nn.MultiheadAttention) or sdpa (scaled_dot_product_attention, faster and lighter on CPU). Default: native",
+    )
+    m.add_argument(
+        "--onnx_intra_threads",
+        type=int,
+        help="Intra-op threads for ONNX Runtime. 0: on CPU the ensemble_threads not used by Demucs, on GPU ONNX Runtime decides.",
+        required=False,
+        default=0,
+    )
+    m.add_argument(
+        "--onnx_inter_threads",
+        type=int,
+        help="Inter-op threads for ONNX Runtime. 0 lets ONNX Runtime decide.",
+        required=False,
+        default=0,
+    )
+    m.add_argument(
+        "--onnx_graph_optimization",
+        type=str,
+        choices=list(ONNX_GRAPH_OPTIMIZATION),
+        help="ONNX Runtime graph optimization level",
+        required=False,
+        default="all",
+    )
+    m.add_argument(
+        "--onnx_execution_mode",
+        type=str,
+        choices=list(ONNX_EXECUTION_MODE),
+        help="ONNX Runtime execution mode",
         required=False,
-        default=1000000,
+        default="sequential",
+    )
+    m.add_argument(
+        "--no_onnx_cache",
+        dest="onnx_cache",
+        action="store_false",
+        help="Do not save or load optimized ONNX graphs next to the models.",
     )
     m.add_argument(
         "--large_gpu",
         action="store_true",
         help="It will store all models on GPU for faster processing of multiple audio files. Requires 11 and more GB of free GPU memory.",
     )
+    m.add_argument(
+        "--memory_budget_mb",
+        type=float,
+        help="Memory budget in MB used to plan which models stay loaded and the batch sizes (default: free device memory)",
+    )
     m.add_argument(
         "--use_kim_model_1",
         action="store_true",
@@ -1171,7 +3392,82 @@ if __name__ == "__main__":
         action="store_true",
         help="Only create vocals and instrumental. Skip bass, drums, other",
     )
+    m.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Folder for cached model outputs. Re-running a file with other weights or stems only redoes the cheap ensemble step.",
+    )
+    m.add_argument(
+        "--cache_mb",
+        type=float,
+        help="Size limit of --cache_dir in MB, least recently used entries are removed first (default: {})".format(
+            CACHE_DEFAULT_MB
+        ),
+    )
+    m.add_argument(
+        "--vocals_ensemble_weights",
+        nargs="+",
+        type=float,
+        help="Weights of Kim_Vocal, Kim_Inst and Demucs vocals (default: 12 8 3, or 6 1 with --single_onnx)",
+    )
+    for stem, default in (
+        ("vocals", "10 1 8 9"),
+        ("bass", "19 4 5 8"),
+        ("drums", "18 2 4 9"),
+        ("other", "14 2 5 10"),
+    ):
+        m.add_argument(
+            "--weights_{}".format(stem),
+            nargs=4,
+            type=float,
+            help="Weights of htdemucs_ft, htdemucs, htdemucs_6s and hdemucs_mmi for {} (default: {})".format(
+                stem, default
+            ),
+        )
+    m.add_argument(
+        "--skip_existing",
+        action="store_true",
+        help="Keep a manifest in the output folder and skip inputs already separated with the same options. Duplicate inputs get the outputs copied.",
+    )
+    m.add_argument(
+        "--resume",
+        action="store_true",
+        help="Like --skip_existing, and checkpoint every finished model of a file so an interrupted batch continues where it stopped",
+    )
+    m.add_argument(
+        "--checkpoint_dir",
+        type=str,
+        help="Scratch folder for --resume checkpoints (default: <output_folder>/.checkpoints)",
+    )
+    m.add_argument(
+        "--workers",
+        type=int,
+        help="Separate files in N processes, each pinned to its share of the CPU cores with its own models. Default: 1",
+    )
+    m.add_argument(
+        "--batch_files",
+        type=int,
+        help="Separate up to N files at once, model batches are filled with chunks of all of them. Speeds up many short files. Default: 1",
+    )
+    m.add_argument(
+        "--demucs_batch_size",
+        type=int,
+        help="Demucs segments per call with --batch_files (default: planned from the memory budget)",
+    )
+    m.add_argument(
+        "--stems",
+        nargs="+",
+        choices=STEMS,
+        help="Outputs to create. Only the models they need are run. Default: all",
+    )
+    return m
+
 
+if __name__ == "__main__":
+    start_time = time()
+
+    print("Version: {}".format(__VERSION__))
+    m = build_parser()
     options = m.parse_args().__dict__
     print("Options: ".format(options))
     for el in options:
@@ -0,0 +1,316 @@
+# coding: utf-8
+"""Spool directory job queue for running separations on several machines.
+
+Jobs are JSON files on a shared filesystem, each holding the options of one
+`predict_with_model` call. Submit jobs, then start workers on any number of
+machines pointing at the same folder:
+
+    python jobqueue.py submit /shared/spool -i a.wav b.wav -r /shared/results
+    python jobqueue.py work /shared/spool
+    python jobqueue.py status /shared/spool
+"""
+
+import argparse
+import json
+import os
+import socket
+import threading
+import traceback
+import uuid
+from time import sleep, time, time_ns
+
+import inference
+
+
+class JobQueue:
+    """Jobs in a spool directory shared by every worker.
+
+    The folder of a job file is its state: `pending`, `running`, `done` or
+    `failed`. A job changes state by a rename into `moving`, which only one
+    worker can do, so two workers never claim the same job. A running job is
+    touched by its worker every quarter of `lease` seconds. One not touched
+    for `lease` seconds is put back to pending by the next worker looking for
+    work, a job that failed or lost its lease `max_attempts` times is
+    failed. `lease` should be well above the clock skew between machines.
+    """
+
+    STATES = ["pending", "running", "done", "failed", "moving"]
+
+    def __init__(self, spool, lease=60.0, max_attempts=3):
+        self.spool = spool
+        self.lease = float(lease)
+        self.max_attempts = int(max_attempts)
+        for state in self.STATES:
+            os.makedirs(os.path.join(spool, state), exist_ok=True)
+
+    def path(self, state, job_id):
+        return os.path.join(self.spool, state, job_id + ".json")
+
+    def jobs(self, state):
+        """Ids of the jobs in `state`, oldest first."""
+        names = os.listdir(os.path.join(self.spool, state))
+        return sorted(name[:-5] for name in names if name.endswith(".json"))
+
+    def read(self, state, job_id):
+        try:
+            with open(self.path(state, job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, state, job):
+        path = self.path(state, job["id"])
+        tmp_path = "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, indent=1)
+        os.replace(tmp_path, path)
+
+    def move(self, job, src, dst):
+        """Move `job` from `src` to `dst`, saved with its current content.
+        False if the job is no longer in `src`, another worker took it."""
+        moving = self.path("moving", job["id"])
+        try:
+            os.rename(self.path(src, job["id"]), moving)
+            # The rename keeps the mtime, requeue_stale would take an old
+            # job for one left by a dead worker
+            os.utime(moving)
+        except OSError:
+            return False
+        self.write(dst, job)
+        try:
+            os.remove(moving)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def submit(self, options):
+        """Queue a `predict_with_model` call with `options`, returns the job id."""
+        job = {
+            "id": "{:020d}-{}".format(time_ns(), uuid.uuid4().hex[:8]),
+            "options": inference.plain_options(options),
+            "attempts": 0,
+            "submitted": time(),
+        }
+        self.write("pending", job)
+        return job["id"]
+
+    def claim(self, worker):
+        """Take the oldest pending job for `worker`, None if there is none."""
+        self.requeue_stale()
+        for job_id in self.jobs("pending"):
+            job = self.read("pending", job_id)
+            if job is None:
+                continue
+            job["attempts"] += 1
+            job["worker"] = worker
+            job["started"] = time()
+            if self.move(job, "pending", "running"):
+                return job
+        return None
+
+    def heartbeat(self, job_id):
+        """Renew the lease of a running job, False once it is lost."""
+        try:
+            os.utime(self.path("running", job_id))
+        except OSError:
+            return False
+        return True
+
+    def finish(self, job, error=None):
+        """Move a running job to done, or after an `error` back to pending
+        while it has attempts left, else to failed."""
+        job["finished"] = time()
+        state = "done"
+        if error is not None:
+            job["error"] = error
+            state = "pending" if job["attempts"] < self.max_attempts else "failed"
+        if not self.move(job, "running", state):
+            print("Lost the lease of job {}, not marked {}".format(job["id"], state))
+            return False
+        print("Job {}: {}".format(job["id"], state))
+        return True
+
+    def requeue_stale(self):
+        """Put running jobs whose lease expired back to pending."""
+        now = time()
+        for job_id in self.jobs("running"):
+            try:
+                expired = (
+                    os.path.getmtime(self.path("running", job_id)) < now - self.lease
+                )
+            except OSError:
+                continue
+            job = self.read("running", job_id) if expired else None
+            if job is None:
+                continue
+            job["error"] = "Lease of {} expired".format(job.get("worker"))
+            state = "pending" if job["attempts"] < self.max_attempts else "failed"
+            if self.move(job, "running", state):
+                print("Job {}: lease expired, {}".format(job_id, state))
+        # Left by a worker that died while moving a job
+        for job_id in self.jobs("moving"):
+            moving = self.path("moving", job_id)
+            try:
+                # The ctime also covers a rename not yet followed by utime
+                stat = os.stat(moving)
+                if max(stat.st_mtime, stat.st_ctime) >= now - self.lease:
+                    continue
+                if any(
+                    os.path.exists(self.path(state, job_id))
+                    for state in self.STATES[:4]
+                ):
+                    os.remove(moving)
+                else:
+                    os.rename(moving, self.path("pending", job_id))
+            except OSError:
+                continue
+
+    def status(self):
+        return {state: len(self.jobs(state)) for state in self.STATES[:4]}
+
+    def work(self, worker=None, overrides=None, wait=False, poll=5.0):
+        """Run jobs until none is pending or running, or forever with `wait`.
+
+        The ensemble stays loaded between jobs with the same
+        `ensemble_options`. `overrides` are options of this machine applied
+        to every job, like `cpu` or `torch_threads`.
+        """
+        worker = worker or "{}:{}".format(socket.gethostname(), os.getpid())
+        print("Worker {} on {}".format(worker, self.spool))
+        model = None
+        built_for = None
+        while True:
+            job = self.claim(worker)
+            if job is None:
+                if not wait and not self.jobs("pending") and not self.jobs("running"):
+                    break
+                sleep(poll)
+                continue
+            print("Job {}: running, attempt {}".format(job["id"], job["attempts"]))
+            options = dict(job["options"])
+            options.update(overrides or {})
+            options["stop_requested"] = False
+            if inference.ensemble_options(options) != built_for:
+                model = None
+                built_for = inference.ensemble_options(options)
+
+            finished = threading.Event()
+
+            def beat():
+                while not finished.wait(self.lease / 4):
+                    if not self.heartbeat(job["id"]):
+                        print("Lost the lease of job {}, stop".format(job["id"]))
+                        options["stop_requested"] = True
+                        return
+
+            thread = threading.Thread(target=beat, daemon=True)
+            thread.start()
+            error = None
+            try:
+                missing = [f for f in options["input_audio"] if not os.path.isfile(f)]
+                if missing:
+                    error = "No such file: {}".format(", ".join(missing))
+                    # Retrying does not help
+                    job["attempts"] = self.max_attempts
+                else:
+                    model = inference.predict_with_model(options, model)
+            except KeyboardInterrupt:
+                finished.set()
+                job["attempts"] -= 1
+                self.move(job, "running", "pending")
+                raise
+            except Exception:
+                error = traceback.format_exc()
+                print(error)
+            finally:
+                finished.set()
+                thread.join()
+            if options["stop_requested"]:
+                continue
+            self.finish(job, error)
+
+
+def submit_jobs(queue, options, files_per_job=1):
+    """Queue `options` as jobs of `files_per_job` input files each."""
+    inputs = [os.path.abspath(f) for f in options["input_audio"]]
+    options = dict(options, output_folder=os.path.abspath(options["output_folder"]))
+    ids = []
+    for i in range(0, len(inputs), files_per_job):
+        job_options = dict(options, input_audio=inputs[i : i + files_per_job])
+        ids.append(queue.submit(job_options))
+    return ids
+
+
+if __name__ == "__main__":
+    m = argparse.ArgumentParser(description="Spool directory job queue")
+    commands = m.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser(
+        "submit",
+        parents=[inference.build_parser(add_help=False)],
+        help="Queue input files with the options of inference.py",
+    )
+    submit.add_argument("spool", type=str, help="Spool folder shared by workers")
+    submit.add_argument(
+        "--files_per_job",
+        type=int,
+        default=1,
+        help="Input files per job. Default: 1",
+    )
+
+    work = commands.add_parser("work", help="Run queued jobs")
+    work.add_argument("spool", type=str, help="Spool folder shared by workers")
+    work.add_argument(
+        "--lease",
+        type=float,
+        default=60.0,
+        help="Seconds without heartbeat after which a running job is retried. Use the same value on every worker. Default: 60",
+    )
+    work.add_argument(
+        "--max_attempts",
+        type=int,
+        default=3,
+        help="Attempts per job before it is failed. Default: 3",
+    )
+    work.add_argument(
+        "--wait",
+        action="store_true",
+        help="Keep waiting for new jobs when the queue is empty",
+    )
+    work.add_argument(
+        "--poll",
+        type=float,
+        default=5.0,
+        help="Seconds between looks at an empty queue. Default: 5",
+    )
+    work.add_argument("--worker", type=str, help="Worker name. Default: host:pid")
+    work.add_argument(
+        "--cpu", action="store_true", help="Run every job on CPU on this machine"
+    )
+    work.add_argument(
+        "--torch_threads", type=int, help="Demucs threads on this machine"
+    )
+    work.add_argument(
+        "--memory_budget_mb", type=float, help="Memory budget of this machine"
+    )
+
+    status = commands.add_parser("status", help="Count jobs per state")
+    status.add_argument("spool", type=str, help="Spool folder shared by workers")
+
+    args = m.parse_args().__dict__
+    command = args.pop("command")
+    queue = JobQueue(args.pop("spool"))
+    if command == "submit":
+        files_per_job = max(1, args.pop("files_per_job"))
+        ids = submit_jobs(queue, args, files_per_job)
+        print("Queued {} jobs in {}".format(len(ids), queue.spool))
+    elif command == "work":
+        queue.lease = args.pop("lease")
+        queue.max_attempts = args.pop("max_attempts")
+        overrides = {key: value for key, value in args.items() if value}
+        for key in ("wait", "poll", "worker"):
+            overrides.pop(key, None)
+        queue.work(args["worker"], overrides, args["wait"], args["poll"])
+    else:
+        for state, count in queue.status().items():
+            print("{}: {}".format(state, count))
@@ -0,0 +1,46 @@
+# coding: utf-8
+"""Models of the demucs package run with the demucs4 classes."""
+
+import copy
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+htdemucs = pytest.importorskip("demucs.htdemucs")
+demucs_transformer = pytest.importorskip("demucs.transformer")
+
+from demucs4 import htdemucs as vendored  # noqa: E402
+from demucs4 import transformer  # noqa: E402
+
+
+def test_adopt_model():
+    torch.manual_seed(0)
+    original = htdemucs.HTDemucs(
+        ["drums", "bass", "other", "vocals"],
+        channels=16,
+        depth=3,
+        t_layers=2,
+        segment=1,
+    ).eval()
+    model = vendored.adopt_model(copy.deepcopy(original))
+    assert isinstance(model, vendored.HTDemucs)
+    assert isinstance(model, htdemucs.HTDemucs)
+    cross = model.crosstransformer
+    assert isinstance(cross, transformer.CrossTransformerEncoder)
+    assert isinstance(cross, demucs_transformer.CrossTransformerEncoder)
+    # Adopting again keeps the classes
+    assert type(vendored.adopt_model(model)) is type(model)
+
+    mix = torch.randn(1, 2, int(model.segment * model.samplerate))
+    with torch.no_grad():
+        expected = original(mix)
+        for _ in range(2):
+            torch.testing.assert_close(model(mix), expected, rtol=0, atol=0)
+    assert model.__dict__["_embedding_cache"]
+    assert cross.__dict__["_embedding_cache"]
+    model.train()
+    assert "_embedding_cache" not in cross.__dict__
@@ -0,0 +1,120 @@
+# coding: utf-8
+"""Parity of the sdpa attention backend of demucs4 with the native one."""
+
+import os
+import sys
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from demucs4 import transformer  # noqa: E402
+
+ATOL = 1e-5
+
+
+def run(model, backend, *args):
+    transformer.set_attention(model, backend)
+    with torch.no_grad():
+        return model(*args)
+
+
+def test_dense_encoder():
+    torch.manual_seed(0)
+    encoder = transformer.CrossTransformerEncoder(64, num_heads=4, num_layers=4)
+    encoder.eval()
+    x = torch.randn(2, 64, 4, 30)
+    xt = torch.randn(2, 64, 50)
+    native = run(encoder, "native", x, xt)
+    sdpa = run(encoder, "sdpa", x, xt)
+    for a, b in zip(native, sdpa):
+        torch.testing.assert_close(a, b, atol=ATOL, rtol=0)
+
+
+@pytest.mark.parametrize("norm_first", [False, True])
+def test_dense_layers_sequence_first(norm_first):
+    torch.manual_seed(0)
+    kwargs = dict(dropout=0.0, norm_first=norm_first)
+    layer = transformer.MyTransformerEncoderLayer(64, 4, 128, **kwargs).eval()
+    cross = transformer.CrossTransformerEncoderLayer(64, 4, 128, **kwargs).eval()
+    q = torch.randn(20, 2, 64)
+    k = torch.randn(30, 2, 64)
+    torch.testing.assert_close(
+        run(layer, "native", q), run(layer, "sdpa", q), atol=ATOL, rtol=0
+    )
+    torch.testing.assert_close(
+        run(cross, "native", q, k), run(cross, "sdpa", q, k), atol=ATOL, rtol=0
+    )
+
+
+def masked_attention(attn, x, y, mask):
+    """Reference attention of `MultiheadAttention` with a boolean mask."""
+    x, y = x.transpose(0, 1), y.transpose(0, 1)
+    B, N, C = x.shape
+    heads = attn.num_heads
+
+    def split(z):
+        return z.reshape(B, -1, heads, C // heads).transpose(1, 2)
+
+    q, k, v = split(attn.q(x)), split(attn.k(y)), split(attn.v(y))
+    weights = q @ k.transpose(-1, -2) / (C // heads) ** 0.5
+    weights = weights.masked_fill(~mask, float("-inf")).softmax(-1)
+    out = (weights @ v).transpose(1, 2).reshape(B, N, C)
+    return attn.proj(out).transpose(0, 1)
+
+
+@pytest.mark.parametrize("mask_type", ["diag", "jmask", "diag_jmask"])
+def test_sparse_masks(mask_type):
+    torch.manual_seed(0)
+    kwargs = dict(dropout=0.0, sparse=True, mask_type=mask_type, sparse_attn_window=3)
+    layer = transformer.MyTransformerEncoderLayer(64, 4, 128, **kwargs).eval()
+    cross = transformer.CrossTransformerEncoderLayer(64, 4, 128, **kwargs).eval()
+    q = torch.randn(20, 2, 64)
+    k = torch.randn(30, 2, 64)
+
+    with torch.no_grad():
+        mask = transformer.get_dense_mask(20, 20, mask_type, 3, 50, 42, 0.95, "cpu")
+        x = layer.norm1(q + masked_attention(layer.self_attn, q, q, mask))
+        expected = layer.norm2(x + layer._ff_block(x))
+        torch.testing.assert_close(run(layer, "sdpa", q), expected, atol=ATOL, rtol=0)
+
+        mask = transformer.get_dense_mask(30, 20, mask_type, 3, 50, 42, 0.95, "cpu")
+        x = cross.norm1(q + masked_attention(cross.cross_attn, q, k, mask))
+        expected = cross.norm2(x + cross._ff_block(x))
+        torch.testing.assert_close(
+            run(cross, "sdpa", q, k), expected, atol=ATOL, rtol=0
+        )
+
+
+def test_sparse_native():
+    pytest.importorskip("xformers")
+    torch.manual_seed(0)
+    kwargs = dict(dropout=0.0, sparse=True, mask_type="diag", sparse_attn_window=3)
+    layer = transformer.MyTransformerEncoderLayer(64, 4, 128, **kwargs).eval()
+    q = torch.randn(20, 2, 64)
+    torch.testing.assert_close(
+        run(layer, "native", q), run(layer, "sdpa", q), atol=ATOL, rtol=0
+    )
+
+
+def test_demucs_package_layers():
+    demucs_transformer = pytest.importorskip("demucs.transformer")
+    torch.manual_seed(0)
+    encoder = demucs_transformer.CrossTransformerEncoder(
+        64, num_heads=4, num_layers=2
+    ).eval()
+    x = torch.randn(1, 64, 4, 30)
+    xt = torch.randn(1, 64, 50)
+    with torch.no_grad():
+        native = encoder(x, xt)
+    sdpa = run(encoder, "sdpa", x, xt)
+    assert isinstance(encoder.layers[0], transformer.MyTransformerEncoderLayer)
+    assert isinstance(encoder.layers[1], transformer.CrossTransformerEncoderLayer)
+    for a, b in zip(native, sdpa):
+        torch.testing.assert_close(a, b, atol=ATOL, rtol=0)
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        transformer.set_attention(torch.nn.Identity(), "flash")
@@ -0,0 +1,41 @@
+# coding: utf-8
+"""Modules loaded by importing the GUI, each import in a fresh interpreter."""
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded on first separation or by the device probe, never at GUI startup
+HEAVY_MODULES = {"torch", "onnxruntime", "demucs", "soundfile", "inference"}
+
+CODE = """
+import sys
+import {}
+print(" ".join(sys.modules))
+"""
+
+
+def imported_modules(name):
+    """Import `name` in a new interpreter, returns the names of the loaded
+    modules."""
+    result = subprocess.run(
+        [sys.executable, "-c", CODE.format(name)],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(result.stdout.strip().split("\n")[-1].split())
+
+
+@pytest.mark.parametrize("name", ["gui_modern", "gui.main_window"])
+def test_gui_import_is_light(name):
+    # gui_modern swallows a failed GUI import, which would load nothing
+    pytest.importorskip("PyQt5")
+    modules = imported_modules(name)
+    assert "gui.main_window" in modules
+    assert not HEAVY_MODULES & modules
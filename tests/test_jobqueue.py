@@ -0,0 +1,65 @@
+# coding: utf-8
+"""Several worker processes on one spool folder, each job must run once."""
+
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import jobqueue  # noqa: E402
+
+
+def fake_worker(spool, log, lease):
+    def predict_with_model(options, model=None):
+        line = "{}\n".format(options["input_audio"][0]).encode()
+        fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        time.sleep(0.01)
+        return model
+
+    write = jobqueue.JobQueue.write
+
+    def slow_write(self, state, job):
+        # A slow shared filesystem, leaves jobs in `moving` for a while
+        time.sleep(0.02)
+        write(self, state, job)
+
+    jobqueue.inference.predict_with_model = predict_with_model
+    jobqueue.JobQueue.write = slow_write
+    jobqueue.JobQueue(spool, lease=lease).work(poll=0.05)
+
+
+def test_each_job_runs_once(tmp_path):
+    spool = str(tmp_path / "spool")
+    log = str(tmp_path / "runs.log")
+    lease = 1.0
+    queue = jobqueue.JobQueue(spool, lease=lease)
+    inputs = []
+    for i in range(40):
+        path = str(tmp_path / "input{}.wav".format(i))
+        open(path, "wb").close()
+        inputs.append(path)
+    jobqueue.submit_jobs(queue, {"input_audio": inputs, "output_folder": "out"})
+    # Jobs older than the lease, their files are claimed with an old mtime
+    time.sleep(lease * 1.5)
+
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=fake_worker, args=(spool, log, lease)) for _ in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+    assert [worker.exitcode for worker in workers] == [0] * len(workers)
+
+    with open(log) as f:
+        runs = f.read().split()
+    assert sorted(runs) == sorted(inputs)
+    assert queue.status() == {"pending": 0, "running": 0, "done": 40, "failed": 0}
+    assert queue.jobs("moving") == []
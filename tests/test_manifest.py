@@ -0,0 +1,173 @@
+# coding: utf-8
+"""skip_existing: the output folder manifest, copies of duplicate inputs and
+reruns, with a stand-in ensemble."""
+
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("demucs")
+sf = pytest.importorskip("soundfile")
+
+import inference  # noqa: E402
+
+SR = 44100
+
+
+class FakeEnsemble:
+    """Sources are fixed fractions of the mixture."""
+
+    instruments = ["bass", "drums", "other", "vocals"]
+
+    def outputs(self, audio):
+        return {name: audio * (i + 1) / 10 for i, name in enumerate(self.instruments)}
+
+    def separate_music_file(self, audio, sr, *args, **kwargs):
+        result = self.outputs(audio)
+        return result, {name: sr for name in result}
+
+    def separate_music_files(self, tracks, done, stems=None, max_files=8):
+        for input_audio, audio, sr in tracks:
+            done(input_audio, audio, self.outputs(audio), sr)
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Names of the inputs read, so separated."""
+    names = []
+    read_audio = inference.read_audio
+
+    def counting(input_audio):
+        names.append(os.path.basename(input_audio))
+        return read_audio(input_audio)
+
+    monkeypatch.setattr(inference, "read_audio", counting)
+    return names
+
+
+def write_audio(path, seed):
+    audio = np.random.default_rng(seed).uniform(-0.5, 0.5, (SR // 10, 2))
+    sf.write(path, audio.astype(np.float32), SR, subtype="FLOAT")
+    return path
+
+
+def run(inputs, output_folder, batch_files, reads):
+    reads.clear()
+    options = dict(
+        input_audio=inputs,
+        output_folder=output_folder,
+        skip_existing=True,
+        batch_files=batch_files,
+        cpu=True,
+    )
+    inference.predict_with_model(options, FakeEnsemble())
+    return sorted(reads)
+
+
+def entries(output_folder):
+    with open(os.path.join(output_folder, "manifest.json")) as f:
+        data = json.load(f)
+    return sorted(
+        (entry["folder"], entry.get("copies", [])) for entry in data["entries"].values()
+    )
+
+
+def read_output(output_folder, stem, name="vocals.wav"):
+    return sf.read(os.path.join(output_folder, stem, name))[0]
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    a = write_audio(str(tmp_path / "a.wav"), 0)
+    b = str(tmp_path / "b.wav")
+    shutil.copy(a, b)
+    c = write_audio(str(tmp_path / "c.wav"), 1)
+    return a, b, c
+
+
+@pytest.mark.parametrize("batch_files", [1, 3])
+def test_duplicates_and_rerun(tmp_path, inputs, reads, batch_files):
+    out = str(tmp_path / "out")
+    assert run(list(inputs), out, batch_files, reads) == ["a.wav", "c.wav"]
+    assert entries(out) == [("a", ["b"]), ("c", [])]
+    for name in os.listdir(os.path.join(out, "a")):
+        np.testing.assert_array_equal(
+            read_output(out, "b", name), read_output(out, "a", name)
+        )
+    assert run(list(inputs), out, batch_files, reads) == []
+    assert entries(out) == [("a", ["b"]), ("c", [])]
+
+
+@pytest.mark.parametrize("batch_files", [1, 3])
+def test_deleted_output(tmp_path, inputs, reads, batch_files):
+    out = str(tmp_path / "out")
+    run(list(inputs), out, batch_files, reads)
+    # A missing copy is copied again, a missing original separated again
+    os.remove(os.path.join(out, "b", "vocals.wav"))
+    assert run(list(inputs), out, batch_files, reads) == []
+    assert os.path.isfile(os.path.join(out, "b", "vocals.wav"))
+    os.remove(os.path.join(out, "a", "vocals.wav"))
+    assert run(list(inputs), out, batch_files, reads) == ["a.wav"]
+    assert entries(out) == [("a", ["b"]), ("c", [])]
+
+
+@pytest.mark.parametrize("batch_files", [1, 3])
+def test_rewritten_folder(tmp_path, reads, batch_files):
+    out = str(tmp_path / "out")
+    a = write_audio(str(tmp_path / "a.wav"), 0)
+    old = str(tmp_path / "old.wav")
+    shutil.copy(a, old)
+    assert run([a], out, batch_files, reads) == ["a.wav"]
+    expected = read_output(out, "a")
+
+    # New audio under the same name overwrites the outputs in folder a
+    write_audio(a, 2)
+    assert run([a], out, batch_files, reads) == ["a.wav"]
+    assert entries(out) == [("a", [])]
+
+    # The old audio is not copied from the outputs of the new one
+    b = str(tmp_path / "b.wav")
+    shutil.move(old, b)
+    assert run([b], out, batch_files, reads) == ["b.wav"]
+    np.testing.assert_array_equal(read_output(out, "b"), expected)
+    assert entries(out) == [("a", []), ("b", [])]
+
+
+def test_rewritten_original_keeps_copies(tmp_path, inputs, reads):
+    out = str(tmp_path / "out")
+    a, b, c = inputs
+    run([a, b], out, 1, reads)
+    write_audio(a, 2)
+    assert run([a, b], out, 1, reads) == ["a.wav"]
+    # The audio of b still has its outputs in folder b
+    assert entries(out) == [("a", []), ("b", [])]
+
+
+def record_entries(output_folder, worker, count):
+    manifest = inference.Manifest(output_folder)
+    for i in range(count):
+        name = "{}-{}".format(worker, i)
+        manifest.record(name, "options", name + ".wav", ["vocals"], name, [])
+
+
+def test_concurrent_records(tmp_path):
+    out = str(tmp_path)
+    context = multiprocessing.get_context("fork")
+    workers = [
+        context.Process(target=record_entries, args=(out, worker, 25))
+        for worker in range(4)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+        assert worker.exitcode == 0
+    assert len(entries(out)) == 100
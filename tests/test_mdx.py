@@ -0,0 +1,137 @@
+# coding: utf-8
+"""The batched MDX overlap-add engine against the original per-window loop."""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("demucs")
+
+import inference  # noqa: E402
+from demucs4.spec import get_plan  # noqa: E402
+
+ATOL = 1e-5
+
+
+class StubSession:
+    """Stands in for an ONNX session, a fixed non odd function of the input."""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self.calls = []
+
+    def run(self, outputs, feed):
+        spec = feed["input"]
+        self.calls.append(len(spec))
+        return [(self.scale * spec + 0.05 * spec**2).astype(np.float32)]
+
+
+def small_model(n_fft=256, hop=64, dim_t=32, dim_f=96):
+    """A Conv_TDF_net_trim_model with the geometry shrunk to a few thousand
+    samples per frame."""
+    model = inference.Conv_TDF_net_trim_model("cpu", "vocals", 11, n_fft, hop)
+    model.dim_t = dim_t
+    model.dim_f = dim_f
+    model.chunk_size = hop * (dim_t - 1)
+    model.plan = get_plan(n_fft, hop)
+    model.window = model.plan.window(torch.float32, "cpu")
+    return model
+
+
+def reference_base(mix, model, session):
+    """`demix_base` as it was before the batched engine, for one model."""
+    trim = model.n_fft // 2
+    gen_size = model.chunk_size - 2 * trim
+    n_sample = mix.shape[1]
+    pad = gen_size - n_sample % gen_size
+    mix_p = np.concatenate(
+        (np.zeros((2, trim)), mix, np.zeros((2, pad)), np.zeros((2, trim))), 1
+    )
+    waves = [
+        mix_p[:, i : i + model.chunk_size] for i in range(0, n_sample + pad, gen_size)
+    ]
+    waves = torch.tensor(np.array(waves), dtype=torch.float32)
+    with torch.no_grad():
+        res = session.run(None, {"input": model.stft(waves).numpy()})[0]
+        tar_waves = model.istft(torch.tensor(res))
+    return tar_waves[:, :, trim:-trim].transpose(0, 1).reshape(2, -1).numpy()[:, :-pad]
+
+
+def reference_full(mix, chunk_size, model, session, overlap):
+    """`demix_full` as it was before the batched engine, with a divider."""
+    step = int(chunk_size * (1 - overlap))
+    result = np.zeros((2, mix.shape[-1]), dtype=np.float32)
+    divider = np.zeros((2, mix.shape[-1]), dtype=np.float32)
+    for start in range(0, mix.shape[-1], step):
+        end = min(start + chunk_size, mix.shape[-1])
+        result[:, start:end] += reference_base(mix[:, start:end], model, session)
+        divider[:, start:end] += 1
+    return result / divider
+
+
+def random_mix(length, seed=0):
+    return (
+        np.random.RandomState(seed).uniform(-0.5, 0.5, (2, length)).astype(np.float32)
+    )
+
+
+# 12345 samples in windows of 5000 leave a last window shorter than the
+# others, and each window needs 3 frames of 1728 samples (the last one
+# partial), so 2 and 4 do not divide the frame count.
+@pytest.mark.parametrize("pipeline", [False, True])
+@pytest.mark.parametrize("batch_size", [1, 2, 4, None])
+@pytest.mark.parametrize("overlap", [0.0, 0.6])
+def test_demix_full(pipeline, batch_size, overlap):
+    model = small_model()
+    session = StubSession(0.5)
+    mix = random_mix(12345)
+    expected = reference_full(mix, 5000, model, StubSession(0.5), overlap)
+    got = inference.demix_full(
+        mix,
+        "cpu",
+        5000,
+        [model],
+        session,
+        overlap=overlap,
+        batch_size=batch_size,
+        pipeline=pipeline,
+    )
+    assert got.shape == (1, 2, mix.shape[-1])
+    np.testing.assert_allclose(got[0], expected, atol=ATOL, rtol=0)
+    if batch_size:
+        assert max(session.calls) <= batch_size
+
+
+def test_demix_base():
+    model = small_model()
+    session = StubSession(0.5)
+    mix = random_mix(4000, seed=1)
+    got = inference.demix_base(mix, "cpu", [model], session, batch_size=2)
+    np.testing.assert_allclose(
+        got[0], reference_base(mix, model, session), atol=ATOL, rtol=0
+    )
+
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_demix_full_multi_signs(pipeline):
+    model = small_model()
+    first, second = StubSession(0.5), StubSession(-0.8)
+    mix = random_mix(9000, seed=2)
+    heads = [(model, first, 1), (model, second, -1), (model, first, -1)]
+    got = inference.demix_full_multi(
+        mix, "cpu", 3000, heads, overlap=0.5, batch_size=3, pipeline=pipeline
+    )
+    expected = [
+        reference_full(mix, 3000, model, first, 0.5),
+        -reference_full(-mix, 3000, model, second, 0.5),
+        -reference_full(-mix, 3000, model, first, 0.5),
+    ]
+    assert len(got) == len(heads)
+    for a, b in zip(got, expected):
+        np.testing.assert_allclose(a, b, atol=ATOL, rtol=0)
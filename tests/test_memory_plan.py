@@ -0,0 +1,121 @@
+# coding: utf-8
+"""plan_memory with a fixed budget, and the host memory it starts from."""
+
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("demucs")
+
+import inference  # noqa: E402
+
+GB = 1024 * 1024 * 1024
+NAMES = [
+    inference.DEMUCS_VOCALS_MODEL,
+    "Kim_Vocal_2.onnx",
+    "Kim_Inst.onnx",
+] + inference.DEMUCS_INSTRUM_MODELS
+
+
+@pytest.fixture
+def ensemble(monkeypatch, tmp_path):
+    # Model sizes must not depend on the models downloaded on this machine
+    monkeypatch.setattr(inference, "MODEL_FOLDER", str(tmp_path) + "/")
+
+    def unknown_budget(device):
+        raise AssertionError("the budget is given")
+
+    monkeypatch.setattr(inference, "available_memory", unknown_budget)
+    return SimpleNamespace(
+        device="cpu",
+        mdx_models1=inference.get_models("vocals", "cpu", vocals_model_type=2),
+        mdx_batch_size=None,
+        mdx_batch_bytes=None,
+        antipolar_batch=True,
+        model_names=lambda: list(NAMES),
+    )
+
+
+def plan(ensemble, budget_gb, **options):
+    options["memory_budget_mb"] = budget_gb * 1024
+    return inference.plan_memory(ensemble, options)
+
+
+def check_fits(result):
+    resident = sum(result.model_bytes[name] for name in result.resident)
+    assert resident + max(result.stage_bytes.values()) <= result.budget
+    assert result.graph_memory == result.budget - resident
+
+
+def test_large_budget_keeps_everything(ensemble):
+    result = plan(ensemble, 256)
+    assert result.budget == 256 * GB
+    assert result.resident == NAMES
+    assert result.antipolar_batch
+    assert result.demucs_batch_size == inference.DEMUCS_MAX_BATCH
+    assert result.chunk_size == 200000000
+    assert result.mdx_batch_size == inference.MDX_DEFAULT_MAX_BATCH
+    check_fits(result)
+
+
+def test_laptop_budget(ensemble):
+    result = plan(ensemble, 8)
+    assert result.resident == NAMES
+    assert result.antipolar_batch
+    # A MDX batch takes at most an eighth of the budget, 256 MB per frame
+    assert result.mdx_batch_size == 4
+    assert result.demucs_batch_size == 3
+    check_fits(result)
+
+
+def test_small_budget(ensemble):
+    result = plan(ensemble, 2)
+    assert not result.antipolar_batch
+    assert result.demucs_batch_size == 1
+    assert result.mdx_batch_size == 1
+    # Kept in ensemble order while they fit next to the largest stage
+    assert result.resident == [
+        inference.DEMUCS_VOCALS_MODEL,
+        "Kim_Vocal_2.onnx",
+        "Kim_Inst.onnx",
+        "htdemucs",
+        "htdemucs_6s",
+    ]
+    check_fits(result)
+
+
+def test_user_settings_are_kept(ensemble):
+    result = plan(
+        ensemble,
+        3,
+        chunk_size=500000,
+        demucs_batch_size=4,
+        ensemble_memory_mb=1024,
+    )
+    assert result.chunk_size == 500000
+    assert result.demucs_batch_size == 4
+    assert result.graph_memory == GB
+    ensemble.mdx_batch_size = 7
+    assert plan(ensemble, 3).mdx_batch_size == 7
+
+
+def test_available_memory_counts_page_cache(monkeypatch, tmp_path):
+    meminfo = tmp_path / "meminfo"
+    meminfo.write_text(
+        "MemTotal:       16000000 kB\n"
+        "MemFree:         3000000 kB\n"
+        "MemAvailable:    5000000 kB\n"
+        "Cached:          2500000 kB\n"
+    )
+    monkeypatch.setattr(inference, "MEMINFO", str(meminfo))
+    assert inference.available_memory("cpu") == 5000000 * 1024
+
+
+def test_available_memory_without_meminfo(monkeypatch, tmp_path):
+    monkeypatch.setattr(inference, "MEMINFO", str(tmp_path / "missing"))
+    assert inference.available_memory("cpu") > 0
@@ -0,0 +1,72 @@
+# coding: utf-8
+"""ModelRegistry loads of different keys must not wait for each other."""
+
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("demucs")
+
+import inference  # noqa: E402
+
+
+def test_slow_load_does_not_block_other_keys():
+    registry = inference.ModelRegistry(1000)
+    registry.get("cached", lambda: "cached model", lambda model: 1)
+    started, release = threading.Event(), threading.Event()
+
+    def slow_loader():
+        started.set()
+        release.wait(10)
+        return "slow model"
+
+    thread = threading.Thread(target=registry.get, args=("slow", slow_loader))
+    thread.start()
+    try:
+        assert started.wait(10)
+        start_time = time.time()
+        assert registry.get("cached", lambda: "reloaded") == "cached model"
+        assert registry.get("other", lambda: "other model") == "other model"
+        assert time.time() - start_time < 1
+    finally:
+        release.set()
+        thread.join()
+    assert registry._loading == {}
+
+
+def test_concurrent_misses_load_once():
+    registry = inference.ModelRegistry(1000)
+    loads = []
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.1)
+        return object()
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(registry.get("key", loader, lambda m: 1))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
+    assert all(model is results[0] for model in results)
+    assert (registry.hits, registry.misses) == (3, 1)
+
+
+def test_over_budget_is_not_kept():
+    registry = inference.ModelRegistry(10)
+    first = registry.get("big", object, lambda model: 100)
+    assert registry.get("big", object, lambda model: 100) is not first
+    assert registry.used_bytes() == 0
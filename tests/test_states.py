@@ -0,0 +1,69 @@
+# coding: utf-8
+"""Flat model files of demucs4.states, built without touching torch.nn.init."""
+
+import os
+import sys
+import threading
+
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip("diffq")
+htdemucs = pytest.importorskip("demucs.htdemucs")
+
+from demucs4 import states  # noqa: E402
+
+SOURCES = ["drums", "bass", "other", "vocals"]
+KWARGS = dict(channels=16, depth=3, t_layers=2, segment=2)
+
+
+@pytest.fixture
+def flat_path(tmp_path):
+    torch.manual_seed(0)
+    model = htdemucs.HTDemucs(SOURCES, **KWARGS)
+    package = {
+        "klass": htdemucs.HTDemucs,
+        "args": [SOURCES],
+        "kwargs": dict(KWARGS),
+        "state": model.state_dict(),
+    }
+    path = str(tmp_path / "model.flat")
+    states.save_flat_model(package, path)
+    return path, model
+
+
+def test_load_flat_model(flat_path):
+    path, model = flat_path
+    loaded = states.load_flat_model(path)
+    assert type(loaded) is htdemucs.HTDemucs
+    expected = model.state_dict()
+    for name, tensor in loaded.state_dict().items():
+        assert tensor.device.type == "cpu"
+        torch.testing.assert_close(tensor, expected[name], rtol=0, atol=0)
+
+
+def test_other_threads_initialize_weights(flat_path):
+    path, _ = flat_path
+    init = {name: getattr(torch.nn.init, name) for name in dir(torch.nn.init)}
+    stop = threading.Event()
+    built = []
+
+    def build():
+        while not stop.is_set():
+            built.append(torch.nn.Linear(64, 64))
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    try:
+        for _ in range(5):
+            states.load_flat_model(path)
+    finally:
+        stop.set()
+        thread.join()
+    assert built
+    for layer in built:
+        assert layer.weight.device.type == "cpu"
+        assert layer.weight.abs().sum() > 0
+    assert {name: getattr(torch.nn.init, name) for name in dir(torch.nn.init)} == init
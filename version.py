@@ -0,0 +1,4 @@
+# coding: utf-8
+"""Version of the separation code, importable without loading torch."""
+
+__VERSION__ = "1.0.1"